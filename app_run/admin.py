@@ -1,6 +1,6 @@
 from django.contrib import admin
 
-from .models import Run, Challenge, CollectibleItem
+from .models import Run, Challenge, ChallengeRule, CollectibleItem
 
 
 @admin.register(Run)
@@ -21,6 +21,15 @@ class ChallengeAdmin(admin.ModelAdmin):
     search_fields = ["full_name", "athlete__username"]
 
 
+@admin.register(ChallengeRule)
+class ChallengeRuleAdmin(admin.ModelAdmin):
+    list_display = ["id", "full_name", "metric", "threshold", "window"]
+    list_display_links = ["id", "full_name"]
+    list_filter = ["metric"]
+    list_per_page = 20
+    search_fields = ["full_name"]
+
+
 @admin.register(CollectibleItem)
 class CollectibleItemAdmin(admin.ModelAdmin):
     list_display = ["uid", "name"]
@@ -5,3 +5,6 @@ class AppRunConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'app_run'
     verbose_name = 'Забеги'
+
+    def ready(self):
+        from . import signals  # noqa: F401
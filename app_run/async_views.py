@@ -0,0 +1,178 @@
+import json
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.http import HttpResponse, StreamingHttpResponse
+from django.views.decorators.http import require_GET, require_POST
+from rest_framework.renderers import JSONRenderer
+
+from .live import broker
+from .models import Run, Position, Subscribe
+from .serializers import PositionSerializer, PositionFieldsSerializer, LastPositionSerializer
+from .utils import record_position, stop_run
+
+# Асинхронные версии частых эндпоинтов для запуска под ASGI (uvicorn). Запросы к базе идут через
+# асинхронный ORM, а транзакции с блокировкой забега и расчёт расстояний до предметов выполняются
+# одним вызовом в потоке, не блокируя цикл событий. Ответы совпадают с синхронными эндпоинтами.
+
+RUN_NOT_FOUND = f"No {Run._meta.object_name} matches the given query."
+COACH_NOT_FOUND = f"No {User._meta.object_name} matches the given query."
+
+
+def json_response(data, status=200):
+    return HttpResponse(JSONRenderer().render(data), content_type="application/json", status=status)
+
+
+def parse_request_data(request):
+    if request.content_type == "application/json":
+        return json.loads(request.body or b"{}")
+
+    return request.POST
+
+
+async def get_position_run(value):
+    error_messages = PositionSerializer().fields["run"].error_messages
+    if value is None:
+        return None, error_messages["null"]
+    if isinstance(value, bool):
+        return None, error_messages["incorrect_type"].format(data_type=type(value).__name__)
+
+    try:
+        run = await Run.objects.select_related("athlete").aget(pk=value)
+    except Run.DoesNotExist:
+        return None, error_messages["does_not_exist"].format(pk_value=value)
+    except (TypeError, ValueError):
+        return None, error_messages["incorrect_type"].format(data_type=type(value).__name__)
+
+    if run.status != "in_progress":
+        return None, "Забег должен быть в процессе"
+
+    return run, None
+
+
+def save_position(position):
+    collectible = record_position(position)
+    if collectible:
+        return {
+            "message": f"Вы нашли предмет {collectible.name}",
+            "item_id": collectible.id
+        }
+
+    return PositionSerializer(position).data
+
+
+@require_POST
+async def position_create_view(request):
+    try:
+        data = parse_request_data(request)
+    except ValueError as exc:
+        return json_response({"detail": f"JSON parse error - {exc}"}, status=400)
+
+    serializer = PositionFieldsSerializer(data=data)
+    errors = {} if serializer.is_valid() else dict(serializer.errors)
+    if not isinstance(data, dict):
+        return json_response(errors, status=400)
+
+    if "run" not in data:
+        errors["run"] = [PositionSerializer().fields["run"].error_messages["required"]]
+    else:
+        run, run_error = await get_position_run(data.get("run"))
+        if run_error:
+            errors["run"] = [run_error]
+
+    if errors:
+        return json_response(errors, status=400)
+
+    position = Position(run=run, **serializer.validated_data)
+
+    return json_response(await sync_to_async(save_position)(position), status=201)
+
+
+@require_POST
+async def run_start_view(request, run_id):
+    if not await Run.objects.filter(pk=run_id).aexists():
+        return json_response({"detail": RUN_NOT_FOUND}, status=404)
+
+    if not await Run.objects.filter(pk=run_id, status="init").aupdate(status="in_progress"):
+        return json_response({
+            "message": "Невозможно начать забег, он уже начат или закончен",
+        }, status=400)
+
+    return json_response({
+        "message": "Забег начат"
+    })
+
+
+@require_POST
+async def run_stop_view(request, run_id):
+    run, stopped = await sync_to_async(stop_run)(run_id)
+    if run is None:
+        return json_response({"detail": RUN_NOT_FOUND}, status=404)
+    if not stopped:
+        return json_response({
+            "message": "Невозможно закончить забег, он не начат"
+        }, status=400)
+
+    return json_response({
+        "message": "Забег закончен"
+    })
+
+
+def format_event(event, event_id, data):
+    lines = [f"event: {event}", f"data: {JSONRenderer().render(data).decode()}"]
+    if event_id is not None:
+        lines.insert(0, f"id: {event_id}")
+
+    return ("\n".join(lines) + "\n\n").encode()
+
+
+async def get_coach_athlete_ids(coach_id):
+    return [
+        athlete_id async for athlete_id in
+        Subscribe.objects.filter(subscribed_to_id=coach_id).values_list("subscriber_id", flat=True)
+    ]
+
+
+async def live_feed_events(coach_id):
+    # Подписка оформляется до снимка текущих забегов, чтобы не пропустить позиции между ними.
+    # Раз в LIVE_FEED_HEARTBEAT секунд без событий список спортсменов тренера перечитывается.
+    subscription = broker.subscribe(await get_coach_athlete_ids(coach_id), settings.LIVE_FEED_QUEUE_SIZE)
+    try:
+        yield b"retry: 3000\n\n"
+
+        runs = Run.objects.filter(athlete_id__in=subscription.athlete_ids, status="in_progress").order_by("id")
+        yield format_event("snapshot", None, [
+            {
+                "run": run.id,
+                "athlete": run.athlete_id,
+                "last_position": LastPositionSerializer(run.get_last_position()).data if run.positions_count else None
+            }
+            async for run in runs
+        ])
+
+        while True:
+            event = await subscription.get(settings.LIVE_FEED_HEARTBEAT)
+            dropped = subscription.pop_dropped()
+            if dropped:
+                yield format_event("dropped", None, {"count": dropped})
+
+            if event is None:
+                broker.update(subscription, await get_coach_athlete_ids(coach_id))
+                yield b": heartbeat\n\n"
+            else:
+                yield format_event(*event)
+    finally:
+        broker.unsubscribe(subscription)
+
+
+@require_GET
+async def coach_live_feed_view(request, coach_id):
+    if not await User.objects.filter(pk=coach_id, is_staff=True).aexists():
+        return json_response({"detail": COACH_NOT_FOUND}, status=404)
+
+    response = StreamingHttpResponse(live_feed_events(coach_id), content_type="text/event-stream")
+    response["Cache-Control"] = "no-cache"
+    response["X-Accel-Buffering"] = "no"
+
+    return response
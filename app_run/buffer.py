@@ -0,0 +1,165 @@
+import atexit
+import logging
+import threading
+import time
+
+from django.conf import settings
+from django.db import transaction, close_old_connections, DatabaseError
+from django.db.models import F, Value
+from django.db.models.functions import Coalesce, Least
+
+from .live import publish_positions
+from .models import Run, Position
+from .tracks import chain_positions
+
+logger = logging.getLogger(__name__)
+
+# Отложенная запись позиций (POSITION_WRITE_BEHIND). Принятые позиции копятся в буфере процесса
+# и записываются одним bulk_create, когда их набирается POSITION_BUFFER_SIZE, но не реже раза
+# в POSITION_BUFFER_INTERVAL секунд. Последняя позиция каждого забега хранится в памяти, поэтому
+# скорость и дистанция считаются так же, как при записи сразу.
+#
+# Гарантии:
+#   - при штатной остановке процесса буфер записывается;
+#   - при падении процесса теряются позиции этого процесса не более чем за POSITION_BUFFER_INTERVAL секунд;
+#   - если запись не удалась, теряется вся пачка - позиции всех забегов, принятые с прошлой записи;
+#     ошибка логируется, пачка не повторяется, а цепочка этих забегов продолжается от последней
+#     записанной позиции;
+#   - позиции забега, который закончился до записи, отбрасываются и логируются;
+#   - до записи позиции не видны в API, а в ответе на приём id равен null;
+#   - финиш забега записывает буфер своего процесса, поэтому позиции одного забега должен принимать
+#     один процесс (на этом же держится цепочка скорости и дистанции).
+# Буфер без интервала не запускает фоновый поток и записывается при заполнении или явным flush().
+RUN_STATE_TTL = 300
+
+
+class PositionBuffer:
+    def __init__(self, size, interval):
+        self.size = size
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.flush_lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.pending = {}
+        self.count = 0
+        self.last_positions = {}
+        self.thread = None
+        atexit.register(self.flush)
+
+    def add(self, run, positions):
+        with self.lock:
+            state = self.last_positions.get(run.id)
+            for position in positions:
+                position.run = run
+            last_position, dist_diffs = chain_positions(state[0] if state else run.get_last_position(), positions)
+            self.last_positions[run.id] = (last_position, time.monotonic())
+
+            pending = self.pending.get(run.id)
+            if pending is None:
+                pending = self.pending[run.id] = {"run": run, "positions": [], "distance": 0, "speed_sum": 0}
+            pending["positions"] += positions
+            pending["distance"] += float(dist_diffs.sum()) / 1000
+            pending["speed_sum"] += sum(position.speed for position in positions)
+            pending["last_position"] = last_position
+            self.count += len(positions)
+
+            if self.thread is None and self.interval:
+                self.thread = threading.Thread(target=self.run_flusher, name="position-buffer", daemon=True)
+                self.thread.start()
+            full = self.count >= self.size
+
+        if full:
+            if self.thread is None:
+                self.flush()
+            else:
+                self.wakeup.set()
+
+        return positions
+
+    def forget(self, run_id):
+        self.forget_runs([run_id])
+
+    def run_flusher(self):
+        while True:
+            self.wakeup.wait(self.interval)
+            self.wakeup.clear()
+            close_old_connections()
+            self.flush()
+
+    def flush(self):
+        # Записи идут по одной, чтобы приращения по забегам применялись в порядке приёма
+        with self.flush_lock:
+            with self.lock:
+                pending, self.pending, self.count = self.pending, {}, 0
+                expired_at = time.monotonic() - RUN_STATE_TTL
+                self.last_positions = {
+                    run_id: state for run_id, state in self.last_positions.items() if state[1] >= expired_at
+                }
+
+            if not pending:
+                return 0
+
+            try:
+                with transaction.atomic():
+                    # Забег мог закончиться, пока его позиции ждали в буфере: блокировка строк забегов
+                    # ждёт транзакцию stop_run, законченные забеги не обновляются
+                    active_run_ids = set(
+                        Run.objects.select_for_update().filter(pk__in=list(pending), status="in_progress")
+                        .order_by("id").values_list("id", flat=True)
+                    )
+                    active = {run_id: run_pending for run_id, run_pending in pending.items() if run_id in active_run_ids}
+
+                    positions = [position for run_pending in active.values() for position in run_pending["positions"]]
+                    Position.objects.bulk_create(positions, batch_size=1000)
+                    for run_id, run_pending in active.items():
+                        self.update_run(run_id, run_pending)
+                        publish_positions(run_pending["run"], run_pending["positions"])
+            except DatabaseError:
+                logger.exception(
+                    "Не удалось записать %s позиций из буфера", sum(len(run_pending["positions"]) for run_pending in pending.values())
+                )
+                self.forget_runs(pending)
+                return 0
+
+            dropped = [run_id for run_id in pending if run_id not in active_run_ids]
+            if dropped:
+                logger.warning(
+                    "Отброшено %s позиций законченных забегов %s",
+                    sum(len(pending[run_id]["positions"]) for run_id in dropped), dropped
+                )
+                self.forget_runs(dropped)
+
+            return len(positions)
+
+    def forget_runs(self, run_ids):
+        with self.lock:
+            for run_id in run_ids:
+                self.last_positions.pop(run_id, None)
+
+    def update_run(self, run_id, run_pending):
+        first_position_at = Value(min(position.date_time for position in run_pending["positions"]))
+        last_position = run_pending["last_position"]
+
+        Run.objects.filter(pk=run_id).update(
+            positions_count=F("positions_count") + len(run_pending["positions"]),
+            positions_distance=F("positions_distance") + run_pending["distance"],
+            speed_sum=F("speed_sum") + run_pending["speed_sum"],
+            first_position_at=Least(Coalesce("first_position_at", first_position_at), first_position_at),
+            last_position_at=last_position.date_time,
+            last_latitude=last_position.latitude,
+            last_longitude=last_position.longitude,
+            last_position_distance=last_position.distance
+        )
+
+
+_buffer = None
+_buffer_lock = threading.Lock()
+
+
+def get_position_buffer():
+    global _buffer
+    with _buffer_lock:
+        if _buffer is None:
+            _buffer = PositionBuffer(settings.POSITION_BUFFER_SIZE, settings.POSITION_BUFFER_INTERVAL)
+
+    return _buffer
@@ -0,0 +1,136 @@
+import math
+
+import numpy as np
+from geopy.distance import geodesic
+
+GRID_CELL_SIZE = 0.01
+
+# Наименьшая длина градуса меридиана (на экваторе) и длина градуса параллели на экваторе, в метрах.
+# С ними границы поиска по сетке получаются с запасом для эллипсоида WGS-84.
+METERS_PER_LATITUDE_DEGREE = 110_574
+METERS_PER_LONGITUDE_DEGREE = 111_320
+
+WGS84_A = 6_378_137.0
+WGS84_E2 = 6.69437999014e-3
+MEAN_EARTH_RADIUS = 6_371_008.8
+
+# Модели расчёта длины отрезков трека. Погрешности относительно geopy.distance.geodesic
+# (алгоритм Karney, WGS-84), измерены на случайных отрезках с обоими концами в указанном поясе широт:
+#   "ellipsoidal" - плоская аппроксимация с радиусами кривизны WGS-84 в средней широте отрезка.
+#                   Погрешность растёт как квадрат длины отрезка и резко - к полюсам:
+#                     |широта| <= 60°: 10 км - 0.00005 %, 100 км - 0.005 %, 1000 км - 0.4 %;
+#                     |широта| <= 80°: 10 км - 0.0005 %, 100 км - 0.05 %, 1000 км - 4 %;
+#                     |широта| <= 89°: 100 м - 0.00001 %, 1 км - 0.0005 %, 10 км - 0.05 %, 100 км - 4 %,
+#                                      на 1000 км у полюса - десятки процентов.
+#                   Отрезки между соседними точками трека (десятки метров) считаются практически точно;
+#   "haversine"   - формула гаверсинусов на сфере среднего радиуса: не более 0.6 % на любых длинах и широтах;
+#   "geodesic"    - точный расчёт через geopy, без векторизации (эталон).
+DISTANCE_MODELS = ["ellipsoidal", "haversine", "geodesic"]
+
+
+def get_grid_cell(latitude, longitude):
+    return (
+        math.floor(float(latitude) / GRID_CELL_SIZE),
+        math.floor(float(longitude) / GRID_CELL_SIZE)
+    )
+
+
+def get_grid_ranges(coords_list, radius):
+    radius = radius * 1.01
+    lat_min = lat_max = None
+    lon_ranges = []
+
+    for latitude, longitude in coords_list:
+        latitude = float(latitude)
+        longitude = float(longitude)
+
+        lat_delta = radius / METERS_PER_LATITUDE_DEGREE
+        lat_min = min(lat_min, latitude - lat_delta) if lat_min is not None else latitude - lat_delta
+        lat_max = max(lat_max, latitude + lat_delta) if lat_max is not None else latitude + lat_delta
+
+        cos_lat = math.cos(math.radians(min(abs(latitude) + lat_delta, 90)))
+        if cos_lat * METERS_PER_LONGITUDE_DEGREE * 180 <= radius:
+            lon_ranges.append((-180, 180))
+            continue
+
+        lon_delta = radius / (cos_lat * METERS_PER_LONGITUDE_DEGREE)
+        west, east = longitude - lon_delta, longitude + lon_delta
+        if west < -180:
+            lon_ranges += [(west + 360, 180), (-180, east)]
+        elif east > 180:
+            lon_ranges += [(west, 180), (-180, east - 360)]
+        else:
+            lon_ranges.append((west, east))
+
+    cell_lon_ranges = []
+    for west, east in sorted(lon_ranges):
+        west_cell = get_grid_cell(0, west)[1]
+        east_cell = get_grid_cell(0, east)[1]
+        if cell_lon_ranges and west_cell <= cell_lon_ranges[-1][1] + 1:
+            cell_lon_ranges[-1] = (cell_lon_ranges[-1][0], max(cell_lon_ranges[-1][1], east_cell))
+        else:
+            cell_lon_ranges.append((west_cell, east_cell))
+
+    cell_lat_range = (get_grid_cell(lat_min, 0)[0], get_grid_cell(lat_max, 0)[0])
+
+    return cell_lat_range, cell_lon_ranges
+
+
+def _haversine(lat_1, lon_1, lat_2, lon_2):
+    d_lat = lat_2 - lat_1
+    d_lon = lon_2 - lon_1
+    a = np.sin(d_lat / 2) ** 2 + np.cos(lat_1) * np.cos(lat_2) * np.sin(d_lon / 2) ** 2
+
+    return 2 * MEAN_EARTH_RADIUS * np.arcsin(np.sqrt(np.clip(a, 0, 1)))
+
+
+def _ellipsoidal(lat_1, lon_1, lat_2, lon_2):
+    lat_mid = (lat_1 + lat_2) / 2
+    d_lat = lat_2 - lat_1
+    d_lon = np.remainder(lon_2 - lon_1 + np.pi, 2 * np.pi) - np.pi
+
+    w = 1 - WGS84_E2 * np.sin(lat_mid) ** 2
+    meridian_radius = WGS84_A * (1 - WGS84_E2) / w ** 1.5
+    normal_radius = WGS84_A / np.sqrt(w)
+
+    return np.hypot(meridian_radius * d_lat, normal_radius * np.cos(lat_mid) * d_lon)
+
+
+def distances(latitudes_1, longitudes_1, latitudes_2, longitudes_2, model="ellipsoidal"):
+    if model not in DISTANCE_MODELS:
+        raise ValueError(f"Неизвестная модель расчёта расстояния: {model}")
+
+    lat_1 = np.asarray(latitudes_1, dtype=np.float64)
+    lon_1 = np.asarray(longitudes_1, dtype=np.float64)
+    lat_2 = np.asarray(latitudes_2, dtype=np.float64)
+    lon_2 = np.asarray(longitudes_2, dtype=np.float64)
+
+    if model == "geodesic":
+        return np.array([
+            geodesic(coord_1, coord_2).meters
+            for coord_1, coord_2 in zip(zip(lat_1, lon_1), zip(lat_2, lon_2))
+        ])
+
+    if model == "haversine":
+        return _haversine(np.radians(lat_1), np.radians(lon_1), np.radians(lat_2), np.radians(lon_2))
+
+    return _ellipsoidal(np.radians(lat_1), np.radians(lon_1), np.radians(lat_2), np.radians(lon_2))
+
+
+def segment_distances(latitudes, longitudes, model="ellipsoidal"):
+    latitudes = np.asarray(latitudes, dtype=np.float64)
+    longitudes = np.asarray(longitudes, dtype=np.float64)
+    if latitudes.size < 2:
+        return np.zeros(0)
+
+    return distances(latitudes[:-1], longitudes[:-1], latitudes[1:], longitudes[1:], model)
+
+
+def track_distance(coords, model="ellipsoidal"):
+    if len(coords) < 2:
+        return 0.0
+
+    latitudes = np.fromiter((coord[0] for coord in coords), dtype=np.float64, count=len(coords))
+    longitudes = np.fromiter((coord[1] for coord in coords), dtype=np.float64, count=len(coords))
+
+    return float(segment_distances(latitudes, longitudes, model).sum()) / 1000
@@ -0,0 +1,118 @@
+import asyncio
+import threading
+from collections import deque
+
+from django.db import transaction
+
+from .serializers import PositionSerializer
+
+# Живая лента позиций для тренеров. Брокер живёт в памяти процесса: публикация идёт из потока,
+# в котором закоммичена транзакция, а события доставляются в цикл событий каждого подписчика.
+# У подписчика ограниченная очередь: если клиент не успевает читать, старые события вытесняются
+# новыми, а число потерянных событий сообщается клиенту. Лента видит только позиции, принятые
+# этим же процессом, поэтому тренеры и приём позиций должны обслуживаться одним ASGI-воркером.
+
+
+class Subscription:
+    def __init__(self, athlete_ids, max_size):
+        self.loop = asyncio.get_running_loop()
+        self.athlete_ids = set(athlete_ids)
+        self.events = deque(maxlen=max_size)
+        self.dropped = 0
+        self.ready = asyncio.Event()
+
+    def put(self, event):
+        if len(self.events) == self.events.maxlen:
+            self.dropped += 1
+        self.events.append(event)
+        self.ready.set()
+
+    async def get(self, timeout):
+        if not self.events:
+            self.ready.clear()
+            try:
+                await asyncio.wait_for(self.ready.wait(), timeout)
+            except TimeoutError:
+                return None
+
+        return self.events.popleft()
+
+    def pop_dropped(self):
+        dropped, self.dropped = self.dropped, 0
+        return dropped
+
+
+class LiveFeedBroker:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.subscriptions = {}
+
+    def subscribe(self, athlete_ids, max_size):
+        subscription = Subscription(athlete_ids, max_size)
+        with self.lock:
+            for athlete_id in subscription.athlete_ids:
+                self.subscriptions.setdefault(athlete_id, set()).add(subscription)
+
+        return subscription
+
+    def unsubscribe(self, subscription):
+        self.update(subscription, [])
+
+    def update(self, subscription, athlete_ids):
+        athlete_ids = set(athlete_ids)
+        with self.lock:
+            for athlete_id in subscription.athlete_ids - athlete_ids:
+                subscribers = self.subscriptions.get(athlete_id)
+                if subscribers is not None:
+                    subscribers.discard(subscription)
+                    if not subscribers:
+                        del self.subscriptions[athlete_id]
+            for athlete_id in athlete_ids - subscription.athlete_ids:
+                self.subscriptions.setdefault(athlete_id, set()).add(subscription)
+            subscription.athlete_ids = athlete_ids
+
+    def has_subscribers(self, athlete_id):
+        return athlete_id in self.subscriptions
+
+    def publish(self, athlete_id, events):
+        with self.lock:
+            subscriptions = list(self.subscriptions.get(athlete_id, ()))
+
+        for subscription in subscriptions:
+            for event in events:
+                try:
+                    subscription.loop.call_soon_threadsafe(subscription.put, event)
+                except RuntimeError:
+                    # Цикл событий клиента уже закрыт, подписка снимется при выходе из потока ответа
+                    break
+
+
+broker = LiveFeedBroker()
+
+
+def publish_after_commit(athlete_id, make_events):
+    # События собираются только при наличии подписчиков, чтобы не нагружать приём позиций
+    if not broker.has_subscribers(athlete_id):
+        return
+
+    events = make_events()
+    transaction.on_commit(lambda: broker.publish(athlete_id, events))
+
+
+def publish_positions(run, positions):
+    publish_after_commit(run.athlete_id, lambda: [
+        ("position", position.id, {**data, "athlete": run.athlete_id})
+        for position, data in zip(positions, PositionSerializer(positions, many=True).data)
+    ])
+
+
+def publish_run_finished(run):
+    publish_after_commit(run.athlete_id, lambda: [
+        ("run_finished", None, {
+            "run": run.id,
+            "athlete": run.athlete_id,
+            "distance": run.distance,
+            "run_time_seconds": run.run_time_seconds,
+            "speed": run.speed
+        })
+    ])
@@ -0,0 +1,22 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from app_run.models import ChallengeRule
+from app_run.utils import backfill_challenges
+
+
+class Command(BaseCommand):
+    help = "Выдаёт челленджи по правилам с учётом всех законченных забегов"
+
+    def add_arguments(self, parser):
+        parser.add_argument("rules", nargs="*", help="Названия правил (по умолчанию все)")
+        parser.add_argument("--batch-size", type=int, default=1000)
+
+    def handle(self, *args, **options):
+        rules = ChallengeRule.objects.all()
+        if options["rules"]:
+            rules = rules.filter(full_name__in=options["rules"])
+            if len(rules) != len(set(options["rules"])):
+                raise CommandError("Не все правила найдены")
+
+        awarded = backfill_challenges(list(rules), batch_size=options["batch_size"])
+        self.stdout.write(self.style.SUCCESS(f"Выдано челленджей: {awarded}"))
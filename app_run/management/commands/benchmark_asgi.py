@@ -0,0 +1,162 @@
+import http.client
+import json
+import os
+import socket
+import subprocess
+import sys
+import threading
+import time
+from datetime import timedelta
+
+import numpy as np
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+
+from app_run.models import Run
+
+# Синхронные эндпоинты под WSGI-сервером Django против асинхронных под uvicorn
+SERVERS = {
+    "wsgi": {
+        "command": lambda port: [sys.executable, str(settings.BASE_DIR / "manage.py"), "runserver", f"127.0.0.1:{port}",
+                                 "--noreload", "--skip-checks"],
+        "prefix": "/api/",
+    },
+    "asgi": {
+        "command": lambda port: [sys.executable, "-m", "uvicorn", "project_run.asgi:application", "--host", "127.0.0.1",
+                                 "--port", str(port), "--no-access-log", "--log-level", "warning"],
+        "prefix": "/api/async/",
+    },
+}
+
+
+class Command(BaseCommand):
+    help = "Сравнивает запросы в секунду для приёма позиций и старта/финиша забегов: uvicorn (ASGI) против WSGI"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--servers", nargs="+", choices=list(SERVERS), default=list(SERVERS))
+        parser.add_argument("--concurrency", type=int, default=8)
+        parser.add_argument("--requests", type=int, default=100, help="Запросов на одного клиента")
+        parser.add_argument("--port", type=int, default=8765)
+        parser.add_argument("--output", default=None)
+
+    def wait_for_port(self, port, process, timeout=30):
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            if process.poll() is not None:
+                raise CommandError(f"Сервер завершился с кодом {process.returncode}")
+            try:
+                socket.create_connection(("127.0.0.1", port), timeout=0.5).close()
+                return
+            except OSError:
+                time.sleep(0.2)
+
+        raise CommandError(f"Сервер не начал принимать соединения на порту {port}")
+
+    def start_server(self, name, port, **env):
+        env = {
+            **os.environ,
+            "DJANGO_SETTINGS_MODULE": os.environ.get("DJANGO_SETTINGS_MODULE", "project_run.settings"),
+            "DJANGO_DEBUG": "0",
+            **env
+        }
+
+        return subprocess.Popen(SERVERS[name]["command"](port), env=env, cwd=settings.BASE_DIR,
+                                stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    def load(self, port, concurrency, make_requests):
+        timings = [[] for _ in range(concurrency)]
+        errors = [0] * concurrency
+        error_samples = []
+
+        def worker(index):
+            connection = http.client.HTTPConnection("127.0.0.1", port, timeout=60)
+            for method, path, body in make_requests(index):
+                started = time.perf_counter()
+                connection.request(method, path, body=json.dumps(body) if body is not None else None,
+                                   headers={"Content-Type": "application/json"})
+                response = connection.getresponse()
+                content = response.read()
+                timings[index].append(time.perf_counter() - started)
+                if response.status >= 400:
+                    errors[index] += 1
+                    error_samples.append(f"{response.status} {content[:200]!r}")
+            connection.close()
+
+        threads = [threading.Thread(target=worker, args=(index,)) for index in range(concurrency)]
+        started = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        total = time.perf_counter() - started
+
+        timings = np.array([timing for worker_timings in timings for timing in worker_timings]) * 1000
+
+        return {
+            "requests": len(timings),
+            "errors": sum(errors),
+            "requests_per_second": round(len(timings) / total, 1),
+            "p50_ms": round(float(np.percentile(timings, 50)), 3),
+            "p95_ms": round(float(np.percentile(timings, 95)), 3),
+            "p99_ms": round(float(np.percentile(timings, 99)), 3),
+            "error_samples": error_samples[:3],
+        }
+
+    def run_server(self, name, options, athlete):
+        concurrency = options["concurrency"]
+        count = options["requests"]
+        prefix = SERVERS[name]["prefix"]
+        port = options["port"]
+
+        position_runs = [Run.objects.create(athlete=athlete, status="in_progress").id for _ in range(concurrency)]
+        stop_runs = [[Run.objects.create(athlete=athlete).id for _ in range(count // 2)] for _ in range(concurrency)]
+        started_at = timezone.now()
+
+        def position_requests(index):
+            for i in range(count):
+                yield "POST", f"{prefix}positions/", {
+                    "run": position_runs[index],
+                    "latitude": f"{55.75 + i * 0.00003:.4f}",
+                    "longitude": f"{37.61 + index * 0.01:.4f}",
+                    "date_time": (started_at + timedelta(seconds=i)).strftime("%Y-%m-%dT%H:%M:%S.%f")
+                }
+
+        def start_stop_requests(index):
+            for run_id in stop_runs[index]:
+                yield "POST", f"{prefix}runs/{run_id}/start/", None
+                yield "POST", f"{prefix}runs/{run_id}/stop/", None
+
+        process = self.start_server(name, port)
+        try:
+            self.wait_for_port(port, process)
+            results = {
+                "position_create": self.load(port, concurrency, position_requests),
+                "run_start_stop": self.load(port, concurrency, start_stop_requests),
+            }
+        finally:
+            process.terminate()
+            process.wait()
+            Run.objects.filter(pk__in=position_runs + [run_id for runs in stop_runs for run_id in runs]).delete()
+
+        for scenario, result in results.items():
+            self.stdout.write(
+                f"{name} {scenario}: {result['requests_per_second']} запросов/с, p50 {result['p50_ms']} мс, "
+                f"p95 {result['p95_ms']} мс, p99 {result['p99_ms']} мс, ошибок {result['errors']}"
+            )
+            for sample in result["error_samples"]:
+                self.stdout.write(f"  {sample}")
+
+        return results
+
+    def handle(self, *args, **options):
+        athlete = User.objects.create(username=f"benchmark_{time.time_ns()}")
+        try:
+            report = {name: self.run_server(name, options, athlete) for name in options["servers"]}
+        finally:
+            athlete.delete()
+
+        if options["output"]:
+            with open(options["output"], "w") as file:
+                json.dump({"concurrency": options["concurrency"], "results": report}, file, indent=2, ensure_ascii=False)
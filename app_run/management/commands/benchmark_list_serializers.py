@@ -0,0 +1,60 @@
+import time
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from app_run.models import Run, AthleteStats
+from app_run.serializers import RunSerializer, UserSerializer, RunValuesSerializer, UserValuesSerializer
+
+
+class Command(BaseCommand):
+    help = "Сравнивает время сериализации страниц списков забегов и пользователей: ModelSerializer против values()"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--sizes", type=int, nargs="+", default=[100, 1000])
+        parser.add_argument("--repeat", type=int, default=10)
+
+    def measure(self, func, repeat):
+        timings = []
+        for _ in range(repeat):
+            started = time.perf_counter()
+            func()
+            timings.append(time.perf_counter() - started)
+
+        return min(timings) * 1000
+
+    def handle(self, *args, **options):
+        count = max(options["sizes"])
+        with transaction.atomic():
+            prefix = f"benchmark_{time.time_ns()}"
+            athletes = User.objects.bulk_create([
+                User(username=f"{prefix}_{i}", first_name="Имя", last_name="Фамилия", is_staff=i % 10 == 0)
+                for i in range(count)
+            ])
+            AthleteStats.objects.bulk_create([AthleteStats(athlete=athlete, rating_sum=9, rating_count=2) for athlete in athletes])
+            Run.objects.bulk_create([
+                Run(athlete=athletes[i], comment="Забег", status="finished", distance=5.25, run_time_seconds=1800, speed=2.9)
+                for i in range(count)
+            ])
+
+            runs = Run.objects.filter(athlete__username__startswith=prefix).select_related("athlete")
+            users = User.objects.filter(username__startswith=prefix).order_by("id").select_related("stats")
+
+            for size in options["sizes"]:
+                for name, queryset, serializer_class, values_serializer_class in [
+                    ("runs", runs, RunSerializer, RunValuesSerializer),
+                    ("users", users, UserSerializer, UserValuesSerializer),
+                ]:
+                    model_time = self.measure(
+                        lambda: serializer_class(queryset[:size], many=True).data, options["repeat"]
+                    )
+                    values_time = self.measure(
+                        lambda: values_serializer_class(values_serializer_class.get_rows(queryset)[:size]).data, options["repeat"]
+                    )
+                    self.stdout.write(
+                        f"{name}, {size} строк: ModelSerializer {model_time:.1f} мс, values() {values_time:.1f} мс, "
+                        f"ускорение {model_time / values_time:.1f}x"
+                    )
+
+            transaction.set_rollback(True)
@@ -0,0 +1,93 @@
+import http.client
+import json
+import time
+from datetime import timedelta
+
+from django.contrib.auth.models import User
+from django.utils import timezone
+
+from app_run.models import Run, Position
+from .benchmark_asgi import Command as ServerBenchmarkCommand, SERVERS
+
+MODES = {"direct": "0", "buffered": "1"}
+
+
+class Command(ServerBenchmarkCommand):
+    help = "Сравнивает приём позиций в секунду: запись каждой позиции сразу против буфера отложенной записи"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--server", choices=list(SERVERS), default="asgi")
+        parser.add_argument("--concurrency", type=int, default=16)
+        parser.add_argument("--requests", type=int, default=200, help="Позиций на одного клиента")
+        parser.add_argument("--port", type=int, default=8766)
+        parser.add_argument("--output", default=None)
+
+    def stop_runs(self, port, prefix, run_ids):
+        connection = http.client.HTTPConnection("127.0.0.1", port, timeout=60)
+        for run_id in run_ids:
+            connection.request("POST", f"{prefix}runs/{run_id}/stop/")
+            connection.getresponse().read()
+        connection.close()
+
+    def run_mode(self, mode, options, athlete):
+        concurrency = options["concurrency"]
+        count = options["requests"]
+        prefix = SERVERS[options["server"]]["prefix"]
+        port = options["port"]
+
+        run_ids = [Run.objects.create(athlete=athlete, status="in_progress").id for _ in range(concurrency)]
+        started_at = timezone.now()
+
+        def position_requests(index):
+            for i in range(count):
+                yield "POST", f"{prefix}positions/", {
+                    "run": run_ids[index],
+                    "latitude": f"{55.75 + i * 0.00003:.4f}",
+                    "longitude": f"{37.61 + index * 0.01:.4f}",
+                    "date_time": (started_at + timedelta(seconds=i)).strftime("%Y-%m-%dT%H:%M:%S.%f")
+                }
+
+        process = self.start_server(options["server"], port, POSITION_WRITE_BEHIND=MODES[mode])
+        try:
+            self.wait_for_port(port, process)
+            result = self.load(port, concurrency, position_requests)
+            # Финиш забегов записывает буфер, после него все принятые позиции должны быть в базе
+            self.stop_runs(port, prefix, run_ids)
+        finally:
+            process.terminate()
+            process.wait()
+
+        runs = Run.objects.filter(pk__in=run_ids).order_by("id")
+        result["stored"] = Position.objects.filter(run__in=run_ids).count()
+        result["lost"] = result["requests"] - result["errors"] - result["stored"]
+        result["distances"] = [run.distance for run in runs]
+        runs.delete()
+
+        self.stdout.write(
+            f"{mode}: {result['requests_per_second']} позиций/с, p50 {result['p50_ms']} мс, p95 {result['p95_ms']} мс, "
+            f"p99 {result['p99_ms']} мс, ошибок {result['errors']}, записано {result['stored']}, потеряно {result['lost']}"
+        )
+        for sample in result["error_samples"]:
+            self.stdout.write(f"  {sample}")
+
+        return result
+
+    def handle(self, *args, **options):
+        athlete = User.objects.create(username=f"benchmark_{time.time_ns()}")
+        try:
+            report = {mode: self.run_mode(mode, options, athlete) for mode in MODES}
+        finally:
+            athlete.delete()
+
+        if report["direct"]["distances"] != report["buffered"]["distances"]:
+            self.stderr.write("Дистанции забегов в режимах различаются")
+        for result in report.values():
+            del result["distances"]
+
+        if options["output"]:
+            with open(options["output"], "w") as file:
+                json.dump({
+                    "server": options["server"],
+                    "concurrency": options["concurrency"],
+                    "results": report
+                }, file, indent=2, ensure_ascii=False)
@@ -0,0 +1,71 @@
+import time
+from datetime import timedelta
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.utils import timezone
+
+from app_run.models import Run, Position, RunTrack
+from app_run.serializers import PositionSerializer
+from app_run.utils import add_positions, get_track_positions, pack_run_track
+
+
+class Command(BaseCommand):
+    help = "Сравнивает объём хранения и время чтения трека: строки Position против упакованного RunTrack"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--points", type=int, default=7200)
+        parser.add_argument("--repeat", type=int, default=10)
+
+    def get_storage_size(self, tables):
+        with connection.cursor() as cursor:
+            if connection.vendor == "postgresql":
+                cursor.execute("SELECT sum(pg_total_relation_size(relname::regclass)) FROM unnest(%s::text[]) AS relname", [tables])
+            else:
+                cursor.execute(
+                    "SELECT sum(pgsize) FROM dbstat WHERE name IN (SELECT name FROM sqlite_schema WHERE tbl_name IN (%s))"
+                    % ", ".join(["%s"] * len(tables)), tables
+                )
+
+            return cursor.fetchone()[0] or 0
+
+    def measure(self, func, repeat):
+        timings = []
+        for _ in range(repeat):
+            started = time.perf_counter()
+            func()
+            timings.append(time.perf_counter() - started)
+
+        return min(timings) * 1000
+
+    def handle(self, *args, **options):
+        points = options["points"]
+        with transaction.atomic():
+            athlete = User.objects.create(username=f"benchmark_{time.time_ns()}")
+            run = Run.objects.create(athlete=athlete, status="in_progress")
+
+            rows_before = self.get_storage_size([Position._meta.db_table])
+            started_at = timezone.now()
+            add_positions(run, [
+                Position(latitude=f"{55 + i * 0.0001:.4f}", longitude=f"{37 + (i % 50) * 0.0001:.4f}",
+                         date_time=started_at + timedelta(seconds=i))
+                for i in range(points)
+            ])
+            rows_size = self.get_storage_size([Position._meta.db_table]) - rows_before
+
+            Run.objects.filter(pk=run.pk).update(status="finished")
+            pack_run_track(run.pk)
+            blob_size = len(RunTrack.objects.get(run=run).data)
+
+            rows_time = self.measure(
+                lambda: PositionSerializer(Position.objects.filter(run__id=run.pk).select_related("run"), many=True).data,
+                options["repeat"]
+            )
+            blob_time = self.measure(lambda: get_track_positions(run.pk), options["repeat"])
+
+            transaction.set_rollback(True)
+
+        self.stdout.write(f"Точек: {points}")
+        self.stdout.write(f"Строки Position: {rows_size} байт ({rows_size / points:.1f} на точку), чтение {rows_time:.1f} мс")
+        self.stdout.write(f"RunTrack: {blob_size} байт ({blob_size / points:.1f} на точку), чтение {blob_time:.1f} мс")
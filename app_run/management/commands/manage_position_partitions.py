@@ -0,0 +1,33 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.utils import timezone
+
+from app_run.partitions import is_partitioning_supported, add_months, ensure_partitions, detach_partitions, month_start
+
+
+class Command(BaseCommand):
+    help = "Создаёт помесячные секции позиций на будущие месяцы и отсоединяет старые (только PostgreSQL)"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--months-ahead", type=int, default=3)
+        parser.add_argument("--retain-months", type=int, default=None,
+                            help="Отсоединить секции, которые целиком старше указанного числа месяцев")
+        parser.add_argument("--drop", action="store_true", help="Удалить отсоединённые секции вместе с данными")
+
+    def handle(self, *args, **options):
+        if not is_partitioning_supported(connection):
+            raise CommandError("Секционирование позиций поддерживается только в PostgreSQL")
+
+        current_month = month_start(timezone.now())
+        with transaction.atomic(), connection.cursor() as cursor:
+            created = ensure_partitions(cursor, current_month, add_months(current_month, options["months_ahead"]))
+
+            detached = []
+            if options["retain_months"] is not None:
+                detached = detach_partitions(cursor, add_months(current_month, -options["retain_months"]), options["drop"])
+
+        for name in created:
+            self.stdout.write(f"Создана секция {name}")
+        for name in detached:
+            self.stdout.write(f"{'Удалена' if options['drop'] else 'Отсоединена'} секция {name}")
+        self.stdout.write(self.style.SUCCESS(f"Создано секций: {len(created)}, отсоединено: {len(detached)}"))
@@ -0,0 +1,21 @@
+from django.core.management.base import BaseCommand
+
+from app_run.models import Run
+from app_run.utils import pack_run_track
+
+
+class Command(BaseCommand):
+    help = "Упаковывает позиции законченных забегов без трека (законченных не через остановку), запускается по расписанию"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=500)
+
+    def handle(self, *args, **options):
+        runs = Run.objects.filter(status="finished", track__isnull=True).values_list("id", flat=True)
+
+        packed = 0
+        for run_id in runs.iterator(chunk_size=options["batch_size"]):
+            if pack_run_track(run_id) is not None:
+                packed += 1
+
+        self.stdout.write(self.style.SUCCESS(f"Упаковано треков: {packed}"))
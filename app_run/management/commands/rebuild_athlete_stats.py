@@ -0,0 +1,15 @@
+from django.core.management.base import BaseCommand
+
+from app_run.models import AthleteStats
+from app_run.utils import rebuild_athlete_stats
+
+
+class Command(BaseCommand):
+    help = "Пересчитывает статистику пользователей по законченным забегам и оценкам"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=1000)
+
+    def handle(self, *args, **options):
+        rebuild_athlete_stats(batch_size=options["batch_size"])
+        self.stdout.write(self.style.SUCCESS(f"Статистика пересчитана: {AthleteStats.objects.count()} записей"))
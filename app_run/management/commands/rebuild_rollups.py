@@ -0,0 +1,15 @@
+from django.core.management.base import BaseCommand
+
+from app_run.utils import rebuild_rollups
+
+
+class Command(BaseCommand):
+    help = "Пересчитывает итоги атлетов по дням, неделям и месяцам по законченным забегам, параллельно по группам атлетов"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--chunk-size", type=int, default=1000, help="Атлетов в одной группе")
+        parser.add_argument("--workers", type=int, default=4)
+
+    def handle(self, *args, **options):
+        created = rebuild_rollups(chunk_size=options["chunk_size"], workers=options["workers"])
+        self.stdout.write(self.style.SUCCESS(f"Итоги пересчитаны: {created} записей"))
@@ -0,0 +1,181 @@
+import json
+import subprocess
+import time
+from datetime import timedelta
+
+import numpy as np
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.management import call_command
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.test import Client
+from django.test.utils import override_settings
+from django.utils import timezone
+
+from app_run.models import Run, Position
+from app_run.utils import add_positions
+
+
+class Command(BaseCommand):
+    help = "Замеряет пропускную способность и задержки p50/p95/p99 горячих эндпоинтов на тестовой базе SQLite"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--output", default="benchmark_results.json")
+        parser.add_argument("--requests", type=int, default=200)
+        parser.add_argument("--athletes", type=int, default=50)
+        parser.add_argument("--coaches", type=int, default=5)
+        parser.add_argument("--runs-per-athlete", type=int, default=3)
+        parser.add_argument("--points-per-run", type=int, default=300)
+        parser.add_argument("--collectibles", type=int, default=1000)
+        parser.add_argument("--keepdb", action="store_true")
+
+    def measure(self, name, requests, prepare=None):
+        timings = []
+        started = time.perf_counter()
+        for request in requests:
+            if prepare:
+                prepare()
+            request_started = time.perf_counter()
+            response = request()
+            timings.append(time.perf_counter() - request_started)
+            if response.status_code >= 400:
+                raise RuntimeError(f"{name}: ответ {response.status_code} {response.content[:200]!r}")
+        total = time.perf_counter() - started
+
+        timings = np.array(timings) * 1000
+        result = {
+            "requests": len(timings),
+            "throughput_rps": round(len(timings) / timings.sum() * 1000, 1),
+            "mean_ms": round(float(timings.mean()), 3),
+            "p50_ms": round(float(np.percentile(timings, 50)), 3),
+            "p95_ms": round(float(np.percentile(timings, 95)), 3),
+            "p99_ms": round(float(np.percentile(timings, 99)), 3),
+            "wall_s": round(total, 3),
+        }
+        self.stdout.write(
+            f"{name}: {result['throughput_rps']} запросов/с, p50 {result['p50_ms']} мс, p95 {result['p95_ms']} мс, "
+            f"p99 {result['p99_ms']} мс"
+        )
+
+        return result
+
+    def make_runs(self, athletes, count, points):
+        runs = []
+        now = timezone.now()
+        for i in range(count):
+            run = Run.objects.create(athlete=athletes[i % len(athletes)], status="in_progress")
+            add_positions(run, [
+                Position(latitude=f"{55.75 + j * 0.0001:.4f}", longitude=f"{37.61 + j * 0.0001:.4f}", date_time=now + timedelta(seconds=j))
+                for j in range(points)
+            ])
+            runs.append(run)
+
+        return runs
+
+    def run_scenarios(self, options):
+        client = Client()
+        count = options["requests"]
+        athletes = list(User.objects.filter(is_staff=False, username__startswith="seed_").order_by("id"))
+        coaches = list(User.objects.filter(is_staff=True, username__startswith="seed_").order_by("id"))
+        results = {}
+
+        run = Run.objects.create(athlete=athletes[0], status="in_progress")
+        started_at = timezone.now()
+        results["position_create"] = self.measure("position_create", [
+            lambda i=i: client.post("/api/positions/", {
+                "run": run.id, "latitude": f"{55.75 + i * 0.00003:.4f}", "longitude": "37.6100",
+                "date_time": (started_at + timedelta(seconds=i)).strftime("%Y-%m-%dT%H:%M:%S.%f")
+            }, content_type="application/json")
+            for i in range(count)
+        ])
+
+        batch_run = Run.objects.create(athlete=athletes[0], status="in_progress")
+        results["position_batch_60"] = self.measure("position_batch_60", [
+            lambda i=i: client.post("/api/positions/batch/", {
+                "run": batch_run.id,
+                "positions": [
+                    {
+                        "latitude": f"{55.75 + (i * 60 + j) * 0.00003:.4f}", "longitude": "37.6100",
+                        "date_time": (started_at + timedelta(seconds=i * 60 + j)).strftime("%Y-%m-%dT%H:%M:%S.%f")
+                    }
+                    for j in range(60)
+                ]
+            }, content_type="application/json")
+            for i in range(count)
+        ])
+
+        stop_runs = self.make_runs(athletes, count, 60)
+        results["run_stop"] = self.measure("run_stop", [
+            lambda run_id=stop_run.id: client.post(f"/api/runs/{run_id}/stop/") for stop_run in stop_runs
+        ])
+
+        results["user_list"] = self.measure("user_list", [lambda: client.get("/api/users/?size=100")] * count)
+        results["user_search"] = self.measure("user_search", [
+            lambda i=i: client.get(f"/api/users/?search=Фамилия{i % 97}&size=100") for i in range(count)
+        ])
+        results["run_list"] = self.measure("run_list", [lambda: client.get("/api/runs/?size=100")] * count)
+
+        results["coach_analytics"] = self.measure("coach_analytics", [
+            lambda i=i: client.get(f"/api/analytics_for_coach/{coaches[i % len(coaches)].id}/") for i in range(count)
+        ], prepare=cache.clear)
+        results["coach_analytics_cached"] = self.measure("coach_analytics_cached", [
+            lambda i=i: client.get(f"/api/analytics_for_coach/{coaches[i % len(coaches)].id}/") for i in range(count)
+        ])
+
+        results["leaderboard_top"] = self.measure("leaderboard_top", [
+            lambda i=i: client.get(f"/api/leaderboards/distance/?coach={coaches[i % len(coaches)].id}&limit=20") for i in range(count)
+        ])
+        results["leaderboard_around"] = self.measure("leaderboard_around", [
+            lambda i=i: client.get(f"/api/leaderboards/distance/around/?athlete={athletes[i % len(athletes)].id}") for i in range(count)
+        ])
+
+        results["athlete_history"] = self.measure("athlete_history", [
+            lambda i=i: client.get(f"/api/athletes/{athletes[i % len(athletes)].id}/history/?bucket=week") for i in range(count)
+        ])
+
+        results["challenge_summary"] = self.measure("challenge_summary", [
+            lambda: client.get("/api/challenges_summary/")
+        ] * count, prepare=cache.clear)
+        results["challenge_summary_cached"] = self.measure("challenge_summary_cached", [
+            lambda: client.get("/api/challenges_summary/")
+        ] * count)
+
+        return results
+
+    def get_commit(self):
+        try:
+            return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+        except (OSError, subprocess.CalledProcessError):
+            return None
+
+    def handle(self, *args, **options):
+        if connection.vendor != "sqlite":
+            self.stderr.write(f"Внимание: замеры рассчитаны на SQLite, текущая база - {connection.vendor}")
+
+        old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True, keepdb=options["keepdb"])
+        try:
+            seed_options = {
+                name: options[name] for name in ["athletes", "coaches", "runs_per_athlete", "points_per_run", "collectibles"]
+            }
+            if not User.objects.filter(username__startswith="seed_").exists():
+                call_command("seed_data", stdout=self.stdout, **seed_options)
+
+            cache.clear()
+            # Запросы замера идут к тестовой базе, их метрики не должны попасть в METRICS_DIR воркеров
+            with override_settings(DEBUG=False, METRICS_ENABLED=False):
+                results = self.run_scenarios(options)
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0, keepdb=options["keepdb"])
+
+        report = {
+            "commit": self.get_commit(),
+            "created_at": timezone.now().isoformat(),
+            "database": connection.vendor,
+            "options": {**seed_options, "requests": options["requests"]},
+            "results": results,
+        }
+        with open(options["output"], "w") as file:
+            json.dump(report, file, indent=2, ensure_ascii=False)
+
+        self.stdout.write(self.style.SUCCESS(f"Результаты записаны в {options['output']}"))
@@ -0,0 +1,53 @@
+import multiprocessing
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import django
+from django.core.management.base import BaseCommand
+from django.db import connections
+
+from app_run.utils import claim_upload_job, process_upload_job, touch_upload_jobs, fail_stale_upload_jobs
+
+
+class Command(BaseCommand):
+    help = "Обрабатывает загрузки коллекционных предметов из очереди в базе данных"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--processes", type=int, default=2)
+        parser.add_argument("--chunk-size", type=int, default=1000)
+        parser.add_argument("--poll-interval", type=float, default=2.0)
+        parser.add_argument("--once", action="store_true", help="Завершиться, когда очередь опустеет")
+        parser.add_argument("--stale-timeout", type=float, default=300,
+                            help="Через сколько секунд без сигнала воркера его загрузка считается прерванной")
+
+    def handle(self, *args, **options):
+        context = multiprocessing.get_context("spawn")
+        with ProcessPoolExecutor(max_workers=options["processes"], mp_context=context, initializer=django.setup) as pool:
+            running = {}
+            while True:
+                for future, job_id in list(running.items()):
+                    if future.done():
+                        del running[future]
+                        if future.exception():
+                            self.stderr.write(f"Загрузка {job_id}: {future.exception()}")
+                        else:
+                            self.stdout.write(f"Загрузка {job_id} обработана")
+
+                # Сначала сигнал по своим загрузкам, затем сброс загрузок, чьи воркеры перестали отвечать
+                touch_upload_jobs(list(running.values()))
+                stale = fail_stale_upload_jobs(options["stale_timeout"])
+                if stale:
+                    self.stdout.write(self.style.WARNING(f"Прерванных загрузок: {stale}"))
+
+                while len(running) < options["processes"]:
+                    job_id = claim_upload_job()
+                    if job_id is None:
+                        break
+
+                    running[pool.submit(process_upload_job, job_id, options["chunk_size"])] = job_id
+
+                if options["once"] and not running:
+                    break
+
+                connections.close_all()
+                time.sleep(options["poll_interval"])
@@ -0,0 +1,191 @@
+import random
+from datetime import timedelta
+
+import numpy as np
+from django.conf import settings
+from django.contrib.auth.hashers import make_password
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.utils import timezone
+
+from app_run.geo import METERS_PER_LATITUDE_DEGREE, METERS_PER_LONGITUDE_DEGREE, segment_distances
+from app_run.models import Run, Position, CollectibleItem, Subscribe, Rating, ChallengeRule
+from app_run.utils import rebuild_athlete_stats, rebuild_rollups, backfill_challenges, save_collectible_items, bump_table_version
+
+# Район генерации треков и предметов (Москва)
+LATITUDE_RANGE = (55.60, 55.90)
+LONGITUDE_RANGE = (37.40, 37.80)
+
+
+class Command(BaseCommand):
+    help = "Заполняет базу синтетическими данными: атлеты, тренеры, подписки, забеги с треками 1 Гц, предметы и оценки"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--athletes", type=int, default=100)
+        parser.add_argument("--coaches", type=int, default=10)
+        parser.add_argument("--runs-per-athlete", type=int, default=5)
+        parser.add_argument("--points-per-run", type=int, default=600)
+        parser.add_argument("--collectibles", type=int, default=1000)
+        parser.add_argument("--subscribed-share", type=float, default=0.8)
+        parser.add_argument("--rated-share", type=float, default=0.5)
+        parser.add_argument("--prefix", default="seed")
+        parser.add_argument("--seed", type=int, default=0)
+        parser.add_argument("--batch-size", type=int, default=5000)
+
+    def make_track(self, rng, started_at, points):
+        # Случайное блуждание со скоростью бега 2-4 м/с и плавно меняющимся направлением
+        speeds = rng.uniform(2, 4, points)
+        headings = rng.uniform(0, 2 * np.pi) + np.cumsum(rng.normal(0, 0.15, points))
+        latitude = rng.uniform(*LATITUDE_RANGE)
+        longitude = rng.uniform(*LONGITUDE_RANGE)
+
+        latitudes = latitude + np.cumsum(speeds * np.cos(headings)) / METERS_PER_LATITUDE_DEGREE
+        longitudes = longitude + np.cumsum(speeds * np.sin(headings)) / (
+            METERS_PER_LONGITUDE_DEGREE * np.cos(np.radians(latitude))
+        )
+        latitudes = np.round(latitudes, 4)
+        longitudes = np.round(longitudes, 4)
+
+        # Скорость и дистанция считаются так же, как в add_positions
+        dist_diffs = segment_distances(latitudes, longitudes, settings.TRACK_DISTANCE_MODEL)
+        speeds = [0.0] + [round(dist_diff, 2) for dist_diff in dist_diffs.tolist()]
+        point_distances = [0.0]
+        for dist_diff in dist_diffs.tolist():
+            point_distances.append(round(point_distances[-1] + dist_diff / 1000, 2))
+
+        date_times = [started_at + timedelta(seconds=i) for i in range(points)]
+
+        return {
+            "latitudes": [f"{value:.4f}" for value in latitudes],
+            "longitudes": [f"{value:.4f}" for value in longitudes],
+            "date_times": date_times,
+            "speeds": speeds,
+            "distances": point_distances,
+            "total_distance": float(dist_diffs.sum()) / 1000,
+        }
+
+    def make_run(self, athlete, run_index, started_at, track):
+        values = {"created_at": started_at - timedelta(minutes=1), "status": "finished"}
+        points = len(track["date_times"])
+        if points:
+            values.update(
+                positions_count=points,
+                positions_distance=track["total_distance"],
+                speed_sum=sum(track["speeds"]),
+                first_position_at=track["date_times"][0],
+                last_position_at=track["date_times"][-1],
+                last_latitude=track["latitudes"][-1],
+                last_longitude=track["longitudes"][-1],
+                last_position_distance=track["distances"][-1]
+            )
+        if points > 1:
+            values.update(
+                distance=round(track["total_distance"], 2),
+                run_time_seconds=(track["date_times"][-1] - track["date_times"][0]).total_seconds(),
+                speed=round(sum(track["speeds"]) / points, 2)
+            )
+
+        return Run(athlete=athlete, comment=f"Забег {run_index + 1}", **values)
+
+    def create_runs(self, pending, batch_size):
+        if not pending:
+            return 0
+
+        runs = [run for run, _ in pending]
+        created_at = [run.created_at for run in runs]
+        Run.objects.bulk_create(runs, batch_size=batch_size)
+        for run, value in zip(runs, created_at):
+            run.created_at = value
+        Run.objects.bulk_update(runs, ["created_at"], batch_size=batch_size)
+
+        Position.objects.bulk_create([
+            Position(run=run, latitude=latitude, longitude=longitude, date_time=date_time, speed=speed, distance=distance)
+            for run, track in pending
+            for latitude, longitude, date_time, speed, distance in zip(
+                track["latitudes"], track["longitudes"], track["date_times"], track["speeds"], track["distances"]
+            )
+        ], batch_size=batch_size)
+
+        return len(runs)
+
+    def handle(self, *args, **options):
+        prefix = options["prefix"]
+        batch_size = options["batch_size"]
+        if User.objects.filter(username__startswith=f"{prefix}_").exists():
+            raise CommandError(f"Пользователи с префиксом {prefix}_ уже есть, укажите другой --prefix")
+
+        rng = np.random.default_rng(options["seed"])
+        choice = random.Random(options["seed"])
+        now = timezone.now()
+        password = make_password(None)
+
+        with transaction.atomic():
+            coaches = User.objects.bulk_create([
+                User(username=f"{prefix}_coach_{i}", first_name="Тренер", last_name=f"Номер {i}", is_staff=True, password=password)
+                for i in range(options["coaches"])
+            ], batch_size=batch_size)
+            athletes = User.objects.bulk_create([
+                User(username=f"{prefix}_athlete_{i}", first_name=f"Атлет{i}", last_name=f"Фамилия{i % 97}", password=password)
+                for i in range(options["athletes"])
+            ], batch_size=batch_size)
+
+            subscriptions = []
+            if coaches:
+                subscriptions = [
+                    Subscribe(subscriber=athlete, subscribed_to=choice.choice(coaches))
+                    for athlete in athletes if choice.random() < options["subscribed_share"]
+                ]
+            Subscribe.objects.bulk_create(subscriptions, batch_size=batch_size)
+            Rating.objects.bulk_create([
+                Rating(rater_id=subscription.subscriber_id, rated_id=subscription.subscribed_to_id, rating=choice.randint(1, 5))
+                for subscription in subscriptions if choice.random() < options["rated_share"]
+            ], batch_size=batch_size)
+
+            # Забеги создаются пачками: bulk_create забегов с уже посчитанными итогами, bulk_update created_at
+            # (auto_now_add перезаписывает его при создании) и bulk_create позиций - три запроса на пачку
+            runs_count = 0
+            positions_count = 0
+            pending = []
+            pending_points = 0
+            for athlete in athletes:
+                for run_index in range(options["runs_per_athlete"]):
+                    started_at = now - timedelta(days=choice.randint(1, 365), seconds=choice.randint(0, 86400))
+                    track = self.make_track(rng, started_at, options["points_per_run"])
+                    pending.append((self.make_run(athlete, run_index, started_at, track), track))
+                    pending_points += len(track["date_times"])
+
+                    if pending_points >= batch_size:
+                        runs_count += self.create_runs(pending, batch_size)
+                        positions_count += pending_points
+                        pending, pending_points = [], 0
+            runs_count += self.create_runs(pending, batch_size)
+            positions_count += pending_points
+
+            items = [
+                CollectibleItem(
+                    name=f"Предмет {i}", uid=f"{prefix}_{i}", latitude=round(rng.uniform(*LATITUDE_RANGE), 6),
+                    longitude=round(rng.uniform(*LONGITUDE_RANGE), 6), picture=f"https://example.com/items/{i}.png",
+                    value=int(rng.integers(1, 100))
+                )
+                for i in range(options["collectibles"])
+            ]
+            for start in range(0, len(items), batch_size):
+                save_collectible_items(items[start:start + batch_size])
+
+            collected = [
+                CollectibleItem.users.through(collectibleitem_id=item.id, user_id=athlete.id)
+                for item in items for athlete in choice.sample(athletes, min(len(athletes), choice.randint(0, 3)))
+            ]
+            CollectibleItem.users.through.objects.bulk_create(collected, batch_size=batch_size, ignore_conflicts=True)
+
+            rebuild_athlete_stats(batch_size=batch_size)
+            rebuild_rollups(chunk_size=batch_size, workers=1)
+            backfill_challenges(list(ChallengeRule.objects.all()), batch_size=batch_size)
+            for coach in coaches:
+                bump_table_version(f"coach_analytics:{coach.id}")
+
+        self.stdout.write(self.style.SUCCESS(
+            f"Создано: тренеров {len(coaches)}, атлетов {len(athletes)}, подписок {len(subscriptions)}, забегов {runs_count}, "
+            f"позиций {positions_count}, предметов {len(items)}"
+        ))
@@ -0,0 +1,258 @@
+import atexit
+import json
+import os
+import threading
+import time
+from pathlib import Path
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction, sync_to_async
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.core.signals import setting_changed
+from django.db import connection
+from django.dispatch import receiver
+
+# Метрики запросов по маршруту и методу. Каждый процесс копит их в памяти, а фоновый поток
+# раз в METRICS_FLUSH_INTERVAL секунд переписывает его файл в METRICS_DIR, даже без новых запросов.
+# Эндпоинт метрик складывает файлы всех процессов, поэтому счётчики суммируются по всем воркерам на хосте.
+# Процесс удаляет свой файл при выходе. Файлы процессов, которые завершились без этого (по pid или
+# по файлу, не обновлявшемуся STALE_FLUSH_INTERVALS интервалов), удаляются при сборе, их счётчики
+# выпадают из суммы - для Prometheus это обычный сброс счётчика после перезапуска воркера.
+# При METRICS_ENABLED = False middleware отключается, реестр не создаётся, поток и файл не появляются.
+DURATION_BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10]
+SIZE_BUCKETS = [100, 1_000, 10_000, 100_000, 1_000_000, 10_000_000]
+QUERY_BUCKETS = [0, 1, 2, 5, 10, 20, 50, 100]
+STALE_FLUSH_INTERVALS = 10
+
+HISTOGRAMS = {
+    "duration": ("http_request_duration_seconds", "Время обработки запроса в секундах", DURATION_BUCKETS),
+    "size": ("http_response_size_bytes", "Размер ответа в байтах", SIZE_BUCKETS),
+    "queries": ("http_request_db_queries", "Количество запросов к базе данных на один запрос", QUERY_BUCKETS),
+}
+COUNTERS = {
+    "db_time": ("http_request_db_duration_seconds_total", "Суммарное время запросов к базе данных в секундах"),
+}
+
+
+def _empty_series():
+    series = {name: {"buckets": [0] * len(buckets), "sum": 0, "count": 0} for name, (_, _, buckets) in HISTOGRAMS.items()}
+    series.update({name: 0 for name in COUNTERS})
+
+    return series
+
+
+class MetricsRegistry:
+    def __init__(self, directory, flush_interval):
+        self.directory = Path(directory)
+        self.flush_interval = flush_interval
+        # В имени файла есть время запуска, чтобы новый процесс с тем же pid не затёр счётчики старого
+        self.path = self.directory / f"metrics_{os.getpid()}_{time.time_ns()}.json"
+        self.series = {}
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.flusher = threading.Thread(target=self._run_flusher, name="metrics-flusher", daemon=True)
+        self.flusher.start()
+        atexit.register(self.close)
+
+    def _run_flusher(self):
+        while not self.stopped.wait(self.flush_interval):
+            self.flush()
+
+    def close(self):
+        self.stopped.set()
+        with self.lock:
+            self.path.unlink(missing_ok=True)
+
+    def observe(self, route, method, duration, size, queries, db_time):
+        with self.lock:
+            series = self.series.get((route, method))
+            if series is None:
+                series = self.series[(route, method)] = _empty_series()
+
+            for name, value in [("duration", duration), ("size", size), ("queries", queries)]:
+                if value is None:
+                    continue
+
+                histogram = series[name]
+                for index, bound in enumerate(HISTOGRAMS[name][2]):
+                    if value <= bound:
+                        histogram["buckets"][index] += 1
+                histogram["sum"] += value
+                histogram["count"] += 1
+
+            series["db_time"] += db_time
+
+    def flush(self):
+        with self.lock:
+            self._flush()
+
+    def _flush(self):
+        if self.stopped.is_set():
+            return
+
+        self.directory.mkdir(parents=True, exist_ok=True)
+        temporary_path = self.path.with_suffix(".tmp")
+        temporary_path.write_text(json.dumps([[route, method, series] for (route, method), series in self.series.items()]))
+        os.replace(temporary_path, self.path)
+
+    def collect(self):
+        self.flush()
+
+        merged = {}
+        for path in self.directory.glob("metrics_*.json"):
+            if path != self.path and self.is_stale(path):
+                path.unlink(missing_ok=True)
+                continue
+
+            try:
+                rows = json.loads(path.read_text())
+            except (OSError, ValueError):
+                continue
+
+            for route, method, series in rows:
+                total = merged.get((route, method))
+                if total is None:
+                    total = merged[(route, method)] = _empty_series()
+
+                for name in HISTOGRAMS:
+                    total[name]["buckets"] = [a + b for a, b in zip(total[name]["buckets"], series[name]["buckets"])]
+                    total[name]["sum"] += series[name]["sum"]
+                    total[name]["count"] += series[name]["count"]
+                for name in COUNTERS:
+                    total[name] += series[name]
+
+        return merged
+
+    def is_stale(self, path):
+        try:
+            updated_at = path.stat().st_mtime
+        except OSError:
+            return False
+        if time.time() - updated_at > STALE_FLUSH_INTERVALS * self.flush_interval:
+            return True
+
+        pid = path.stem.split("_")[1]
+        if os.name != "posix" or not pid.isdigit():
+            return False
+        try:
+            os.kill(int(pid), 0)
+        except ProcessLookupError:
+            return True
+        except OSError:
+            pass
+
+        return False
+
+
+def _escape(value):
+    return value.replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+def render_metrics(merged):
+    lines = []
+    keys = sorted(merged)
+    for name, (metric, help_text, buckets) in HISTOGRAMS.items():
+        lines += [f"# HELP {metric} {help_text}", f"# TYPE {metric} histogram"]
+        for route, method in keys:
+            labels = f'route="{_escape(route)}",method="{_escape(method)}"'
+            histogram = merged[(route, method)][name]
+            for bound, value in zip(buckets, histogram["buckets"]):
+                lines.append(f'{metric}_bucket{{{labels},le="{float(bound)}"}} {value}')
+            lines.append(f'{metric}_bucket{{{labels},le="+Inf"}} {histogram["count"]}')
+            lines.append(f"{metric}_sum{{{labels}}} {float(histogram['sum'])}")
+            lines.append(f"{metric}_count{{{labels}}} {histogram['count']}")
+
+    for name, (metric, help_text) in COUNTERS.items():
+        lines += [f"# HELP {metric} {help_text}", f"# TYPE {metric} counter"]
+        for route, method in keys:
+            labels = f'route="{_escape(route)}",method="{_escape(method)}"'
+            lines.append(f"{metric}{{{labels}}} {float(merged[(route, method)][name])}")
+
+    return "\n".join(lines) + "\n"
+
+
+_registry = None
+
+
+def get_registry():
+    global _registry
+    if _registry is None:
+        _registry = MetricsRegistry(settings.METRICS_DIR, settings.METRICS_FLUSH_INTERVAL)
+
+    return _registry
+
+
+@receiver(setting_changed)
+def reset_registry(setting, **kwargs):
+    global _registry
+    if setting.startswith("METRICS_") and _registry is not None:
+        _registry.close()
+        _registry = None
+
+
+class QueryTimer:
+    def __init__(self):
+        self.count = 0
+        self.duration = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        started = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.count += 1
+            self.duration += time.perf_counter() - started
+
+
+def _install_query_timer(timer):
+    connection.execute_wrappers.append(timer)
+
+
+def _remove_query_timer(timer):
+    connection.execute_wrappers.remove(timer)
+
+
+class MetricsMiddleware:
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        if not settings.METRICS_ENABLED:
+            raise MiddlewareNotUsed
+
+        self.get_response = get_response
+        self.async_mode = iscoroutinefunction(get_response)
+        if self.async_mode:
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if self.async_mode:
+            return self.__acall__(request)
+
+        timer = QueryTimer()
+        started = time.perf_counter()
+        with connection.execute_wrapper(timer):
+            response = self.get_response(request)
+        self.observe(request, response, time.perf_counter() - started, timer)
+
+        return response
+
+    async def __acall__(self, request):
+        # Асинхронный ORM и sync_to_async выполняют запросы в синхронном потоке запроса, у которого своё
+        # подключение, поэтому счётчик ставится и снимается в этом потоке, а не в потоке цикла событий
+        timer = QueryTimer()
+        started = time.perf_counter()
+        await sync_to_async(_install_query_timer)(timer)
+        try:
+            response = await self.get_response(request)
+        finally:
+            await sync_to_async(_remove_query_timer)(timer)
+        self.observe(request, response, time.perf_counter() - started, timer)
+
+        return response
+
+    def observe(self, request, response, duration, timer):
+        match = request.resolver_match
+        route = match.route if match else "unmatched"
+        size = None if response.streaming else len(response.content)
+        get_registry().observe(route, request.method, duration, size, timer.count, timer.duration)
@@ -0,0 +1,39 @@
+from django.db import migrations, models
+
+from app_run.geo import get_grid_cell
+
+
+def fill_grid_cells(apps, schema_editor):
+    CollectibleItem = apps.get_model("app_run", "CollectibleItem")
+    items = list(CollectibleItem.objects.all())
+    for item in items:
+        item.grid_latitude, item.grid_longitude = get_grid_cell(item.latitude, item.longitude)
+
+    CollectibleItem.objects.bulk_update(items, ["grid_latitude", "grid_longitude"], batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app_run', '0029_rating'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='collectibleitem',
+            name='grid_latitude',
+            field=models.IntegerField(default=0, editable=False, verbose_name='Ячейка сетки по широте'),
+            preserve_default=False,
+        ),
+        migrations.AddField(
+            model_name='collectibleitem',
+            name='grid_longitude',
+            field=models.IntegerField(default=0, editable=False, verbose_name='Ячейка сетки по долготе'),
+            preserve_default=False,
+        ),
+        migrations.RunPython(fill_grid_cells, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='collectibleitem',
+            index=models.Index(fields=['grid_latitude', 'grid_longitude'], name='collectible_grid_idx'),
+        ),
+    ]
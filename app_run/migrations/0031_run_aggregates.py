@@ -0,0 +1,77 @@
+from django.db import migrations, models
+
+from app_run.geo import track_distance
+
+
+def fill_run_aggregates(apps, schema_editor):
+    Run = apps.get_model("app_run", "Run")
+    Position = apps.get_model("app_run", "Position")
+
+    runs = Run.objects.filter(positions__isnull=False).distinct()
+    for run in runs.iterator():
+        positions = list(Position.objects.filter(run=run).order_by("date_time", "id").values_list(
+            "latitude", "longitude", "date_time", "speed", "distance"
+        ))
+        dated = [position[2] for position in positions if position[2] is not None]
+        last_position = positions[-1]
+
+        run.positions_count = len(positions)
+        run.positions_distance = track_distance([position[:2] for position in positions])
+        run.speed_sum = sum(position[3] or 0 for position in positions)
+        run.first_position_at = min(dated) if dated else None
+        run.last_position_at = max(dated) if dated else None
+        run.last_latitude = last_position[0]
+        run.last_longitude = last_position[1]
+        run.last_position_distance = last_position[4] or 0
+        run.save()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app_run', '0030_collectibleitem_grid'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='run',
+            name='first_position_at',
+            field=models.DateTimeField(blank=True, null=True, verbose_name='Время первой позиции'),
+        ),
+        migrations.AddField(
+            model_name='run',
+            name='last_latitude',
+            field=models.DecimalField(blank=True, decimal_places=4, max_digits=6, null=True, verbose_name='Широта последней позиции'),
+        ),
+        migrations.AddField(
+            model_name='run',
+            name='last_longitude',
+            field=models.DecimalField(blank=True, decimal_places=4, max_digits=7, null=True, verbose_name='Долгота последней позиции'),
+        ),
+        migrations.AddField(
+            model_name='run',
+            name='last_position_at',
+            field=models.DateTimeField(blank=True, null=True, verbose_name='Время последней позиции'),
+        ),
+        migrations.AddField(
+            model_name='run',
+            name='last_position_distance',
+            field=models.FloatField(default=0, verbose_name='Дистанция последней позиции'),
+        ),
+        migrations.AddField(
+            model_name='run',
+            name='positions_count',
+            field=models.PositiveIntegerField(default=0, verbose_name='Количество позиций'),
+        ),
+        migrations.AddField(
+            model_name='run',
+            name='positions_distance',
+            field=models.FloatField(default=0, verbose_name='Дистанция по позициям'),
+        ),
+        migrations.AddField(
+            model_name='run',
+            name='speed_sum',
+            field=models.FloatField(default=0, verbose_name='Сумма скоростей позиций'),
+        ),
+        migrations.RunPython(fill_run_aggregates, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,64 @@
+# Generated by Django 5.2 on 2026-10-18 17:46
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import Count, Sum, Max, Q
+from django.db.models.functions import Coalesce
+
+
+def fill_athlete_stats(apps, schema_editor):
+    User = apps.get_model(*settings.AUTH_USER_MODEL.split("."))
+    AthleteStats = apps.get_model("app_run", "AthleteStats")
+
+    users = User.objects.annotate(
+        runs_finished=Count("runs", filter=Q(runs__status="finished"), distinct=True),
+        total_distance=Sum("runs__distance", filter=Q(runs__status="finished")),
+        last_activity=Max(Coalesce("runs__last_position_at", "runs__created_at"), filter=Q(runs__status="finished")),
+    )
+    ratings = {
+        rating["rated_id"]: rating
+        for rating in apps.get_model("app_run", "Rating").objects.values("rated_id").annotate(
+            rating_sum=Sum("rating"), rating_count=Count("id")
+        )
+    }
+
+    AthleteStats.objects.bulk_create([
+        AthleteStats(
+            athlete_id=user.id,
+            runs_finished=user.runs_finished,
+            total_distance=user.total_distance or 0,
+            rating_sum=ratings.get(user.id, {}).get("rating_sum", 0),
+            rating_count=ratings.get(user.id, {}).get("rating_count", 0),
+            last_activity=user.last_activity
+        )
+        for user in users.iterator()
+    ], batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app_run', '0031_run_aggregates'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='AthleteStats',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('runs_finished', models.PositiveIntegerField(default=0, verbose_name='Законченные забеги')),
+                ('total_distance', models.FloatField(default=0, verbose_name='Общая дистанция')),
+                ('rating_sum', models.PositiveIntegerField(default=0, verbose_name='Сумма оценок')),
+                ('rating_count', models.PositiveIntegerField(default=0, verbose_name='Количество оценок')),
+                ('last_activity', models.DateTimeField(blank=True, null=True, verbose_name='Последняя активность')),
+                ('athlete', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='stats', to=settings.AUTH_USER_MODEL, verbose_name='Атлет')),
+            ],
+            options={
+                'verbose_name': 'Статистика атлета',
+                'verbose_name_plural': 'Статистика атлетов',
+            },
+        ),
+        migrations.RunPython(fill_athlete_stats, migrations.RunPython.noop),
+    ]
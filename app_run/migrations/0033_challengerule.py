@@ -0,0 +1,37 @@
+# Generated by Django 5.2 on 2026-10-18 17:47
+
+from django.db import migrations, models
+
+
+def create_rules(apps, schema_editor):
+    ChallengeRule = apps.get_model("app_run", "ChallengeRule")
+    ChallengeRule.objects.bulk_create([
+        ChallengeRule(full_name="Сделай 10 Забегов!", metric="runs_finished", threshold=10),
+        ChallengeRule(full_name="Пробеги 50 километров!", metric="total_distance", threshold=50),
+        ChallengeRule(full_name="2 километра за 10 минут!", metric="total_distance", threshold=2, window=600),
+    ], ignore_conflicts=True)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app_run', '0032_athletestats'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ChallengeRule',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('full_name', models.CharField(max_length=255, unique=True, verbose_name='Название челленджа')),
+                ('metric', models.CharField(choices=[('runs_finished', 'Количество законченных забегов'), ('total_distance', 'Общая дистанция')], max_length=20, verbose_name='Показатель')),
+                ('threshold', models.FloatField(verbose_name='Порог')),
+                ('window', models.PositiveIntegerField(blank=True, null=True, verbose_name='Максимальное время забега в секундах')),
+            ],
+            options={
+                'verbose_name': 'Правило челленджа',
+                'verbose_name_plural': 'Правила челленджей',
+            },
+        ),
+        migrations.RunPython(create_rules, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,33 @@
+# Generated by Django 5.2 on 2026-10-18 17:52
+
+import django.core.serializers.json
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app_run', '0033_challengerule'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='UploadJob',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('file', models.FileField(upload_to='uploads/', verbose_name='Файл')),
+                ('status', models.CharField(choices=[('pending', 'Ожидает обработки'), ('processing', 'Обрабатывается'), ('finished', 'Обработана'), ('failed', 'Ошибка обработки')], default='pending', max_length=10, verbose_name='Статус')),
+                ('rows_processed', models.PositiveIntegerField(default=0, verbose_name='Обработано строк')),
+                ('rows_rejected', models.PositiveIntegerField(default=0, verbose_name='Отклонено строк')),
+                ('errors', models.JSONField(blank=True, default=list, encoder=django.core.serializers.json.DjangoJSONEncoder, verbose_name='Ошибки в строках')),
+                ('message', models.TextField(blank=True, verbose_name='Сообщение об ошибке')),
+                ('created_at', models.DateTimeField(auto_now_add=True, verbose_name='Дата создания')),
+                ('started_at', models.DateTimeField(blank=True, null=True, verbose_name='Начало обработки')),
+                ('finished_at', models.DateTimeField(blank=True, null=True, verbose_name='Конец обработки')),
+            ],
+            options={
+                'verbose_name': 'Загрузка предметов',
+                'verbose_name_plural': 'Загрузки предметов',
+            },
+        ),
+    ]
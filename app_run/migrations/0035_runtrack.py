@@ -0,0 +1,27 @@
+# Generated by Django 5.2 on 2026-10-18 17:54
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app_run', '0034_uploadjob'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RunTrack',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('points_count', models.PositiveIntegerField(verbose_name='Количество точек')),
+                ('data', models.BinaryField(verbose_name='Упакованный трек')),
+                ('run', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='track', to='app_run.run', verbose_name='Забег')),
+            ],
+            options={
+                'verbose_name': 'Трек забега',
+                'verbose_name_plural': 'Треки забегов',
+            },
+        ),
+    ]
@@ -0,0 +1,31 @@
+# Generated by Django 5.2 on 2026-10-18 17:57
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app_run', '0035_runtrack'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='position',
+            index=models.Index(fields=['run', 'date_time', 'id'], name='position_run_time_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='position',
+            index=models.Index(fields=['date_time', 'id'], name='position_time_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='run',
+            index=models.Index(fields=['created_at', 'id'], name='run_created_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='run',
+            index=models.Index(fields=['athlete', 'created_at', 'id'], name='run_athlete_created_idx'),
+        ),
+    ]
@@ -0,0 +1,105 @@
+# Generated by Django 5.2 on 2026-10-18 18:10
+
+import re
+
+from django.db import migrations
+from django.utils import timezone
+
+from app_run.partitions import POSITION_TABLE, DEFAULT_PARTITION, is_partitioning_supported, add_months, \
+    ensure_partitions, month_start
+
+OLD_TABLE = f"{POSITION_TABLE}_unpartitioned"
+PARTITIONED_TABLE = f"{POSITION_TABLE}_partitioned"
+MONTHS_AHEAD = 3
+
+
+def get_indexes(cursor, table):
+    cursor.execute(
+        "SELECT indexname, indexdef FROM pg_indexes WHERE tablename = %s AND indexname NOT IN ("
+        "SELECT conname FROM pg_constraint WHERE conrelid = %s::regclass AND contype IN ('p', 'u'))",
+        [table, table]
+    )
+
+    return cursor.fetchall()
+
+
+def get_foreign_keys(cursor, table):
+    cursor.execute(
+        "SELECT conname, pg_get_constraintdef(oid) FROM pg_constraint WHERE conrelid = %s::regclass AND contype = 'f'",
+        [table]
+    )
+
+    return cursor.fetchall()
+
+
+def recreate_indexes(cursor, indexes, foreign_keys, source, target):
+    # Индексы секционированной таблицы pg_indexes описывает как "ON ONLY": у обычной таблицы секций нет,
+    # а у секционированной индекс без ONLY сразу создаётся и во всех секциях
+    for name, definition in indexes:
+        cursor.execute(re.sub(rf" ON (ONLY )?(public\.)?{source} ", f" ON {target} ", definition))
+    for name, definition in foreign_keys:
+        cursor.execute(f'ALTER TABLE "{target}" ADD CONSTRAINT "{name}" {definition}')
+
+
+def partition_positions(apps, schema_editor):
+    # Таблица позиций заменяется секционированной по месяцам date_time. Первичный ключ в секционированной
+    # таблице обязан включать date_time, а она может быть пустой, поэтому id остаётся уникальным
+    # за счёт последовательности и индексируется обычным индексом.
+    if not is_partitioning_supported(schema_editor.connection):
+        return
+
+    with schema_editor.connection.cursor() as cursor:
+        cursor.execute(f'ALTER TABLE "{POSITION_TABLE}" RENAME TO "{OLD_TABLE}"')
+        indexes = get_indexes(cursor, OLD_TABLE)
+        foreign_keys = get_foreign_keys(cursor, OLD_TABLE)
+
+        cursor.execute(f'CREATE TABLE "{POSITION_TABLE}" (LIKE "{OLD_TABLE}" INCLUDING DEFAULTS) PARTITION BY RANGE (date_time)')
+        cursor.execute(f'CREATE TABLE "{DEFAULT_PARTITION}" PARTITION OF "{POSITION_TABLE}" DEFAULT')
+
+        cursor.execute(f'SELECT min(date_time), max(id) FROM "{OLD_TABLE}"')
+        first_date_time, max_id = cursor.fetchone()
+        last_month = add_months(month_start(timezone.now()), MONTHS_AHEAD)
+        ensure_partitions(cursor, first_date_time or timezone.now(), last_month)
+
+        cursor.execute(f'INSERT INTO "{POSITION_TABLE}" SELECT * FROM "{OLD_TABLE}"')
+        cursor.execute(f'DROP TABLE "{OLD_TABLE}"')
+
+        recreate_indexes(cursor, indexes, foreign_keys, OLD_TABLE, POSITION_TABLE)
+        cursor.execute(f'CREATE INDEX "{POSITION_TABLE}_id_idx" ON "{POSITION_TABLE}" (id)')
+
+        cursor.execute(f'CREATE SEQUENCE "{POSITION_TABLE}_id_seq" OWNED BY "{POSITION_TABLE}".id')
+        cursor.execute(f"SELECT setval('\"{POSITION_TABLE}_id_seq\"', %s, %s)", [max_id or 1, max_id is not None])
+        cursor.execute(f'ALTER TABLE "{POSITION_TABLE}" ALTER COLUMN id SET DEFAULT nextval(\'"{POSITION_TABLE}_id_seq"\')')
+
+
+def unpartition_positions(apps, schema_editor):
+    if not is_partitioning_supported(schema_editor.connection):
+        return
+
+    with schema_editor.connection.cursor() as cursor:
+        cursor.execute(f'ALTER TABLE "{POSITION_TABLE}" RENAME TO "{PARTITIONED_TABLE}"')
+        indexes = [index for index in get_indexes(cursor, PARTITIONED_TABLE) if index[0] != f"{POSITION_TABLE}_id_idx"]
+        foreign_keys = get_foreign_keys(cursor, PARTITIONED_TABLE)
+
+        cursor.execute(f'CREATE TABLE "{POSITION_TABLE}" (LIKE "{PARTITIONED_TABLE}")')
+        cursor.execute(f'INSERT INTO "{POSITION_TABLE}" SELECT * FROM "{PARTITIONED_TABLE}"')
+        cursor.execute(f'SELECT max(id) FROM "{POSITION_TABLE}"')
+        max_id = cursor.fetchone()[0]
+        cursor.execute(f'DROP TABLE "{PARTITIONED_TABLE}" CASCADE')
+
+        cursor.execute(f'ALTER TABLE "{POSITION_TABLE}" ADD CONSTRAINT "{POSITION_TABLE}_pkey" PRIMARY KEY (id)')
+        cursor.execute(f'ALTER TABLE "{POSITION_TABLE}" ALTER COLUMN id ADD GENERATED BY DEFAULT AS IDENTITY')
+        cursor.execute(f"SELECT setval(pg_get_serial_sequence(%s, 'id'), %s, %s)", [POSITION_TABLE, max_id or 1, max_id is not None])
+        recreate_indexes(cursor, indexes, foreign_keys, PARTITIONED_TABLE, POSITION_TABLE)
+
+
+class Migration(migrations.Migration):
+    atomic = True
+
+    dependencies = [
+        ('app_run', '0036_pagination_indexes'),
+    ]
+
+    operations = [
+        migrations.RunPython(partition_positions, unpartition_positions),
+    ]
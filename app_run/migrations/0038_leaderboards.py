@@ -0,0 +1,86 @@
+# Generated by Django 5.2 on 2026-10-18 18:28
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import Max, OuterRef, Subquery, Sum
+from django.db.models.functions import Coalesce
+
+
+def fill_leaderboard_stats(apps, schema_editor):
+    AthleteStats = apps.get_model("app_run", "AthleteStats")
+    Subscribe = apps.get_model("app_run", "Subscribe")
+    Run = apps.get_model("app_run", "Run")
+    Collected = apps.get_model("app_run", "CollectibleItem").users.through
+
+    best_speeds = Run.objects.filter(athlete_id=OuterRef("athlete_id"), status="finished", speed__gt=0).values(
+        "athlete_id"
+    ).annotate(best_speed=Max("speed")).values("best_speed")
+    items_values = Collected.objects.filter(user_id=OuterRef("athlete_id")).values("user_id").annotate(
+        items_value=Sum("collectibleitem__value")
+    ).values("items_value")
+
+    AthleteStats.objects.update(
+        coach_id=Subquery(Subscribe.objects.filter(subscriber_id=OuterRef("athlete_id")).values("subscribed_to_id")[:1]),
+        best_speed=Subquery(best_speeds),
+        items_value=Coalesce(Subquery(items_values), 0)
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app_run', '0037_position_partitioning'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='athletestats',
+            name='best_speed',
+            field=models.FloatField(blank=True, null=True, verbose_name='Лучшая средняя скорость'),
+        ),
+        migrations.AddField(
+            model_name='athletestats',
+            name='coach',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='athletes_stats', to=settings.AUTH_USER_MODEL, verbose_name='Тренер'),
+        ),
+        migrations.AddField(
+            model_name='athletestats',
+            name='items_value',
+            field=models.IntegerField(default=0, verbose_name='Ценность собранных предметов'),
+        ),
+        migrations.RunPython(fill_leaderboard_stats, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='athletestats',
+            index=models.Index(fields=['-total_distance', 'athlete'], name='stats_distance_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='athletestats',
+            index=models.Index(fields=['coach', '-total_distance', 'athlete'], name='stats_coach_distance_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='athletestats',
+            index=models.Index(fields=['-runs_finished', 'athlete'], name='stats_runs_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='athletestats',
+            index=models.Index(fields=['coach', '-runs_finished', 'athlete'], name='stats_coach_runs_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='athletestats',
+            index=models.Index(fields=['-best_speed', 'athlete'], name='stats_speed_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='athletestats',
+            index=models.Index(fields=['coach', '-best_speed', 'athlete'], name='stats_coach_speed_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='athletestats',
+            index=models.Index(fields=['-items_value', 'athlete'], name='stats_items_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='athletestats',
+            index=models.Index(fields=['coach', '-items_value', 'athlete'], name='stats_coach_items_idx'),
+        ),
+    ]
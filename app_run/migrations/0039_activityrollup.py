@@ -0,0 +1,58 @@
+# Generated by Django 5.2 on 2026-10-18 18:31
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import Count, Sum, DateField
+from django.db.models.functions import TruncDay, TruncWeek, TruncMonth
+
+
+def fill_rollups(apps, schema_editor):
+    Run = apps.get_model("app_run", "Run")
+    ActivityRollup = apps.get_model("app_run", "ActivityRollup")
+
+    runs = Run.objects.filter(status="finished").order_by()
+    for bucket, trunc in [("day", TruncDay), ("week", TruncWeek), ("month", TruncMonth)]:
+        rows = runs.annotate(period_start=trunc("created_at", output_field=DateField())).values(
+            "athlete_id", "period_start"
+        ).annotate(runs_count=Count("id"), distance_sum=Sum("distance"), run_time_sum=Sum("run_time_seconds"))
+        ActivityRollup.objects.bulk_create([
+            ActivityRollup(
+                athlete_id=row["athlete_id"],
+                bucket=bucket,
+                period_start=row["period_start"],
+                runs=row["runs_count"],
+                distance=row["distance_sum"] or 0,
+                run_time_seconds=row["run_time_sum"] or 0
+            )
+            for row in rows.iterator()
+        ], batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app_run', '0038_leaderboards'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ActivityRollup',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('bucket', models.CharField(choices=[('day', 'День'), ('week', 'Неделя'), ('month', 'Месяц')], max_length=5, verbose_name='Период')),
+                ('period_start', models.DateField(verbose_name='Начало периода')),
+                ('runs', models.PositiveIntegerField(default=0, verbose_name='Законченные забеги')),
+                ('distance', models.FloatField(default=0, verbose_name='Дистанция')),
+                ('run_time_seconds', models.PositiveIntegerField(default=0, verbose_name='Время забегов в секундах')),
+                ('athlete', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='rollups', to=settings.AUTH_USER_MODEL, verbose_name='Атлет')),
+            ],
+            options={
+                'verbose_name': 'Итоги атлета за период',
+                'verbose_name_plural': 'Итоги атлетов за периоды',
+                'constraints': [models.UniqueConstraint(fields=('athlete', 'bucket', 'period_start'), name='unique_rollup_period')],
+            },
+        ),
+        migrations.RunPython(fill_rollups, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,38 @@
+from django.conf import settings
+from django.db import migrations
+from django.db.models import Count, Sum, Max, Q
+from django.db.models.functions import Coalesce
+
+
+def refresh_athlete_activity(apps, schema_editor):
+    # Поля статистики, зависящие от забегов, пересчитываются заново: до сигналов модели Run удаление
+    # и правка забегов их не меняли, а last_activity при финише бралась по времени остановки
+    User = apps.get_model(*settings.AUTH_USER_MODEL.split("."))
+    AthleteStats = apps.get_model("app_run", "AthleteStats")
+
+    activity = {
+        row[0]: row[1:]
+        for row in User.objects.annotate(
+            runs_finished=Count("runs", filter=Q(runs__status="finished")),
+            total_distance=Sum("runs__distance", filter=Q(runs__status="finished")),
+            last_activity=Max(Coalesce("runs__last_position_at", "runs__created_at"), filter=Q(runs__status="finished")),
+            best_speed=Max("runs__speed", filter=Q(runs__status="finished", runs__speed__gt=0)),
+        ).values_list("id", "runs_finished", "total_distance", "last_activity", "best_speed").iterator()
+    }
+
+    stats = list(AthleteStats.objects.all())
+    for row in stats:
+        row.runs_finished, total_distance, row.last_activity, row.best_speed = activity[row.athlete_id]
+        row.total_distance = total_distance or 0
+    AthleteStats.objects.bulk_update(stats, ["runs_finished", "total_distance", "last_activity", "best_speed"], batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app_run', '0041_uploadjob_heartbeat'),
+    ]
+
+    operations = [
+        migrations.RunPython(refresh_athlete_activity, migrations.RunPython.noop),
+    ]
@@ -1,6 +1,9 @@
 from django.contrib.auth.models import User
+from django.core.serializers.json import DjangoJSONEncoder
 from django.db import models
 
+from .geo import get_grid_cell
+
 
 class Run(models.Model):
     STATUS_CHOICES = [
@@ -16,15 +19,40 @@ class Run(models.Model):
     distance = models.FloatField(blank=True, null=True, verbose_name="Пройденная дистанция")
     run_time_seconds = models.IntegerField(blank=True, null=True, verbose_name="Время забега в секундах")
     speed = models.FloatField(blank=True, null=True, default=0, verbose_name="Средняя скорость")
+    positions_count = models.PositiveIntegerField(default=0, verbose_name="Количество позиций")
+    positions_distance = models.FloatField(default=0, verbose_name="Дистанция по позициям")
+    speed_sum = models.FloatField(default=0, verbose_name="Сумма скоростей позиций")
+    first_position_at = models.DateTimeField(blank=True, null=True, verbose_name="Время первой позиции")
+    last_position_at = models.DateTimeField(blank=True, null=True, verbose_name="Время последней позиции")
+    last_latitude = models.DecimalField(max_digits=6, decimal_places=4, blank=True, null=True, verbose_name="Широта последней позиции")
+    last_longitude = models.DecimalField(max_digits=7, decimal_places=4, blank=True, null=True, verbose_name="Долгота последней позиции")
+    last_position_distance = models.FloatField(default=0, verbose_name="Дистанция последней позиции")
 
     class Meta:
         ordering = ["-created_at"]
         verbose_name = "Забег"
         verbose_name_plural = "Забеги"
+        indexes = [
+            models.Index(fields=["created_at", "id"], name="run_created_idx"),
+            models.Index(fields=["athlete", "created_at", "id"], name="run_athlete_created_idx")
+        ]
 
     def __str__(self):
         return f"{self.athlete.username} - {self.created_at.strftime('%d.%m.%Y %H:%M')}"
 
+    def get_last_position(self):
+        # Без времени последней позиции (старые забеги) новые позиции считаются от начала
+        if not self.positions_count or self.last_position_at is None:
+            return None
+
+        return Position(
+            run=self,
+            latitude=self.last_latitude,
+            longitude=self.last_longitude,
+            date_time=self.last_position_at,
+            distance=self.last_position_distance
+        )
+
 
 class AthleteInfo(models.Model):
     athlete = models.OneToOneField(User, on_delete=models.CASCADE, related_name="athlete_info", verbose_name="Атлет")
@@ -39,6 +67,72 @@ class AthleteInfo(models.Model):
         return self.athlete.username
 
 
+class AthleteStats(models.Model):
+    athlete = models.OneToOneField(User, on_delete=models.CASCADE, related_name="stats", verbose_name="Атлет")
+    runs_finished = models.PositiveIntegerField(default=0, verbose_name="Законченные забеги")
+    total_distance = models.FloatField(default=0, verbose_name="Общая дистанция")
+    rating_sum = models.PositiveIntegerField(default=0, verbose_name="Сумма оценок")
+    rating_count = models.PositiveIntegerField(default=0, verbose_name="Количество оценок")
+    last_activity = models.DateTimeField(blank=True, null=True, verbose_name="Последняя активность")
+    coach = models.ForeignKey(User, on_delete=models.SET_NULL, blank=True, null=True, related_name="athletes_stats",
+                              verbose_name="Тренер")
+    best_speed = models.FloatField(blank=True, null=True, verbose_name="Лучшая средняя скорость")
+    items_value = models.IntegerField(default=0, verbose_name="Ценность собранных предметов")
+
+    class Meta:
+        verbose_name = "Статистика атлета"
+        verbose_name_plural = "Статистика атлетов"
+        # Индексы таблиц лидеров: общий и по тренеру для каждого показателя
+        indexes = [
+            models.Index(fields=["-total_distance", "athlete"], name="stats_distance_idx"),
+            models.Index(fields=["coach", "-total_distance", "athlete"], name="stats_coach_distance_idx"),
+            models.Index(fields=["-runs_finished", "athlete"], name="stats_runs_idx"),
+            models.Index(fields=["coach", "-runs_finished", "athlete"], name="stats_coach_runs_idx"),
+            models.Index(fields=["-best_speed", "athlete"], name="stats_speed_idx"),
+            models.Index(fields=["coach", "-best_speed", "athlete"], name="stats_coach_speed_idx"),
+            models.Index(fields=["-items_value", "athlete"], name="stats_items_idx"),
+            models.Index(fields=["coach", "-items_value", "athlete"], name="stats_coach_items_idx"),
+        ]
+
+    def __str__(self):
+        return self.athlete.username
+
+    @property
+    def rating(self):
+        if not self.rating_count:
+            return None
+
+        return self.rating_sum / self.rating_count
+
+
+class ActivityRollup(models.Model):
+    BUCKET_CHOICES = [
+        ("day", "День"),
+        ("week", "Неделя"),
+        ("month", "Месяц")
+    ]
+
+    athlete = models.ForeignKey(User, on_delete=models.CASCADE, related_name="rollups", verbose_name="Атлет")
+    bucket = models.CharField(max_length=5, choices=BUCKET_CHOICES, verbose_name="Период")
+    period_start = models.DateField(verbose_name="Начало периода")
+    runs = models.PositiveIntegerField(default=0, verbose_name="Законченные забеги")
+    distance = models.FloatField(default=0, verbose_name="Дистанция")
+    run_time_seconds = models.PositiveIntegerField(default=0, verbose_name="Время забегов в секундах")
+
+    class Meta:
+        verbose_name = "Итоги атлета за период"
+        verbose_name_plural = "Итоги атлетов за периоды"
+        constraints = [
+            models.UniqueConstraint(
+                fields=["athlete", "bucket", "period_start"],
+                name="unique_rollup_period"
+            )
+        ]
+
+    def __str__(self):
+        return f"{self.athlete.username} - {self.bucket} {self.period_start}"
+
+
 class Rating(models.Model):
     rater = models.ForeignKey(User, on_delete=models.CASCADE, related_name="ratings", verbose_name="Оценивающий")
     rated = models.ForeignKey(User, on_delete=models.CASCADE, related_name="rated_by", verbose_name="Оцениваемый")
@@ -70,6 +164,34 @@ class Challenge(models.Model):
         return self.full_name
 
 
+class ChallengeRule(models.Model):
+    METRIC_CHOICES = [
+        ("runs_finished", "Количество законченных забегов"),
+        ("total_distance", "Общая дистанция")
+    ]
+
+    full_name = models.CharField(max_length=255, unique=True, verbose_name="Название челленджа")
+    metric = models.CharField(max_length=20, choices=METRIC_CHOICES, verbose_name="Показатель")
+    threshold = models.FloatField(verbose_name="Порог")
+    window = models.PositiveIntegerField(blank=True, null=True, verbose_name="Максимальное время забега в секундах")
+
+    class Meta:
+        verbose_name = "Правило челленджа"
+        verbose_name_plural = "Правила челленджей"
+
+    def __str__(self):
+        return self.full_name
+
+    def is_achieved(self, stats, run):
+        if getattr(stats, self.metric) < self.threshold:
+            return False
+
+        if self.window is not None:
+            return run.run_time_seconds is not None and run.run_time_seconds <= self.window
+
+        return True
+
+
 class Position(models.Model):
     run = models.ForeignKey(Run, on_delete=models.CASCADE, related_name="positions", verbose_name="Забег")
     latitude = models.DecimalField(max_digits=6, decimal_places=4, verbose_name="Широта")
@@ -81,11 +203,28 @@ class Position(models.Model):
     class Meta:
         verbose_name = "Позиция"
         verbose_name_plural = "Позиции"
+        indexes = [
+            models.Index(fields=["run", "date_time", "id"], name="position_run_time_idx"),
+            models.Index(fields=["date_time", "id"], name="position_time_idx")
+        ]
 
     def __str__(self):
         return f"{self.run}: {self.latitude}, {self.longitude}"
 
 
+class RunTrack(models.Model):
+    run = models.OneToOneField(Run, on_delete=models.CASCADE, related_name="track", verbose_name="Забег")
+    points_count = models.PositiveIntegerField(verbose_name="Количество точек")
+    data = models.BinaryField(verbose_name="Упакованный трек")
+
+    class Meta:
+        verbose_name = "Трек забега"
+        verbose_name_plural = "Треки забегов"
+
+    def __str__(self):
+        return str(self.run)
+
+
 class CollectibleItem(models.Model):
     name = models.CharField(max_length=255, verbose_name="Название")
     uid = models.CharField(max_length=255, verbose_name="UID")
@@ -94,10 +233,46 @@ class CollectibleItem(models.Model):
     picture = models.URLField(verbose_name="Ссылка на картинку")
     value = models.IntegerField(verbose_name="Значение")
     users = models.ManyToManyField(User, blank=True, related_name="items", verbose_name="Атлеты")
+    grid_latitude = models.IntegerField(editable=False, verbose_name="Ячейка сетки по широте")
+    grid_longitude = models.IntegerField(editable=False, verbose_name="Ячейка сетки по долготе")
 
     class Meta:
         verbose_name = "Коллекционный предмет"
         verbose_name_plural = "Коллекционные предметы"
+        indexes = [
+            models.Index(fields=["grid_latitude", "grid_longitude"], name="collectible_grid_idx")
+        ]
+
+    def save(self, *args, **kwargs):
+        self.grid_latitude, self.grid_longitude = get_grid_cell(self.latitude, self.longitude)
+        super().save(*args, **kwargs)
+
+
+class UploadJob(models.Model):
+    STATUS_CHOICES = [
+        ("pending", "Ожидает обработки"),
+        ("processing", "Обрабатывается"),
+        ("finished", "Обработана"),
+        ("failed", "Ошибка обработки")
+    ]
+
+    file = models.FileField(upload_to="uploads/", verbose_name="Файл")
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default="pending", verbose_name="Статус")
+    rows_processed = models.PositiveIntegerField(default=0, verbose_name="Обработано строк")
+    rows_rejected = models.PositiveIntegerField(default=0, verbose_name="Отклонено строк")
+    errors = models.JSONField(default=list, blank=True, encoder=DjangoJSONEncoder, verbose_name="Ошибки в строках")
+    message = models.TextField(blank=True, verbose_name="Сообщение об ошибке")
+    created_at = models.DateTimeField(auto_now_add=True, verbose_name="Дата создания")
+    started_at = models.DateTimeField(blank=True, null=True, verbose_name="Начало обработки")
+    heartbeat_at = models.DateTimeField(blank=True, null=True, verbose_name="Последний сигнал воркера")
+    finished_at = models.DateTimeField(blank=True, null=True, verbose_name="Конец обработки")
+
+    class Meta:
+        verbose_name = "Загрузка предметов"
+        verbose_name_plural = "Загрузки предметов"
+
+    def __str__(self):
+        return f"{self.file.name} - {self.get_status_display()}"
 
 
 class Subscribe(models.Model):
@@ -110,3 +285,15 @@ class Subscribe(models.Model):
 
     def __str__(self):
         return f"{self.subscriber} подписан на {self.subscribed_to}"
+
+
+class TableVersion(models.Model):
+    name = models.CharField(max_length=255, unique=True, verbose_name="Таблица")
+    version = models.BigIntegerField(verbose_name="Версия")
+
+    class Meta:
+        verbose_name = "Версия таблицы"
+        verbose_name_plural = "Версии таблиц"
+
+    def __str__(self):
+        return f"{self.name}: {self.version}"
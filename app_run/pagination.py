@@ -0,0 +1,180 @@
+import json
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from datetime import date, time
+from decimal import Decimal
+
+from django.core.exceptions import ValidationError
+from django.db.models import F, Q
+from rest_framework import serializers
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import BasePagination, PageNumberPagination
+from rest_framework.response import Response
+from rest_framework.utils.urls import replace_query_param
+
+
+def is_cursor_request(request):
+    return request.query_params.get("pagination") == "cursor" or "cursor" in request.query_params
+
+
+class SizePagination(PageNumberPagination):
+    page_size_query_param = "size"
+
+
+class KeysetPagination(BasePagination):
+    # Курсорная пагинация по ключу из нескольких полей: страница выбирается условием на ключ
+    # последней строки, без COUNT(*) и OFFSET. Включается параметром ?pagination=cursor или ?cursor=...,
+    # иначе запрос обрабатывает page_number_class (None - без пагинации).
+    # Пустые значения ключа считаются наибольшими, как в индексах PostgreSQL.
+    ordering = ("id",)
+    page_number_class = SizePagination
+    cursor_query_param = "cursor"
+    page_size_query_param = "size"
+    page_size = 100
+    max_page_size = 1000
+    invalid_cursor_message = "Неверный курсор"
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.page_number_paginator = None
+        if not is_cursor_request(request):
+            if self.page_number_class is None:
+                return None
+
+            self.page_number_paginator = self.page_number_class()
+            return self.page_number_paginator.paginate_queryset(queryset, request, view)
+
+        self.request = request
+        self.base_url = request.build_absolute_uri()
+        self.page_size = self.get_page_size(request)
+        self.keys = self.get_keys(request, view, queryset.model)
+
+        position, reverse = self.decode_cursor(request)
+        if position is not None:
+            queryset = queryset.filter(self.get_keyset_filter(position, reverse))
+
+        results = list(queryset.order_by(*self.get_order_by(reverse))[:self.page_size + 1])
+        has_more = len(results) > self.page_size
+        results = results[:self.page_size]
+        if reverse:
+            results.reverse()
+            self.has_next, self.has_previous = position is not None, has_more
+        else:
+            self.has_next, self.has_previous = has_more, position is not None
+
+        self.first_position = self.get_position(results[0]) if results else position
+        self.last_position = self.get_position(results[-1]) if results else position
+
+        return results
+
+    def get_paginated_response(self, data):
+        if self.page_number_paginator is not None:
+            return self.page_number_paginator.get_paginated_response(data)
+
+        return Response({
+            "next": self.get_next_link(),
+            "previous": self.get_previous_link(),
+            "results": data
+        })
+
+    def get_page_size(self, request):
+        size = request.query_params.get(self.page_size_query_param, "")
+        if size.isdigit() and int(size) > 0:
+            return min(int(size), self.max_page_size)
+
+        return self.page_size
+
+    def get_keys(self, request, view, model):
+        # ?ordering должен совпадать с началом ключа, направление берётся из первого поля.
+        # Другую сортировку ключ не поддерживает, поэтому она отклоняется, а не игнорируется.
+        ordering = [(name.lstrip("-"), name.startswith("-")) for name in self.ordering]
+        requested = [name.strip() for name in request.query_params.get("ordering", "").split(",") if name.strip()]
+        if requested:
+            descending = requested[0].startswith("-")
+            names = [("-" if descending else "") + name for name, _ in ordering]
+            if requested != names[:len(requested)]:
+                allowed = " или ".join(",".join(("-" if flag else "") + name for name, _ in ordering) for flag in (False, True))
+                raise serializers.ValidationError({"ordering": [f"При курсорной пагинации доступна только сортировка {allowed}"]})
+            ordering = [(name, descending) for name, _ in ordering]
+
+        return [(name, descending, model._meta.get_field(name)) for name, descending in ordering]
+
+    def get_order_by(self, reverse):
+        order_by = []
+        for name, descending, _ in self.keys:
+            if descending != reverse:
+                order_by.append(F(name).desc(nulls_first=True))
+            else:
+                order_by.append(F(name).asc(nulls_last=True))
+
+        return order_by
+
+    def get_keyset_filter(self, position, reverse):
+        keyset_filter = Q(pk__in=[])
+        equal = Q()
+        for (name, descending, field), value in zip(self.keys, position):
+            if (descending != reverse) and value is not None:
+                after = Q(**{f"{name}__lt": value})
+            elif descending != reverse:
+                after = Q(**{f"{name}__isnull": False})
+            elif value is not None:
+                after = Q(**{f"{name}__gt": value})
+                if field.null:
+                    after |= Q(**{f"{name}__isnull": True})
+            else:
+                after = Q(pk__in=[])
+
+            keyset_filter |= equal & after
+            equal &= Q(**{f"{name}__isnull": True}) if value is None else Q(**{name: value})
+
+        return keyset_filter
+
+    def get_position(self, instance):
+        return [getattr(instance, field.attname) for _, _, field in self.keys]
+
+    def encode_cursor(self, position, reverse):
+        values = [
+            value.isoformat() if isinstance(value, (date, time)) else str(value) if isinstance(value, Decimal) else value
+            for value in position
+        ]
+        cursor = urlsafe_b64encode(json.dumps({"p": values, "r": reverse}).encode()).decode()
+
+        return replace_query_param(self.base_url, self.cursor_query_param, cursor)
+
+    def decode_cursor(self, request):
+        cursor = request.query_params.get(self.cursor_query_param, "")
+        if not cursor:
+            return None, False
+
+        try:
+            data = json.loads(urlsafe_b64decode(cursor.encode()))
+            values = data["p"]
+            if len(values) != len(self.keys):
+                raise ValueError
+            position = [None if value is None else field.to_python(value) for (_, _, field), value in zip(self.keys, values)]
+            return position, bool(data["r"])
+        except (KeyError, TypeError, ValueError, ValidationError):
+            raise NotFound(self.invalid_cursor_message)
+
+    def get_next_link(self):
+        if not self.has_next:
+            return None
+
+        return self.encode_cursor(self.last_position, False)
+
+    def get_previous_link(self):
+        if not self.has_previous:
+            return None
+
+        return self.encode_cursor(self.first_position, True)
+
+
+class RunPagination(KeysetPagination):
+    ordering = ("-created_at", "-id")
+
+
+class PositionPagination(KeysetPagination):
+    ordering = ("date_time", "id")
+    page_number_class = None
+
+
+class UserPagination(KeysetPagination):
+    ordering = ("id",)
@@ -0,0 +1,90 @@
+import re
+from datetime import datetime, timezone as dt_timezone
+
+# Помесячное секционирование таблицы позиций по date_time, только для PostgreSQL.
+# Секции называются app_run_position_pYYYY_MM, позиции без даты и вне созданных секций
+# попадают в секцию по умолчанию app_run_position_default.
+POSITION_TABLE = "app_run_position"
+DEFAULT_PARTITION = f"{POSITION_TABLE}_default"
+PARTITION_NAME_RE = re.compile(rf"^{POSITION_TABLE}_p(\d{{4}})_(\d{{2}})$")
+
+
+def is_partitioning_supported(connection):
+    return connection.vendor == "postgresql"
+
+
+def month_start(value):
+    return datetime(value.year, value.month, 1, tzinfo=dt_timezone.utc)
+
+
+def add_months(value, months):
+    month = value.month - 1 + months
+    return datetime(value.year + month // 12, month % 12 + 1, 1, tzinfo=dt_timezone.utc)
+
+
+def get_partition_name(month):
+    return f"{POSITION_TABLE}_p{month.year:04d}_{month.month:02d}"
+
+
+def get_partition_month(name):
+    match = PARTITION_NAME_RE.match(name)
+    if not match:
+        return None
+
+    return datetime(int(match.group(1)), int(match.group(2)), 1, tzinfo=dt_timezone.utc)
+
+
+def get_partitions(cursor):
+    cursor.execute(
+        "SELECT child.relname FROM pg_inherits "
+        "JOIN pg_class parent ON parent.oid = pg_inherits.inhparent "
+        "JOIN pg_class child ON child.oid = pg_inherits.inhrelid "
+        "WHERE parent.relname = %s",
+        [POSITION_TABLE]
+    )
+
+    return [row[0] for row in cursor.fetchall()]
+
+
+def create_partition(cursor, month):
+    # Строки этого месяца, уже попавшие в секцию по умолчанию, переносятся в новую секцию,
+    # иначе PostgreSQL не даст её присоединить
+    name = get_partition_name(month)
+    start, end = month, add_months(month, 1)
+
+    cursor.execute(f'CREATE TABLE "{name}" (LIKE "{POSITION_TABLE}" INCLUDING DEFAULTS INCLUDING CONSTRAINTS)')
+    cursor.execute(
+        f'WITH moved AS (DELETE FROM "{DEFAULT_PARTITION}" WHERE date_time >= %s AND date_time < %s RETURNING *) '
+        f'INSERT INTO "{name}" SELECT * FROM moved',
+        [start, end]
+    )
+    cursor.execute(f'ALTER TABLE "{POSITION_TABLE}" ATTACH PARTITION "{name}" FOR VALUES FROM (%s) TO (%s)', [start, end])
+
+    return name
+
+
+def ensure_partitions(cursor, first_month, last_month):
+    existing = set(get_partitions(cursor))
+    created = []
+    month = month_start(first_month)
+    while month <= last_month:
+        if get_partition_name(month) not in existing:
+            created.append(create_partition(cursor, month))
+        month = add_months(month, 1)
+
+    return created
+
+
+def detach_partitions(cursor, before, drop=False):
+    detached = []
+    for name in sorted(get_partitions(cursor)):
+        month = get_partition_month(name)
+        if month is None or add_months(month, 1) > before:
+            continue
+
+        cursor.execute(f'ALTER TABLE "{POSITION_TABLE}" DETACH PARTITION "{name}"')
+        if drop:
+            cursor.execute(f'DROP TABLE "{name}"')
+        detached.append(name)
+
+    return detached
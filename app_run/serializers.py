@@ -1,13 +1,13 @@
 from rest_framework import serializers
 from django.contrib.auth.models import User
 
-from .models import Run, Challenge, Position, CollectibleItem, Subscribe, Rating
+from .models import Run, Challenge, Position, CollectibleItem, Subscribe, Rating, UploadJob, ActivityRollup
 
 
 class UserSerializer(serializers.ModelSerializer):
     type = serializers.SerializerMethodField()
-    runs_finished = serializers.IntegerField()
-    rating = serializers.FloatField(source="avg_rating", read_only=True)
+    runs_finished = serializers.SerializerMethodField()
+    rating = serializers.SerializerMethodField()
 
     class Meta:
         model = User
@@ -19,6 +19,20 @@ class UserSerializer(serializers.ModelSerializer):
 
         return "athlete"
 
+    def get_stats(self, obj):
+        # У пользователей, созданных через bulk_create, строки статистики может не быть
+        return getattr(obj, "stats", None)
+
+    def get_runs_finished(self, obj):
+        stats = self.get_stats(obj)
+
+        return stats.runs_finished if stats else 0
+
+    def get_rating(self, obj):
+        stats = self.get_stats(obj)
+
+        return stats.rating if stats else None
+
 
 class RatingSerializer(serializers.ModelSerializer):
     class Meta:
@@ -43,7 +57,90 @@ class RunSerializer(serializers.ModelSerializer):
 
     class Meta:
         model = Run
-        fields = "__all__"
+        fields = ["id", "athlete_data", "comment", "created_at", "status", "distance", "run_time_seconds", "speed", "athlete"]
+
+
+class ValuesSerializer:
+    # Быстрое чтение списков: строки queryset.values_list() превращаются в словари заранее собранной
+    # функцией, без создания моделей и обхода полей DRF на каждую строку. Вывод совпадает с serializer_class.
+    # Подкласс задаёт lookups и get_row_mapper(), который собирает функцию для строки с полями lookups.
+    serializer_class = None
+    lookups = []
+
+    def __init__(self, rows):
+        self.rows = rows
+        self.row_mapper = self.get_row_mapper()
+
+    @classmethod
+    def get_rows(cls, queryset):
+        return queryset.values_list(*cls.lookups, named=True)
+
+    def get_field_mapper(self, name):
+        to_representation = self.serializer_class().fields[name].to_representation
+
+        return lambda value: None if value is None else to_representation(value)
+
+    @property
+    def data(self):
+        row_mapper = self.row_mapper
+
+        return [row_mapper(row) for row in self.rows]
+
+
+class RunValuesSerializer(ValuesSerializer):
+    serializer_class = RunSerializer
+    lookups = ["id", "athlete", "athlete__username", "athlete__last_name", "athlete__first_name", "comment", "created_at",
+               "status", "distance", "run_time_seconds", "speed"]
+
+    def get_row_mapper(self):
+        created_at_mapper = self.get_field_mapper("created_at")
+
+        def row_mapper(row):
+            run_id, athlete, username, last_name, first_name, comment, created_at, status, distance, run_time_seconds, speed = row
+
+            return {
+                "id": run_id,
+                "athlete_data": {
+                    "id": athlete,
+                    "username": username,
+                    "last_name": last_name,
+                    "first_name": first_name
+                },
+                "comment": comment,
+                "created_at": created_at_mapper(created_at),
+                "status": status,
+                "distance": None if distance is None else float(distance),
+                "run_time_seconds": None if run_time_seconds is None else int(run_time_seconds),
+                "speed": None if speed is None else float(speed),
+                "athlete": athlete
+            }
+
+        return row_mapper
+
+
+class UserValuesSerializer(ValuesSerializer):
+    serializer_class = UserSerializer
+    lookups = ["id", "date_joined", "username", "last_name", "first_name", "is_staff", "stats__runs_finished",
+               "stats__rating_sum", "stats__rating_count"]
+
+    def get_row_mapper(self):
+        date_joined_mapper = self.get_field_mapper("date_joined")
+
+        def row_mapper(row):
+            user_id, date_joined, username, last_name, first_name, is_staff, runs_finished, rating_sum, rating_count = row
+
+            return {
+                "id": user_id,
+                "date_joined": date_joined_mapper(date_joined),
+                "username": username,
+                "last_name": last_name,
+                "first_name": first_name,
+                "type": "coach" if is_staff else "athlete",
+                "runs_finished": 0 if runs_finished is None else int(runs_finished),
+                "rating": float(rating_sum / rating_count) if rating_count else None
+            }
+
+        return row_mapper
 
 
 class ChallengeSerializer(serializers.ModelSerializer):
@@ -78,6 +175,34 @@ class PositionSerializer(serializers.ModelSerializer):
             return value
 
 
+class PositionPointSerializer(PositionSerializer):
+    class Meta(PositionSerializer.Meta):
+        fields = ["latitude", "longitude", "date_time"]
+
+
+class PositionFieldsSerializer(PositionSerializer):
+    # Поля позиции без забега: проверяются без запросов к базе в асинхронном пути
+    class Meta(PositionSerializer.Meta):
+        fields = ["id", "date_time", "latitude", "longitude", "speed", "distance"]
+
+
+class LastPositionSerializer(PositionSerializer):
+    # Последняя позиция забега, восстановленная из полей Run, для снимка живой ленты
+    class Meta(PositionSerializer.Meta):
+        fields = ["date_time", "latitude", "longitude", "distance"]
+
+
+class PositionBatchSerializer(serializers.Serializer):
+    run = serializers.PrimaryKeyRelatedField(queryset=Run.objects.select_related("athlete"))
+    positions = PositionPointSerializer(many=True, allow_empty=False)
+
+    def validate_run(self, value):
+        if value.status != "in_progress":
+            raise serializers.ValidationError("Забег должен быть в процессе")
+        else:
+            return value
+
+
 class CollectibleItemSerializer(serializers.ModelSerializer):
     class Meta:
         model = CollectibleItem
@@ -96,6 +221,27 @@ class CollectibleItemSerializer(serializers.ModelSerializer):
             return value
 
 
+class ActivityRollupSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = ActivityRollup
+        fields = ["period_start", "runs", "distance", "run_time_seconds"]
+
+
+class UploadJobSerializer(serializers.ModelSerializer):
+    duration = serializers.SerializerMethodField()
+
+    class Meta:
+        model = UploadJob
+        fields = ["id", "status", "rows_processed", "rows_rejected", "errors", "message", "created_at", "started_at", "finished_at",
+                  "duration"]
+
+    def get_duration(self, obj):
+        if obj.started_at and obj.finished_at:
+            return (obj.finished_at - obj.started_at).total_seconds()
+
+        return None
+
+
 class UserDetailSerializer(UserSerializer):
     items = CollectibleItemSerializer(many=True, read_only=True)
     coach = serializers.SerializerMethodField()
@@ -105,6 +251,9 @@ class UserDetailSerializer(UserSerializer):
         fields = UserSerializer.Meta.fields + ["items", "coach"]
 
     def get_coach(self, obj):
+        if hasattr(obj, "coach_id"):
+            return obj.coach_id
+
         try:
             subscribe = Subscribe.objects.get(subscriber=obj)
             return subscribe.subscribed_to_id
@@ -120,4 +269,4 @@ class CoachDetailSerializer(UserSerializer):
         fields = UserSerializer.Meta.fields + ["athletes"]
 
     def get_athletes(self, obj):
-        return Subscribe.objects.filter(subscribed_to=obj).values_list("subscriber_id", flat=True)
+        return [subscribe.subscriber_id for subscribe in obj.subscriptions.all()]
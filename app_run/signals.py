@@ -0,0 +1,74 @@
+from django.contrib.auth.models import User
+from django.db.models.signals import pre_save, post_save, post_delete
+from django.dispatch import receiver
+
+from .models import AthleteStats, Challenge, Subscribe, CollectibleItem, Position, Run
+from .utils import bump_table_version, refresh_run_aggregates, tracks_run_activity, load_run_activity, apply_run_activity, \
+    get_run_activity, refresh_athlete_activity
+
+
+@receiver(post_save, sender=User)
+def create_athlete_stats(sender, instance, created, raw=False, **kwargs):
+    if created and not raw:
+        AthleteStats.objects.get_or_create(athlete=instance)
+
+
+@receiver(pre_save, sender=Run)
+def run_saving(sender, instance, raw=False, update_fields=None, **kwargs):
+    if not raw and tracks_run_activity(instance, update_fields):
+        instance._previous_activity = load_run_activity(instance)
+
+
+@receiver(post_save, sender=Run)
+def run_saved(sender, instance, raw=False, **kwargs):
+    if not raw and "_previous_activity" in instance.__dict__:
+        apply_run_activity(instance, instance.__dict__.pop("_previous_activity"))
+
+
+@receiver(post_delete, sender=Run)
+def run_deleted(sender, instance, origin=None, **kwargs):
+    # Забеги удалённого атлета уходят каскадом вместе с его статистикой
+    if isinstance(origin, User) or getattr(origin, "model", None) is User:
+        return
+
+    if get_run_activity(instance):
+        refresh_athlete_activity(instance.athlete_id)
+
+
+@receiver(post_save, sender=Position)
+def position_saved(sender, instance, raw=False, **kwargs):
+    # Позиции, сохранённые по одной (админка, PATCH, Position.objects.create), обновляют итоги забега и его
+    # границы по времени, по которым get_run_positions выбирает секции. Приём позиций идёт через bulk_create
+    # и обновляет их сам. Удаление не расширяет границы, поэтому обработчика post_delete нет:
+    # он отключил бы быстрое каскадное удаление позиций вместе с забегом.
+    if not raw:
+        refresh_run_aggregates(instance.run_id)
+
+
+@receiver(post_save, sender=Challenge)
+@receiver(post_delete, sender=Challenge)
+def challenge_changed(sender, instance, **kwargs):
+    bump_table_version("challenge")
+
+
+@receiver(post_save, sender=CollectibleItem)
+@receiver(post_delete, sender=CollectibleItem)
+def collectible_item_changed(sender, instance, **kwargs):
+    bump_table_version("collectible_item")
+
+
+@receiver(post_save, sender=Subscribe)
+@receiver(post_delete, sender=Subscribe)
+def subscription_changed(sender, instance, **kwargs):
+    bump_table_version(f"coach_analytics:{instance.subscribed_to_id}")
+
+
+@receiver(post_save, sender=Subscribe)
+def subscription_created(sender, instance, raw=False, **kwargs):
+    if not raw:
+        AthleteStats.objects.update_or_create(athlete_id=instance.subscriber_id, defaults={"coach_id": instance.subscribed_to_id})
+
+
+@receiver(post_delete, sender=Subscribe)
+def subscription_deleted(sender, instance, **kwargs):
+    AthleteStats.objects.filter(athlete_id=instance.subscriber_id, coach_id=instance.subscribed_to_id).update(coach_id=None)
@@ -1,3 +1,1363 @@
-from django.test import TestCase
+import asyncio
+import io
+import json
+import os
+import subprocess
+import tempfile
+import time
+from datetime import date, datetime, timedelta, timezone as dt_timezone
+from importlib import import_module
+from pathlib import Path
+from unittest import mock, skipIf, skipUnless
 
-# Create your tests here.
+import numpy as np
+import openpyxl
+from asgiref.sync import sync_to_async
+from django.apps import apps as django_apps
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.files.base import ContentFile
+from django.core.management import call_command, CommandError
+from django.db import DatabaseError, connection
+from django.db.models import Sum
+from django.test import TestCase, SimpleTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from geopy.distance import geodesic
+from django.utils import timezone
+from django.utils.http import parse_http_date
+
+from .buffer import PositionBuffer
+from .geo import distances, get_grid_cell
+from .live import LiveFeedBroker
+from .metrics import MetricsRegistry, get_registry
+from .models import CollectibleItem, Rating, Subscribe, Run, Position, AthleteStats, ActivityRollup, Challenge, UploadJob, \
+    RunTrack, ChallengeRule
+from .partitions import POSITION_TABLE, DEFAULT_PARTITION, get_partitions, get_partition_name, ensure_partitions, \
+    add_months, month_start
+from .serializers import UserSerializer
+from .utils import add_positions, finish_run, find_collectible_items, get_nearby_collectible_items, stop_run, \
+    rebuild_rollups, rebuild_athlete_stats, get_table_version, bump_table_version, get_challenge_summary, process_upload_job, \
+    pack_run_track, get_run_positions, update_athlete_stats, rebuild_rollups_chunk, get_collectible_candidates, \
+    award_challenges, backfill_challenges, import_collectible_items, save_collectible_items, refresh_run_aggregates, \
+    COLLECTIBLE_RADIUS
+
+
+class UserRetrieveTestCase(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.coach = User.objects.create(username="coach", is_staff=True)
+        cls.athletes = [User.objects.create(username=f"athlete_{i}") for i in range(3)]
+        for athlete in cls.athletes:
+            Subscribe.objects.create(subscriber=athlete, subscribed_to=cls.coach)
+        Rating.objects.create(rater=cls.athletes[0], rated=cls.coach, rating=4)
+
+        for i in range(3):
+            item = CollectibleItem.objects.create(
+                name=f"item_{i}", uid=f"uid_{i}", latitude=55.75, longitude=37.61, picture="https://example.com/item.png", value=i
+            )
+            item.users.add(cls.athletes[0])
+
+    def test_athlete_retrieve_query_count(self):
+        with self.assertNumQueries(2):
+            response = self.client.get(f"/api/users/{self.athletes[0].id}/")
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()["coach"], self.coach.id)
+        self.assertEqual(len(response.json()["items"]), 3)
+
+    def test_coach_retrieve_query_count(self):
+        with self.assertNumQueries(2):
+            response = self.client.get(f"/api/users/{self.coach.id}/")
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()["athletes"], [athlete.id for athlete in self.athletes])
+        self.assertEqual(response.json()["type"], "coach")
+
+    def test_unsubscribed_athlete_retrieve(self):
+        athlete = User.objects.create(username="athlete_free")
+
+        with self.assertNumQueries(2):
+            response = self.client.get(f"/api/users/{athlete.id}/")
+
+        self.assertEqual(response.json()["coach"], None)
+        self.assertEqual(response.json()["items"], [])
+
+    def test_user_without_stats(self):
+        athlete = User.objects.bulk_create([User(username="athlete_bulk")])[0]
+
+        response = self.client.get(f"/api/users/{athlete.id}/")
+        self.assertEqual(response.json()["runs_finished"], 0)
+        self.assertIsNone(response.json()["rating"])
+
+    def test_list_matches_serializer(self):
+        User.objects.bulk_create([User(username="athlete_bulk")])
+        users = User.objects.exclude(is_superuser=True).order_by("id").select_related("stats")
+
+        response = self.client.get("/api/users/")
+        self.assertEqual(response.json(), UserSerializer(users, many=True).data)
+
+
+class CoachLiveFeedTestCase(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.coach = User.objects.create(username="coach", is_staff=True)
+        cls.athlete = User.objects.create(username="athlete")
+        cls.stranger = User.objects.create(username="stranger")
+        Subscribe.objects.create(subscriber=cls.athlete, subscribed_to=cls.coach)
+        cls.athlete_run = Run.objects.create(athlete=cls.athlete, status="in_progress")
+        cls.stranger_run = Run.objects.create(athlete=cls.stranger, status="in_progress")
+
+    def add_position(self, run, seconds):
+        with self.captureOnCommitCallbacks(execute=True):
+            add_positions(run, [
+                Position(latitude="55.7500", longitude="37.6100", date_time=timezone.now() + timedelta(seconds=seconds))
+            ])
+
+    async def test_positions_are_streamed_to_coach(self):
+        response = await self.async_client.get(f"/api/async/coaches/{self.coach.id}/live/")
+        self.assertEqual(response["Content-Type"], "text/event-stream")
+        stream = aiter(response.streaming_content)
+
+        self.assertEqual(await anext(stream), b"retry: 3000\n\n")
+        snapshot = (await anext(stream)).decode()
+        self.assertIn("event: snapshot", snapshot)
+        self.assertIn(f'"run":{self.athlete_run.id}', snapshot)
+        self.assertNotIn(f'"run":{self.stranger_run.id}', snapshot)
+
+        await sync_to_async(self.add_position)(self.stranger_run, 0)
+        await sync_to_async(self.add_position)(self.athlete_run, 1)
+        event = (await anext(stream)).decode()
+        await stream.aclose()
+
+        lines = event.strip().split("\n")
+        self.assertEqual(lines[1], "event: position")
+        data = json.loads(lines[2].removeprefix("data: "))
+        self.assertEqual(data["run"], self.athlete_run.id)
+        self.assertEqual(data["athlete"], self.athlete.id)
+        self.assertEqual(lines[0], f"id: {data['id']}")
+
+    async def test_unknown_coach(self):
+        response = await self.async_client.get(f"/api/async/coaches/{self.athlete.id}/live/")
+
+        self.assertEqual(response.status_code, 404)
+
+    async def test_async_route_counts_queries(self):
+        with tempfile.TemporaryDirectory() as directory, override_settings(METRICS_ENABLED=True, METRICS_DIR=directory):
+            response = await self.async_client.post("/api/async/positions/", {
+                "run": self.athlete_run.id, "latitude": "55.7500", "longitude": "37.6100", "date_time": "2024-01-01T10:00:00"
+            }, content_type="application/json")
+            self.assertEqual(response.status_code, 201)
+
+            series = get_registry().series[("api/async/positions/", "POST")]
+            self.assertGreater(series["queries"]["sum"], 0)
+
+    async def test_slow_client_drops_oldest_events(self):
+        broker = LiveFeedBroker()
+        subscription = broker.subscribe([self.athlete.id], 2)
+        broker.publish(self.athlete.id, [("position", i, {"id": i}) for i in range(3)])
+        await asyncio.sleep(0)
+
+        self.assertEqual(subscription.pop_dropped(), 1)
+        self.assertEqual([(await subscription.get(1))[1] for _ in range(2)], [1, 2])
+        self.assertIsNone(await subscription.get(0.01))
+
+        broker.unsubscribe(subscription)
+        self.assertFalse(broker.has_subscribers(self.athlete.id))
+
+
+class PositionBufferTestCase(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.athlete = User.objects.create(username="athlete")
+
+    def make_positions(self, started_at, offsets):
+        return [
+            Position(latitude=f"{55.75 + offset * 0.0001:.4f}", longitude="37.6100", date_time=started_at + timedelta(seconds=offset))
+            for offset in offsets
+        ]
+
+    def test_buffered_positions_match_direct_inserts(self):
+        started_at = timezone.now()
+        # Вторая пачка содержит позицию из прошлого, она не должна сдвинуть последнюю позицию забега
+        batches = [[0, 1, 2], [5, 3], [4], [10]]
+
+        direct_run = Run.objects.create(athlete=self.athlete, status="in_progress")
+        for offsets in batches:
+            add_positions(direct_run, self.make_positions(started_at, offsets))
+
+        buffered_run = Run.objects.create(athlete=self.athlete, status="in_progress")
+        buffer = PositionBuffer(size=100, interval=None)
+        for index, offsets in enumerate(batches):
+            buffer.add(Run.objects.get(pk=buffered_run.pk), self.make_positions(started_at, offsets))
+            if index == 1:
+                self.assertEqual(buffer.flush(), 5)
+        self.assertEqual(Position.objects.filter(run=buffered_run).count(), 5)
+        self.assertEqual(buffer.flush(), 2)
+
+        fields = ["latitude", "date_time", "speed", "distance"]
+        self.assertEqual(
+            list(Position.objects.filter(run=buffered_run).order_by("id").values_list(*fields)),
+            list(Position.objects.filter(run=direct_run).order_by("id").values_list(*fields))
+        )
+
+        runs = []
+        for run in [direct_run, buffered_run]:
+            run = Run.objects.get(pk=run.pk)
+            finish_run(run)
+            runs.append(run)
+        for field in ["positions_count", "speed_sum", "first_position_at", "last_position_at", "last_latitude",
+                      "last_position_distance", "distance", "run_time_seconds", "speed"]:
+            self.assertEqual(getattr(runs[0], field), getattr(runs[1], field), field)
+        self.assertAlmostEqual(runs[0].positions_distance, runs[1].positions_distance)
+
+    def test_late_flush_skips_finished_run(self):
+        run = Run.objects.create(athlete=self.athlete, status="in_progress")
+        buffer = PositionBuffer(size=100, interval=None)
+        buffer.add(Run.objects.get(pk=run.pk), self.make_positions(timezone.now(), [0, 1]))
+        buffer.flush()
+        Run.objects.filter(pk=run.pk).update(status="finished")
+        finished = Run.objects.get(pk=run.pk)
+
+        buffer.add(Run.objects.get(pk=run.pk), self.make_positions(timezone.now(), [2]))
+        self.assertEqual(buffer.flush(), 0)
+        self.assertEqual(Position.objects.filter(run=run).count(), 2)
+        self.assertEqual(Run.objects.get(pk=run.pk).last_position_at, finished.last_position_at)
+        self.assertNotIn(run.id, buffer.last_positions)
+
+    def test_failed_flush_drops_run_state(self):
+        run = Run.objects.create(athlete=self.athlete, status="in_progress")
+        buffer = PositionBuffer(size=100, interval=None)
+        buffer.add(Run.objects.get(pk=run.pk), self.make_positions(timezone.now(), [0]))
+
+        with mock.patch("app_run.buffer.Position.objects.bulk_create", side_effect=DatabaseError), \
+                self.assertLogs("app_run.buffer", "ERROR"):
+            self.assertEqual(buffer.flush(), 0)
+        self.assertNotIn(run.id, buffer.last_positions)
+
+
+class CollectibleOwnershipTestCase(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.athlete = User.objects.create(username="athlete")
+        owners = User.objects.bulk_create([User(username=f"owner_{i}") for i in range(500)])
+        cls.popular = CollectibleItem.objects.create(
+            name="popular", uid="popular", latitude=55.75, longitude=37.61, picture="https://example.com/item.png", value=1
+        )
+        cls.popular.users.add(*owners)
+        cls.near = CollectibleItem.objects.create(
+            name="near", uid="near", latitude=55.7502, longitude=37.61, picture="https://example.com/item.png", value=1
+        )
+        CollectibleItem.objects.create(
+            name="far", uid="far", latitude=55.76, longitude=37.61, picture="https://example.com/item.png", value=1
+        )
+
+    def find(self, coords_list):
+        return find_collectible_items(self.athlete.id, coords_list, get_nearby_collectible_items(coords_list))
+
+    def test_each_item_is_found_once(self):
+        # Запросы: предметы рядом, владение предметами в радиусе, выдача найденного предмета
+        # и его ценность в статистике атлета внутри точки сохранения
+        with self.assertNumQueries(6):
+            found = self.find([(55.75, 37.61)])
+        self.assertEqual(found, [self.popular])
+
+        found = self.find([(55.75, 37.61), (55.75, 37.61), (55.75, 37.61)])
+        self.assertEqual(found, [self.near, None, None])
+        self.assertEqual(set(self.athlete.items.values_list("name", flat=True)), {"popular", "near"})
+
+    def test_no_items_in_radius(self):
+        with self.assertNumQueries(1):
+            self.assertEqual(self.find([(55.70, 37.61)]), [None])
+
+    def test_item_near_cell_edge(self):
+        # Предмет и позиции по разные стороны границы ячеек сетки по широте и долготе
+        edge = CollectibleItem.objects.create(
+            name="edge", uid="edge", latitude=55.6999, longitude=37.5999, picture="https://example.com/item.png", value=1
+        )
+        self.assertNotEqual(get_grid_cell(55.6999, 37.5999), get_grid_cell(55.7001, 37.6001))
+
+        coords_list = [(55.7001, 37.6001), (55.7001, 37.6001), (55.7010, 37.6001)]
+        self.assertEqual(self.find(coords_list), [edge, None, None])
+
+    def test_candidates_match_geodesic(self):
+        items = [
+            CollectibleItem(
+                id=i, latitude=round(55.75 + (i % 7 - 3) * 0.0004, 4), longitude=round(37.61 + (i // 7 - 3) * 0.0006, 4)
+            )
+            for i in range(49)
+        ]
+        coords_list = [(55.75 + i * 0.0003, 37.61 + i * 0.0002) for i in range(-5, 6)]
+
+        with mock.patch("app_run.utils.COLLECTIBLE_MATRIX_SIZE", 100):
+            candidates = get_collectible_candidates(coords_list, items)
+        self.assertEqual(candidates, [
+            [item for item in items if geodesic(coords, (item.latitude, item.longitude)).meters <= COLLECTIBLE_RADIUS]
+            for coords in coords_list
+        ])
+        self.assertTrue(all(candidates))
+
+
+class PositionBatchTestCase(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.athlete = User.objects.create(username="athlete")
+        cls.item = CollectibleItem.objects.create(
+            name="item", uid="item", latitude=55.7515, longitude=37.61, picture="https://example.com/item.png", value=1
+        )
+
+    def points(self, started_at, offsets):
+        return [
+            {
+                "latitude": f"{55.75 + offset * 0.001:.4f}", "longitude": "37.6100",
+                "date_time": (started_at + timedelta(seconds=offset * 10)).strftime("%Y-%m-%dT%H:%M:%S.%f")
+            }
+            for offset in offsets
+        ]
+
+    def batch(self, run, points):
+        return self.client.post("/api/positions/batch/", {"run": run.id, "positions": points}, content_type="application/json")
+
+    def test_batch_matches_single_positions(self):
+        started_at = timezone.now()
+        points = self.points(started_at, range(5))
+
+        single_run = Run.objects.create(athlete=User.objects.create(username="single"), status="in_progress")
+        for point in points:
+            self.assertEqual(self.client.post("/api/positions/", {**point, "run": single_run.id}).status_code, 201)
+
+        batch_run = Run.objects.create(athlete=self.athlete, status="in_progress")
+        response = self.batch(batch_run, points[:1])
+        self.assertEqual(response.status_code, 201)
+        # Вторая пачка продолжает цепочку от последней сохранённой позиции забега
+        response = self.batch(batch_run, points[1:])
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual([result["distance"] for result in response.json()], list(
+            Position.objects.filter(run=batch_run).order_by("id").values_list("distance", flat=True)
+        )[1:])
+
+        fields = ["latitude", "date_time", "speed", "distance"]
+        self.assertEqual(
+            list(Position.objects.filter(run=batch_run).order_by("id").values_list(*fields)),
+            list(Position.objects.filter(run=single_run).order_by("id").values_list(*fields))
+        )
+        self.assertGreater(Position.objects.filter(run=batch_run).order_by("-id").first().distance, 0)
+
+    def test_results_and_collectibles_per_point(self):
+        run = Run.objects.create(athlete=self.athlete, status="in_progress")
+        response = self.batch(run, self.points(timezone.now(), range(4)))
+        self.assertEqual(response.status_code, 201)
+
+        results = response.json()
+        self.assertEqual(len(results), 4)
+        self.assertEqual([result["id"] for result in results], list(
+            Position.objects.filter(run=run).order_by("id").values_list("id", flat=True)
+        ))
+        # Предмет в радиусе нескольких точек засчитывается только первой из них
+        self.assertEqual([result.get("item_id") for result in results], [None, self.item.id, None, None])
+        self.assertEqual(results[1]["message"], "Вы нашли предмет item")
+        self.assertEqual(list(self.athlete.items.all()), [self.item])
+
+    def test_invalid_point_rejects_batch(self):
+        run = Run.objects.create(athlete=self.athlete, status="in_progress")
+        points = self.points(timezone.now(), range(3))
+        points[1]["latitude"] = "91.0000"
+
+        response = self.batch(run, points)
+        self.assertEqual(response.status_code, 400)
+        errors = response.json()["positions"]
+        self.assertEqual(errors[0], {})
+        self.assertIn("latitude", errors[1])
+        self.assertEqual(errors[2], {})
+        self.assertFalse(Position.objects.filter(run=run).exists())
+
+        self.assertEqual(self.batch(run, []).status_code, 400)
+
+    def test_finished_run_is_rejected(self):
+        run = Run.objects.create(athlete=self.athlete, status="finished")
+        response = self.batch(run, self.points(timezone.now(), range(2)))
+        self.assertEqual(response.status_code, 400)
+        self.assertIn("run", response.json())
+        self.assertFalse(Position.objects.filter(run=run).exists())
+
+
+class LeaderboardTestCase(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.coach = User.objects.create(username="coach", is_staff=True)
+        cls.athletes = [User.objects.create(username=f"athlete_{i}") for i in range(12)]
+        for athlete in cls.athletes[::2]:
+            Subscribe.objects.create(subscriber=athlete, subscribed_to=cls.coach)
+
+        # Одинаковые дистанции у нескольких атлетов, у последнего дистанции нет
+        distances = [5, 3, 5, 8, 1, 3, 5, 2, 8, 4, 6, 0]
+        for athlete, distance in zip(cls.athletes, distances):
+            AthleteStats.objects.filter(athlete=athlete).update(total_distance=distance)
+
+    def expected(self, coach=False):
+        stats = AthleteStats.objects.filter(total_distance__gt=0)
+        if coach:
+            stats = stats.filter(coach=self.coach)
+
+        return [(row.athlete_id, row.total_distance) for row in sorted(stats, key=lambda row: (-row.total_distance, row.athlete_id))]
+
+    def test_top_and_ranks_match_full_sort(self):
+        for coach in [False, True]:
+            expected = self.expected(coach)
+            query = f"?coach={self.coach.id}" if coach else ""
+
+            response = self.client.get(f"/api/leaderboards/distance/{query}{'&' if query else '?'}limit=100")
+            self.assertEqual([(entry["athlete"], entry["value"]) for entry in response.json()], expected)
+            self.assertEqual([entry["rank"] for entry in response.json()], list(range(1, len(expected) + 1)))
+
+            for rank, (athlete_id, _) in enumerate(expected, start=1):
+                response = self.client.get(f"/api/leaderboards/distance/rank/{athlete_id}/{query}")
+                self.assertEqual(response.json()["rank"], rank)
+
+    def test_around(self):
+        expected = self.expected()
+        athlete_id = expected[4][0]
+
+        with self.assertNumQueries(7):
+            response = self.client.get(f"/api/leaderboards/distance/around/?athlete={athlete_id}&limit=2")
+        self.assertEqual([entry["athlete"] for entry in response.json()], [row[0] for row in expected[2:7]])
+        self.assertEqual([entry["rank"] for entry in response.json()], [3, 4, 5, 6, 7])
+
+        response = self.client.get("/api/leaderboards/distance/around/?rank=1&limit=2")
+        self.assertEqual([entry["rank"] for entry in response.json()], [1, 2, 3])
+
+        response = self.client.get(f"/api/leaderboards/distance/around/?rank={len(expected)}&limit=2")
+        self.assertEqual([entry["athlete"] for entry in response.json()], [row[0] for row in expected[-3:]])
+
+    def test_unranked_and_unknown(self):
+        self.assertEqual(self.client.get(f"/api/leaderboards/distance/rank/{self.athletes[-1].id}/").status_code, 404)
+        self.assertEqual(self.client.get("/api/leaderboards/unknown/").status_code, 404)
+        self.assertEqual(self.client.get("/api/leaderboards/distance/?limit=0").status_code, 400)
+        self.assertEqual(self.client.get("/api/leaderboards/distance/around/").status_code, 400)
+        self.assertEqual(self.client.get("/api/leaderboards/distance/around/?athlete=").status_code, 400)
+        self.assertEqual(self.client.get("/api/leaderboards/distance/around/?athlete=&rank=1").status_code, 200)
+
+    def test_stats_follow_runs_items_and_subscriptions(self):
+        athlete = self.athletes[1]
+        Subscribe.objects.create(subscriber=athlete, subscribed_to=self.coach)
+        self.assertEqual(AthleteStats.objects.get(athlete=athlete).coach_id, self.coach.id)
+
+        item = CollectibleItem.objects.create(
+            name="item", uid="item", latitude=55.75, longitude=37.61, picture="https://example.com/item.png", value=7
+        )
+        run = Run.objects.create(athlete=athlete, status="in_progress")
+        started_at = timezone.now()
+        add_positions(run, [
+            Position(latitude=f"{55.75 + i * 0.001:.4f}", longitude="37.6100", date_time=started_at + timedelta(seconds=i * 60))
+            for i in range(3)
+        ])
+        find_collectible_items(athlete.id, [(55.75, 37.61)], get_nearby_collectible_items([(55.75, 37.61)]))
+        run, _ = stop_run(run.id)
+
+        stats = AthleteStats.objects.get(athlete=athlete)
+        self.assertEqual(stats.best_speed, run.speed)
+        self.assertEqual(stats.items_value, item.value)
+        self.assertEqual(stats.total_distance, 3 + run.distance)
+
+        Subscribe.objects.filter(subscriber=athlete).delete()
+        self.assertIsNone(AthleteStats.objects.get(athlete=athlete).coach_id)
+
+    def test_bulk_created_athletes_get_coach(self):
+        subscribed, bulk_subscribed = User.objects.bulk_create([User(username="bulk_1"), User(username="bulk_2")])
+        Subscribe.objects.create(subscriber=subscribed, subscribed_to=self.coach)
+        Subscribe.objects.bulk_create([Subscribe(subscriber=bulk_subscribed, subscribed_to=self.coach)])
+        update_athlete_stats(bulk_subscribed.id, runs_finished=1)
+
+        self.assertEqual(AthleteStats.objects.get(athlete=subscribed).coach_id, self.coach.id)
+        self.assertEqual(AthleteStats.objects.get(athlete=bulk_subscribed).coach_id, self.coach.id)
+        self.assertEqual(AthleteStats.objects.get(athlete=bulk_subscribed).runs_finished, 1)
+
+
+class RunActivityTestCase(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.coach = User.objects.create(username="coach", is_staff=True)
+        cls.athlete = User.objects.create(username="athlete")
+        Subscribe.objects.create(subscriber=cls.athlete, subscribed_to=cls.coach)
+
+    def create_run(self, athlete, km, finish=True):
+        run = Run.objects.create(athlete=athlete, status="in_progress")
+        started_at = timezone.now()
+        add_positions(run, [
+            Position(latitude=f"{55.75 + i * km / 111.3:.4f}", longitude="37.6100", date_time=started_at + timedelta(minutes=i * 10))
+            for i in range(2)
+        ])
+        if finish:
+            run, _ = stop_run(run.id)
+
+        return Run.objects.get(pk=run.pk)
+
+    def stats(self, athlete):
+        return AthleteStats.objects.filter(athlete=athlete).values_list(
+            "runs_finished", "total_distance", "last_activity", "best_speed"
+        ).get()
+
+    def runs_finished(self, athlete):
+        response = self.client.get("/api/users/")
+        return next(user["runs_finished"] for user in response.json() if user["id"] == athlete.id)
+
+    def test_stats_follow_run_delete_and_status_patch(self):
+        finished = self.create_run(self.athlete, 2)
+        started = self.create_run(self.athlete, 3, finish=False)
+        self.assertEqual(self.runs_finished(self.athlete), 1)
+
+        self.assertEqual(self.client.delete(f"/api/runs/{finished.id}/").status_code, 204)
+        self.assertEqual(self.runs_finished(self.athlete), 0)
+        self.assertEqual(self.stats(self.athlete), (0, 0, None, None))
+
+        response = self.client.patch(f"/api/runs/{started.id}/", {"status": "finished"}, content_type="application/json")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.runs_finished(self.athlete), 1)
+
+        stats = self.stats(self.athlete)
+        rebuild_athlete_stats()
+        self.assertEqual(self.stats(self.athlete), stats)
+
+    def test_stats_follow_finished_run_edit(self):
+        run = self.create_run(self.athlete, 2)
+        other = User.objects.create(username="other")
+
+        response = self.client.patch(f"/api/runs/{run.id}/", {"athlete": other.id}, content_type="application/json")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.stats(self.athlete), (0, 0, None, None))
+        self.assertEqual(self.stats(other)[:2], (1, run.distance))
+
+        response = self.client.patch(f"/api/runs/{run.id}/", {"status": "in_progress"}, content_type="application/json")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.stats(other), (0, 0, None, None))
+
+    def test_leaderboards_follow_run_delete(self):
+        other = User.objects.create(username="other")
+        run = self.create_run(self.athlete, 2)
+        self.create_run(other, 1)
+
+        for board in ["distance", "runs", "speed"]:
+            response = self.client.get(f"/api/leaderboards/{board}/")
+            self.assertIn(self.athlete.id, [entry["athlete"] for entry in response.json()])
+
+        self.assertEqual(self.client.delete(f"/api/runs/{run.id}/").status_code, 204)
+        for board in ["distance", "runs", "speed"]:
+            response = self.client.get(f"/api/leaderboards/{board}/")
+            self.assertEqual([(entry["athlete"], entry["rank"]) for entry in response.json()], [(other.id, 1)])
+        self.assertEqual(self.client.get(f"/api/leaderboards/distance/rank/{self.athlete.id}/").status_code, 404)
+        self.assertEqual(self.client.get(f"/api/leaderboards/distance/?coach={self.coach.id}").json(), [])
+
+    def test_history_follows_run_changes(self):
+        url = f"/api/athletes/{self.athlete.id}/history/?bucket=month"
+        run = self.create_run(self.athlete, 2)
+        self.assertEqual([row["runs"] for row in self.client.get(url).json()], [1])
+
+        self.assertEqual(self.client.delete(f"/api/runs/{run.id}/").status_code, 204)
+        self.assertEqual(self.client.get(url).json(), [])
+
+        run = self.create_run(self.athlete, 3, finish=False)
+        self.client.patch(f"/api/runs/{run.id}/", {"status": "finished"}, content_type="application/json")
+        run = Run.objects.get(pk=run.pk)
+        run.created_at = datetime(2020, 5, 10, 8, 0, tzinfo=timezone.get_current_timezone())
+        run.save()
+        self.assertEqual([(row["period_start"], row["runs"]) for row in self.client.get(url).json()], [("2020-05-01", 1)])
+
+        rollups = sorted(ActivityRollup.objects.values_list("athlete_id", "bucket", "period_start", "runs", "distance"))
+        rebuild_rollups(workers=1)
+        self.assertEqual(sorted(ActivityRollup.objects.values_list("athlete_id", "bucket", "period_start", "runs", "distance")), rollups)
+
+
+    def test_coach_analytics_ties_go_to_lowest_id(self):
+        cache.clear()
+        other = User.objects.create(username="other")
+        Subscribe.objects.create(subscriber=other, subscribed_to=self.coach)
+        self.create_run(other, 2)
+        self.create_run(self.athlete, 2)
+
+        response = self.client.get(f"/api/analytics_for_coach/{self.coach.id}/").json()
+        self.assertEqual(
+            [response["longest_run_user"], response["total_run_user"], response["speed_avg_user"]],
+            [self.athlete.id] * 3
+        )
+
+    def test_coach_analytics_follow_run_changes(self):
+        cache.clear()
+        url = f"/api/analytics_for_coach/{self.coach.id}/"
+        other = User.objects.create(username="other")
+        Subscribe.objects.create(subscriber=other, subscribed_to=self.coach)
+        run = self.create_run(self.athlete, 3)
+        self.create_run(other, 2)
+        self.assertEqual(self.client.get(url).json()["longest_run_user"], self.athlete.id)
+
+        self.client.patch(f"/api/runs/{run.id}/", {"distance": 1}, content_type="application/json")
+        self.assertEqual(self.client.get(url).json()["longest_run_user"], other.id)
+
+        self.client.patch(f"/api/runs/{run.id}/", {"distance": 5}, content_type="application/json")
+        self.assertEqual(self.client.get(url).json()["longest_run_value"], 5)
+
+        self.assertEqual(self.client.delete(f"/api/runs/{run.id}/").status_code, 204)
+        response = self.client.get(url).json()
+        self.assertEqual([response["longest_run_user"], response["total_run_user"]], [other.id, other.id])
+
+
+class AthleteHistoryTestCase(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.athlete = User.objects.create(username="athlete")
+        cls.other = User.objects.create(username="other")
+
+    def finish_run(self, athlete, created_at, minutes):
+        run = Run.objects.create(athlete=athlete, status="in_progress")
+        Run.objects.filter(pk=run.pk).update(created_at=created_at)
+        add_positions(run, [
+            Position(latitude=f"{55.75 + i * 0.01:.4f}", longitude="37.6100", date_time=created_at + timedelta(minutes=i * minutes))
+            for i in range(2)
+        ])
+
+        return stop_run(run.id)[0]
+
+    def rollups(self):
+        return sorted(ActivityRollup.objects.values_list("athlete_id", "bucket", "period_start", "runs", "run_time_seconds"))
+
+    def test_incremental_rollups_match_rebuild(self):
+        # Пятница и воскресенье одной недели, понедельник следующей недели и другой месяц
+        dates = [(2026, 10, 16), (2026, 10, 18), (2026, 10, 18), (2026, 10, 19), (2026, 11, 2)]
+        runs = [
+            self.finish_run(athlete, timezone.make_aware(datetime(*day, 8, 0)), minutes)
+            for athlete in [self.athlete, self.other] for minutes, day in enumerate(dates, start=10)
+        ]
+        Run.objects.create(athlete=self.athlete, status="in_progress")
+
+        incremental = self.rollups()
+        distances = dict(((row.athlete_id, row.bucket, row.period_start), row.distance) for row in ActivityRollup.objects.all())
+        self.assertEqual(rebuild_rollups(chunk_size=1, workers=1), len(incremental))
+        self.assertEqual(self.rollups(), incremental)
+        for row in ActivityRollup.objects.all():
+            self.assertAlmostEqual(row.distance, distances[(row.athlete_id, row.bucket, row.period_start)])
+
+        weeks = ActivityRollup.objects.filter(athlete=self.athlete, bucket="week").order_by("period_start")
+        self.assertEqual([(week.period_start, week.runs) for week in weeks], [
+            (date(2026, 10, 12), 3), (date(2026, 10, 19), 1), (date(2026, 11, 2), 1)
+        ])
+        self.assertAlmostEqual(weeks[0].distance, sum(run.distance for run in runs[:3]))
+
+    def test_rebuild_creates_missing_stats_to_lock(self):
+        athlete = User.objects.bulk_create([User(username="bulk")])[0]
+        Subscribe.objects.bulk_create([Subscribe(subscriber=athlete, subscribed_to=self.other)])
+
+        rebuild_rollups_chunk(athlete.id, athlete.id)
+        self.assertEqual(AthleteStats.objects.get(athlete=athlete).coach_id, self.other.id)
+
+    def test_history_reads_rollups(self):
+        for day in [(2026, 9, 30), (2026, 10, 1), (2026, 10, 20)]:
+            self.finish_run(self.athlete, timezone.make_aware(datetime(*day, 8, 0)), 10)
+
+        with self.assertNumQueries(2):
+            response = self.client.get(f"/api/athletes/{self.athlete.id}/history/?bucket=month")
+        self.assertEqual([(row["period_start"], row["runs"]) for row in response.json()], [("2026-09-01", 1), ("2026-10-01", 2)])
+
+        response = self.client.get(f"/api/athletes/{self.athlete.id}/history/?bucket=day&from=2026-10-01&to=2026-10-31")
+        self.assertEqual([row["period_start"] for row in response.json()], ["2026-10-01", "2026-10-20"])
+
+        response = self.client.get(f"/api/athletes/{self.athlete.id}/history/?from=2026-10-01")
+        self.assertEqual([row["period_start"] for row in response.json()], ["2026-09-28", "2026-10-19"])
+
+        self.assertEqual(self.client.get(f"/api/athletes/{self.athlete.id}/history/?bucket=year").status_code, 400)
+        self.assertEqual(self.client.get(f"/api/athletes/{self.athlete.id}/history/?from=01.10.2026").status_code, 400)
+        self.assertEqual(self.client.get("/api/athletes/999999/history/").status_code, 404)
+
+
+class DistanceModelTestCase(SimpleTestCase):
+    # Границы погрешности из описания DISTANCE_MODELS в geo.py: пояс широт, длина отрезка, допуск в процентах
+    ELLIPSOIDAL_BOUNDS = [
+        (60, 10_000, 0.00005), (60, 100_000, 0.005), (60, 1_000_000, 0.4),
+        (80, 10_000, 0.0005), (80, 100_000, 0.05), (80, 1_000_000, 4),
+        (89, 100, 0.00001), (89, 1_000, 0.0005), (89, 10_000, 0.05), (89, 100_000, 4),
+    ]
+
+    def relative_errors(self, rng, max_latitude, length, model, count=300):
+        starts = list(zip(rng.uniform(-max_latitude, max_latitude, count), rng.uniform(-180, 180, count)))
+        ends = [geodesic(meters=length).destination(start, bearing) for start, bearing in zip(starts, rng.uniform(0, 360, count))]
+        segments = [(start, (end.latitude, end.longitude)) for start, end in zip(starts, ends) if abs(end.latitude) <= max_latitude]
+
+        result = distances(*zip(*[(start[0], start[1], end[0], end[1]) for start, end in segments]), model)
+        expected = np.array([geodesic(start, end).meters for start, end in segments])
+
+        return np.abs(result - expected) / expected * 100
+
+    def test_ellipsoidal_bounds(self):
+        rng = np.random.default_rng(0)
+        for max_latitude, length, bound in self.ELLIPSOIDAL_BOUNDS:
+            with self.subTest(max_latitude=max_latitude, length=length):
+                self.assertLessEqual(self.relative_errors(rng, max_latitude, length, "ellipsoidal").max(), bound)
+
+        # Оценки выше не переносятся на длинные отрезки у полюса
+        self.assertGreater(self.relative_errors(rng, 89, 1_000_000, "ellipsoidal").max(), 10)
+
+    def test_haversine_bound(self):
+        rng = np.random.default_rng(0)
+        for length in [100, 10_000, 1_000_000]:
+            self.assertLessEqual(self.relative_errors(rng, 89, length, "haversine").max(), 0.6)
+
+
+class RunStopTestCase(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.athlete = User.objects.create(username="athlete")
+
+    def create_legacy_run(self):
+        # Позиции без времени, как у забегов до обязательного date_time
+        run = Run.objects.create(athlete=self.athlete, status="in_progress")
+        Position.objects.bulk_create([Position(run=run, latitude="55.7500", longitude="37.6100") for _ in range(2)])
+        Run.objects.filter(pk=run.pk).update(positions_count=2, positions_distance=0.5, last_latitude="55.7500",
+                                             last_longitude="37.6100")
+
+        return Run.objects.get(pk=run.pk)
+
+    def test_stop_legacy_run(self):
+        run = self.create_legacy_run()
+
+        self.assertEqual(self.client.post(f"/api/runs/{run.id}/stop/").status_code, 200)
+        run.refresh_from_db()
+        self.assertEqual((run.status, run.distance, run.run_time_seconds), ("finished", 0.5, 0))
+        # Позиции без времени не упаковываются, забег читается из строк
+        self.assertFalse(RunTrack.objects.filter(run=run).exists())
+
+    def test_stop_packs_track_and_keeps_rows(self):
+        run = Run.objects.create(athlete=self.athlete, status="in_progress")
+        started_at = timezone.now()
+        add_positions(run, [
+            Position(latitude=f"{55.75 + i * 0.001:.4f}", longitude="37.6100", date_time=started_at + timedelta(seconds=i * 10))
+            for i in range(3)
+        ])
+        url = f"/api/positions/?run={run.id}"
+        rows = self.client.get(url).json()
+
+        self.assertEqual(self.client.post(f"/api/runs/{run.id}/stop/").status_code, 200)
+        self.assertEqual(RunTrack.objects.get(run=run).points_count, 3)
+        self.assertEqual(Position.objects.filter(run=run).count(), 3)
+
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(self.client.get(url).json(), rows)
+        self.assertFalse(any(Position._meta.db_table in query["sql"] for query in queries))
+
+    def test_last_activity_matches_rebuild(self):
+        started_at = timezone.now() - timedelta(days=3)
+        for offset in [2, 0, 1]:
+            run = Run.objects.create(athlete=self.athlete, status="in_progress")
+            add_positions(run, [
+                Position(latitude="55.7500", longitude="37.6100", date_time=started_at + timedelta(days=offset, minutes=minute))
+                for minute in range(2)
+            ])
+            stop_run(run.id)
+
+        last_activity = AthleteStats.objects.get(athlete=self.athlete).last_activity
+        self.assertEqual(last_activity, started_at + timedelta(days=2, minutes=1))
+        rebuild_athlete_stats()
+        self.assertEqual(AthleteStats.objects.get(athlete=self.athlete).last_activity, last_activity)
+
+    def test_add_positions_to_legacy_run(self):
+        run = self.create_legacy_run()
+
+        add_positions(run, [Position(latitude="55.7600", longitude="37.6100", date_time=timezone.now())])
+        run.refresh_from_db()
+        self.assertEqual(run.positions_count, 3)
+
+
+class ChallengeRuleTestCase(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.athlete = User.objects.create(username="athlete")
+
+    def finish(self, athlete, distance, run_time_seconds, award=True):
+        # Законченный забег учитывается в статистике атлета сигналом сохранения, как при остановке забега
+        run = Run.objects.create(athlete=athlete, status="finished", distance=distance, run_time_seconds=run_time_seconds)
+        if award:
+            award_challenges(run)
+
+        return run
+
+    def legacy_challenges(self, athlete, run, earned):
+        # Проверки, которые были зашиты в остановку забега до правил челленджей
+        finished_runs = athlete.runs.filter(status="finished")
+        total_distance = finished_runs.aggregate(total_distance=Sum("distance"))["total_distance"]
+        if finished_runs.count() == 10:
+            earned.add("Сделай 10 Забегов!")
+        if total_distance and total_distance >= 50:
+            earned.add("Пробеги 50 километров!")
+        if total_distance and total_distance >= 2 and run.run_time_seconds / 60 <= 10:
+            earned.add("2 километра за 10 минут!")
+
+        return earned
+
+    def challenges(self, athlete):
+        return set(Challenge.objects.filter(athlete=athlete).values_list("full_name", flat=True))
+
+    def test_seeded_rules_match_legacy_checks(self):
+        self.assertEqual(
+            set(ChallengeRule.objects.values_list("full_name", "metric", "threshold", "window")),
+            {
+                ("Сделай 10 Забегов!", "runs_finished", 10, None),
+                ("Пробеги 50 километров!", "total_distance", 50, None),
+                ("2 километра за 10 минут!", "total_distance", 2, 600),
+            }
+        )
+
+        earned = set()
+        runs = [(1.5, 300), (1, 900), (0.5, 600), (10, 3000), (12, 3600), (9, 2700), (8, 2400), (7, 2100), (2, 601), (1, 300)]
+        for distance, run_time_seconds in runs:
+            run = self.finish(self.athlete, distance, run_time_seconds)
+            self.assertEqual(self.challenges(self.athlete), self.legacy_challenges(self.athlete, run, earned))
+        self.assertEqual(len(earned), 3)
+
+    def test_runs_rule_fires_past_threshold(self):
+        # Прежняя проверка выдавала челлендж только на ровно десятом забеге, правило - на любом начиная с десятого
+        for _ in range(12):
+            self.finish(self.athlete, 0.1, 60, award=False)
+
+        self.finish(self.athlete, 0.1, 60)
+        self.assertEqual(self.challenges(self.athlete), {"Сделай 10 Забегов!"})
+
+    def test_backfill_matches_awards_and_is_idempotent(self):
+        other = User.objects.create(username="other")
+        runs = [(1.5, 300), (1, 900), (0.5, 600)] + [(6, 1800)] * 8
+        for distance, run_time_seconds in runs:
+            self.finish(self.athlete, distance, run_time_seconds)
+            self.finish(other, distance, run_time_seconds, award=False)
+        awarded = self.challenges(self.athlete)
+
+        rules = list(ChallengeRule.objects.all())
+        self.assertEqual(backfill_challenges(rules, batch_size=2), 3)
+        self.assertEqual(self.challenges(other), awarded)
+
+        self.assertEqual(backfill_challenges(rules, batch_size=2), 0)
+        call_command("backfill_challenges", stdout=io.StringIO())
+        self.assertEqual(Challenge.objects.filter(athlete=other).count(), 3)
+
+    def test_window_limits_run_time(self):
+        rule = ChallengeRule.objects.create(full_name="5 километров за 30 минут!", metric="total_distance", threshold=5, window=1800)
+        for run_time_seconds in [None, 1801]:
+            self.finish(self.athlete, 5, run_time_seconds)
+            self.assertNotIn(rule.full_name, self.challenges(self.athlete))
+
+        self.finish(self.athlete, 1, 1800)
+        self.assertIn(rule.full_name, self.challenges(self.athlete))
+
+        other = User.objects.create(username="other")
+        for distance, run_time_seconds in [(3, 900), (3, 2000), (0.5, 1900)]:
+            self.finish(other, distance, run_time_seconds, award=False)
+        backfill_challenges([rule])
+        self.assertNotIn(rule.full_name, self.challenges(other))
+
+        self.finish(other, 0.5, 1700, award=False)
+        backfill_challenges([rule])
+        self.assertIn(rule.full_name, self.challenges(other))
+
+
+class TableVersionTestCase(TestCase):
+    def test_versions_only_grow(self):
+        versions = [get_table_version("table")]
+        for _ in range(3):
+            bump_table_version("table")
+            versions.append(get_table_version("table"))
+
+        self.assertEqual(versions, sorted(set(versions)))
+
+    def test_summary_follows_changes(self):
+        athlete = User.objects.create(username="athlete")
+        Challenge.objects.create(full_name="first", athlete=athlete)
+        self.assertEqual([row["name_to_display"] for row in get_challenge_summary()], ["first"])
+
+        # Версия повышается в транзакции изменения и видна без кэша процесса
+        Challenge.objects.create(full_name="second", athlete=athlete)
+        with self.assertNumQueries(2):
+            summary = get_challenge_summary()
+        self.assertEqual([row["name_to_display"] for row in summary], ["first", "second"])
+
+
+class ConditionalGetTestCase(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.athlete = User.objects.create(username="athlete")
+
+    def assertNewETagAfter(self, url, change):
+        etag = self.client.get(url)["ETag"]
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, 304)
+
+        change()
+        # Кэш процесса не участвует: так ответ выглядит для воркера, который изменения не делал
+        cache.clear()
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response["ETag"], etag)
+
+    def test_challenge_edit_changes_etag(self):
+        challenge = Challenge.objects.create(full_name="first", athlete=self.athlete)
+
+        def rename():
+            challenge.full_name = "renamed"
+            challenge.save()
+
+        self.assertNewETagAfter("/api/challenges/", rename)
+        self.assertNewETagAfter("/api/challenges_summary/", challenge.delete)
+
+    def test_collectible_item_edit_changes_etag(self):
+        self.assertNewETagAfter("/api/collectible_item/", lambda: CollectibleItem.objects.create(
+            name="item", uid="item", latitude=55.75, longitude=37.61, picture="https://example.com/item.png", value=1
+        ))
+
+    def test_writes_in_same_second_change_last_modified(self):
+        url = "/api/challenges/"
+        # Часы стоят внутри одной секунды, затем отстают: каждая запись всё равно сдвигает Last-Modified
+        for now in [1_700_000_000_250_000_000, 1_700_000_000_750_000_000, 1_600_000_000_000_000_000]:
+            with mock.patch("app_run.utils.time.time_ns", return_value=now):
+                last_modified = self.client.get(url)["Last-Modified"]
+                self.assertEqual(self.client.get(url, HTTP_IF_MODIFIED_SINCE=last_modified).status_code, 304)
+
+                Challenge.objects.create(full_name=f"challenge_{now}", athlete=self.athlete)
+                cache.clear()
+                response = self.client.get(url, HTTP_IF_MODIFIED_SINCE=last_modified)
+            self.assertEqual(response.status_code, 200)
+            self.assertGreater(parse_http_date(response["Last-Modified"]), parse_http_date(last_modified))
+
+
+COLLECTIBLE_ITEM_HEADER = ["name", "uid", "value", "latitude", "longitude", "picture"]
+
+
+def make_collectible_items_file(rows):
+    workbook = openpyxl.Workbook()
+    workbook.active.append(COLLECTIBLE_ITEM_HEADER)
+    for row in rows:
+        workbook.active.append(row)
+    content = io.BytesIO()
+    workbook.save(content)
+    content.seek(0)
+
+    return content
+
+
+class CollectibleItemUploadTestCase(TestCase):
+    rows = [
+        ["ok", "uid_1", 1, 55.1, 37.1, "https://example.com/item.png"],
+        ["bad", "uid_2", 1, 155.1, 37.1, "https://example.com/item.png"],
+        ["ok", "uid_3", 1, 55.1, 37.1, "https://example.com/item.png"],
+        ["bad", "uid_4", "много", 55.1, 237.1, "https://example.com/item.png"],
+        ["ok", "uid_5", 1, 55.1, 37.1, "https://example.com/item.png"],
+    ]
+
+    def upload(self, query=""):
+        file = make_collectible_items_file(self.rows)
+        file.name = "items.xlsx"
+
+        return self.client.post(f"/api/upload_file/{query}", {"file": file})
+
+    def test_invalid_rows_are_returned(self):
+        response = self.upload()
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json(), [self.rows[1], self.rows[3]])
+        self.assertEqual(sorted(CollectibleItem.objects.values_list("uid", flat=True)), ["uid_1", "uid_3", "uid_5"])
+
+    def test_details_report_row_numbers_and_errors(self):
+        response = self.upload("?details=1")
+        self.assertEqual(response.status_code, 200)
+        details = response.json()
+        # Первая строка файла - заголовок
+        self.assertEqual([row["row"] for row in details], [3, 5])
+        self.assertEqual([row["values"] for row in details], [self.rows[1], self.rows[3]])
+        self.assertEqual(set(details[0]["errors"]), {"latitude"})
+        self.assertEqual(set(details[1]["errors"]), {"value", "longitude"})
+
+    def test_missing_file(self):
+        self.assertEqual(self.client.post("/api/upload_file/").status_code, 400)
+
+    def test_chunked_import(self):
+        chunks = []
+        saved, invalid_rows = import_collectible_items(
+            make_collectible_items_file(self.rows), chunk_size=2,
+            on_chunk=lambda rows_processed, invalid_rows: chunks.append((rows_processed, len(invalid_rows)))
+        )
+        self.assertEqual((saved, [row["row"] for row in invalid_rows]), (3, [3, 5]))
+        self.assertEqual(chunks, [(3, 1), (5, 2)])
+        self.assertEqual(CollectibleItem.objects.count(), 3)
+
+    def test_failed_chunk_with_and_without_atomic(self):
+        # Запись второй пачки падает: в одной транзакции пропадает весь файл, без неё остаются сохранённые пачки
+        for atomic, saved in [(True, []), (False, ["uid_1", "uid_3"])]:
+            with self.subTest(atomic=atomic):
+                CollectibleItem.objects.all().delete()
+                calls = []
+
+                def save_items(items):
+                    calls.append(len(items))
+                    if len(calls) > 1:
+                        raise DatabaseError("Нет соединения с базой")
+                    return save_collectible_items(items)
+
+                with mock.patch("app_run.utils.save_collectible_items", side_effect=save_items), \
+                        self.assertRaises(DatabaseError):
+                    import_collectible_items(make_collectible_items_file(self.rows), chunk_size=2, atomic=atomic)
+                self.assertEqual(sorted(CollectibleItem.objects.values_list("uid", flat=True)), saved)
+
+
+class UploadWorkerTestCase(TestCase):
+    def create_job(self, minutes_ago):
+        seen_at = timezone.now() - timedelta(minutes=minutes_ago)
+
+        return UploadJob.objects.create(file="uploads/items.xlsx", status="processing", started_at=seen_at, heartbeat_at=seen_at)
+
+    def test_only_stale_jobs_are_failed(self):
+        # Загрузка другого воркера с недавним сигналом продолжает обрабатываться
+        live = self.create_job(minutes_ago=1)
+        stale = self.create_job(minutes_ago=10)
+
+        call_command("run_upload_worker", once=True, stale_timeout=300, stdout=io.StringIO())
+
+        self.assertEqual(UploadJob.objects.get(pk=live.pk).status, "processing")
+        self.assertEqual(UploadJob.objects.get(pk=stale.pk).status, "failed")
+
+    def test_row_errors_are_saved_with_progress(self):
+        content = make_collectible_items_file([
+            ["bad", "uid_1", 1, 155.1, 37.1, "https://example.com/item.png"],
+            ["ok", "uid_2", 1, 55.1, 37.1, "https://example.com/item.png"],
+            ["ok", "uid_3", 1, 55.1, 37.1, "https://example.com/item.png"],
+        ])
+
+        # Запись второй пачки падает: ошибки строк до неё уже должны быть в загрузке
+        save_error = DatabaseError("Нет соединения с базой")
+        with tempfile.TemporaryDirectory() as media_root, override_settings(MEDIA_ROOT=media_root), \
+                mock.patch("app_run.utils.save_collectible_items", side_effect=[1, save_error]):
+            job = UploadJob.objects.create(file=ContentFile(content.getvalue(), name="items.xlsx"), status="processing")
+            with self.assertRaises(DatabaseError):
+                process_upload_job(job.id, chunk_size=1)
+
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.rows_processed, job.rows_rejected), ("failed", 2, 1))
+        self.assertEqual([error["row"] for error in job.errors], [2])
+
+
+class PositionEditTestCase(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.athlete = User.objects.create(username="athlete")
+
+    def create_run(self, status):
+        run = Run.objects.create(athlete=self.athlete, status="in_progress")
+        started_at = timezone.now()
+        add_positions(run, [
+            Position(latitude=f"{55.75 + i * 0.001:.4f}", longitude="37.6100", date_time=started_at + timedelta(seconds=i * 10))
+            for i in range(3)
+        ])
+        Run.objects.filter(pk=run.pk).update(status=status)
+
+        return Run.objects.get(pk=run.pk)
+
+    def test_finished_run_positions_are_read_only(self):
+        run = self.create_run("finished")
+        pack_run_track(run.id)
+        position = run.positions.order_by("id").first()
+
+        self.assertEqual(self.client.patch(f"/api/positions/{position.id}/", {"latitude": "10.0000"},
+                                           content_type="application/json").status_code, 400)
+        self.assertEqual(self.client.delete(f"/api/positions/{position.id}/").status_code, 400)
+        self.assertTrue(RunTrack.objects.filter(run=run).exists())
+        self.assertEqual(self.client.get(f"/api/positions/?run={run.id}").json()[0]["latitude"], "55.7500")
+
+    def test_edit_refreshes_aggregates(self):
+        run = self.create_run("in_progress")
+        first, _, last = run.positions.order_by("id")
+
+        response = self.client.patch(f"/api/positions/{first.id}/", {"date_time": "2020-01-01T00:00:00"},
+                                     content_type="application/json")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.client.delete(f"/api/positions/{last.id}/").status_code, 204)
+
+        run.refresh_from_db()
+        self.assertEqual(run.positions_count, 2)
+        self.assertEqual(run.first_position_at, datetime(2020, 1, 1, tzinfo=timezone.get_current_timezone()))
+        self.assertEqual(run.last_latitude, Position.objects.filter(run=run).order_by("id").last().latitude)
+
+    def test_direct_create_extends_bounds(self):
+        run = self.create_run("in_progress")
+        position = Position.objects.create(run=run, latitude="55.7400", longitude="37.6100",
+                                           date_time=run.first_position_at - timedelta(days=1))
+
+        run.refresh_from_db()
+        self.assertEqual(run.first_position_at, position.date_time)
+        self.assertEqual(run.positions_count, 4)
+        self.assertIn(position.id, get_run_positions(run.id).values_list("id", flat=True))
+
+    def test_run_positions_follow_time_bounds(self):
+        run = self.create_run("in_progress")
+        other = self.create_run("in_progress")
+        undated = Position.objects.create(run=run, latitude="55.7600", longitude="37.6100")
+        moved = run.positions.order_by("id").first()
+        run_ids = set(run.positions.values_list("id", flat=True))
+
+        self.assertEqual(set(get_run_positions(run.id).values_list("id", flat=True)), run_ids)
+        self.assertIn(undated.id, run_ids)
+        self.assertFalse(run_ids & set(other.positions.values_list("id", flat=True)))
+
+        # Позиция, сдвинутая в обход сигналов, выходит за границы забега, пока их не пересчитают
+        Position.objects.filter(pk=moved.pk).update(date_time=moved.date_time - timedelta(days=1))
+        self.assertEqual(set(get_run_positions(run.id).values_list("id", flat=True)), run_ids - {moved.id})
+        refresh_run_aggregates(run.id)
+        self.assertEqual(set(get_run_positions(run.id).values_list("id", flat=True)), run_ids)
+
+    def test_run_edit_drops_track_and_reads_do_not_pack(self):
+        run = self.create_run("finished")
+
+        self.client.get(f"/api/positions/?run={run.id}")
+        self.assertFalse(RunTrack.objects.filter(run=run).exists())
+
+        pack_run_track(run.id)
+        response = self.client.patch(f"/api/runs/{run.id}/", {"status": "in_progress"}, content_type="application/json")
+        self.assertEqual(response.status_code, 200)
+        self.assertFalse(RunTrack.objects.filter(run=run).exists())
+
+    def test_rows_and_packed_track_share_order(self):
+        run = Run.objects.create(athlete=self.athlete, status="in_progress")
+        started_at = timezone.now()
+        add_positions(run, [
+            Position(latitude=f"{55.75 + i * 0.001:.4f}", longitude=f"{37.61 + (i % 2) * 0.001:.4f}",
+                     date_time=started_at + timedelta(seconds=seconds))
+            for i, seconds in enumerate([0, 30, 10, 20, 40])
+        ])
+        url = f"/api/positions/?run={run.id}"
+
+        rows = self.client.get(url).json()
+        simplified = self.client.get(f"{url}&max_points=3").json()
+        self.assertEqual([position["date_time"] for position in rows], sorted(position["date_time"] for position in rows))
+
+        Run.objects.filter(pk=run.pk).update(status="finished")
+        pack_run_track(run.id)
+        self.assertEqual(self.client.get(url).json(), rows)
+        self.assertEqual(self.client.get(f"{url}&max_points=3").json(), simplified)
+
+
+@skipUnless(connection.vendor == "postgresql", "Секционирование позиций поддерживается только в PostgreSQL")
+class PositionPartitioningTestCase(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.athlete = User.objects.create(username="athlete")
+
+    def setUp(self):
+        self.cursor = connection.cursor()
+        self.addCleanup(self.cursor.close)
+
+    def flush_constraints(self):
+        # Отложенные проверки внешних ключей не дают изменять таблицу позиций в той же транзакции
+        self.cursor.execute("SET CONSTRAINTS ALL IMMEDIATE")
+
+    def create_positions(self, date_times):
+        run = Run.objects.create(athlete=self.athlete, status="in_progress")
+        Position.objects.bulk_create([
+            Position(run=run, latitude="55.7500", longitude="37.6100", date_time=date_time) for date_time in date_times
+        ])
+        self.flush_constraints()
+
+        return run
+
+    def rows(self):
+        return list(Position.objects.order_by("id").values_list("id", "run_id", "date_time", "latitude"))
+
+    def is_partitioned(self):
+        self.cursor.execute("SELECT count(*) FROM pg_partitioned_table WHERE partrelid = %s::regclass", [POSITION_TABLE])
+        return self.cursor.fetchone()[0] == 1
+
+    def partition_of(self, position_id):
+        self.cursor.execute(f'SELECT tableoid::regclass::text FROM "{POSITION_TABLE}" WHERE id = %s', [position_id])
+        return self.cursor.fetchone()[0]
+
+    def month(self, year, month):
+        return datetime(year, month, 1, tzinfo=dt_timezone.utc)
+
+    def test_migration_round_trip_keeps_rows(self):
+        migration = import_module("app_run.migrations.0037_position_partitioning")
+        run = self.create_positions([self.month(2020, 1) + timedelta(days=14), timezone.now(), None])
+        rows = self.rows()
+        self.assertTrue(self.is_partitioned())
+
+        with connection.schema_editor() as schema_editor:
+            migration.unpartition_positions(django_apps, schema_editor)
+        self.assertFalse(self.is_partitioned())
+        self.assertEqual(self.rows(), rows)
+
+        with connection.schema_editor() as schema_editor:
+            migration.partition_positions(django_apps, schema_editor)
+        self.assertTrue(self.is_partitioned())
+        self.assertEqual(self.rows(), rows)
+        self.assertEqual(self.partition_of(rows[0][0]), get_partition_name(self.month(2020, 1)))
+        self.assertEqual(self.partition_of(rows[2][0]), DEFAULT_PARTITION)
+
+        position = Position.objects.create(run=run, latitude="55.7600", longitude="37.6100", date_time=timezone.now())
+        self.assertGreater(position.id, rows[-1][0])
+        self.assertEqual(set(get_run_positions(run.id).values_list("id", flat=True)), {row[0] for row in rows} | {position.id})
+
+    def test_manage_partitions(self):
+        current_month = month_start(timezone.now())
+        call_command("manage_position_partitions", months_ahead=5, stdout=io.StringIO())
+        with connection.cursor() as cursor:
+            partitions = get_partitions(cursor)
+        for months in range(6):
+            self.assertIn(get_partition_name(add_months(current_month, months)), partitions)
+
+        output = io.StringIO()
+        call_command("manage_position_partitions", months_ahead=5, stdout=output)
+        self.assertIn("Создано секций: 0", output.getvalue())
+
+        # Позиция старого месяца лежит в секции по умолчанию и переносится в созданную для него секцию
+        run = self.create_positions([self.month(2020, 1) + timedelta(days=14)])
+        position_id = run.positions.get().id
+        self.assertEqual(self.partition_of(position_id), DEFAULT_PARTITION)
+        ensure_partitions(self.cursor, self.month(2020, 1), self.month(2020, 1))
+        old_partition = get_partition_name(self.month(2020, 1))
+        self.assertEqual(self.partition_of(position_id), old_partition)
+
+        call_command("manage_position_partitions", retain_months=3, drop=True, stdout=io.StringIO())
+        with connection.cursor() as cursor:
+            self.assertNotIn(old_partition, get_partitions(cursor))
+        self.assertFalse(Position.objects.filter(pk=position_id).exists())
+
+    def test_run_positions_read_only_run_partitions(self):
+        ensure_partitions(self.cursor, self.month(2020, 1), self.month(2020, 3))
+        run = Run.objects.create(athlete=self.athlete, status="in_progress")
+        add_positions(run, [
+            Position(latitude="55.7500", longitude="37.6100", date_time=self.month(2020, 2) + timedelta(days=9, minutes=minute))
+            for minute in range(2)
+        ])
+
+        sql, params = get_run_positions(run.id).query.sql_with_params()
+        self.cursor.execute(f"EXPLAIN {sql}", params)
+        plan = "\n".join(row[0] for row in self.cursor.fetchall())
+        self.assertIn(get_partition_name(self.month(2020, 2)), plan)
+        for month in [1, 3]:
+            self.assertNotIn(get_partition_name(self.month(2020, month)), plan)
+
+
+class PartitionCommandTestCase(TestCase):
+    @skipIf(connection.vendor == "postgresql", "Проверяется отказ на базах без секционирования")
+    def test_unsupported_database(self):
+        with self.assertRaises(CommandError):
+            call_command("manage_position_partitions", stdout=io.StringIO())
+
+
+class CursorPaginationTestCase(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.athlete_run = Run.objects.create(athlete=User.objects.create(username="athlete"))
+
+    def test_supported_ordering(self):
+        for ordering in ["created_at", "-created_at,-id"]:
+            response = self.client.get(f"/api/runs/?pagination=cursor&ordering={ordering}")
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.json()["results"][0]["id"], self.athlete_run.id)
+
+    def test_unsupported_params_are_rejected(self):
+        for url in [
+            "/api/runs/?pagination=cursor&ordering=id",
+            "/api/runs/?pagination=cursor&ordering=created_at,-id",
+            "/api/users/?pagination=cursor&ordering=date_joined",
+            f"/api/positions/?run={self.athlete_run.id}&pagination=cursor&tolerance=5",
+            f"/api/positions/?run={self.athlete_run.id}&pagination=cursor&max_points=10",
+        ]:
+            self.assertEqual(self.client.get(url).status_code, 400, url)
+
+
+class MetricsRegistryTestCase(SimpleTestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = Path(directory.name)
+
+    def create_registry(self):
+        registry = MetricsRegistry(self.directory, 60)
+        self.addCleanup(registry.close)
+
+        return registry
+
+    def test_files_of_all_processes_are_summed(self):
+        first, second = self.create_registry(), self.create_registry()
+        first.observe("api/runs/", "GET", 0.01, 100, 2, 0.5)
+        second.observe("api/runs/", "GET", 0.02, 200, 3, 0.25)
+        second.flush()
+
+        series = first.collect()[("api/runs/", "GET")]
+        self.assertEqual(series["queries"]["count"], 2)
+        self.assertEqual(series["queries"]["sum"], 5)
+        self.assertEqual(series["size"]["sum"], 300)
+        self.assertEqual(series["db_time"], 0.75)
+
+    def test_files_of_finished_processes_are_removed(self):
+        registry, closed = self.create_registry(), self.create_registry()
+        closed.flush()
+        closed.close()
+
+        stale_path = self.directory / f"metrics_{os.getpid()}_0.json"
+        stale_path.write_text("[]")
+        os.utime(stale_path, (0, 0))
+        process = subprocess.Popen(["true"])
+        process.wait()
+        (self.directory / f"metrics_{process.pid}_0.json").write_text("[]")
+
+        registry.collect()
+        self.assertEqual([path.name for path in self.directory.iterdir()], [registry.path.name])
+
+    def test_stale_files(self):
+        registry = self.create_registry()
+        registry.flush()
+        self.assertFalse(registry.is_stale(registry.path))
+        self.assertFalse(registry.is_stale(self.directory / "metrics_1_0.json"))
+
+        # Файл без pid в имени устаревает только по времени
+        unnamed = self.directory / "metrics_worker_0.json"
+        unnamed.write_text("[]")
+        self.assertFalse(registry.is_stale(unnamed))
+        os.utime(unnamed, (time.time() - 10 * 60 - 1,) * 2)
+        self.assertTrue(registry.is_stale(unnamed))
+
+        recent = self.directory / f"metrics_{os.getpid()}_0.json"
+        recent.write_text("[]")
+        os.utime(recent, (time.time() - 9 * 60,) * 2)
+        self.assertFalse(registry.is_stale(recent))
+
+    def test_collect_merges_buckets_and_skips_broken_files(self):
+        first, second = self.create_registry(), self.create_registry()
+        first.observe("api/runs/", "GET", 0.01, 100, 0, 0)
+        first.observe("api/runs/", "POST", 0.3, None, 1, 0.1)
+        second.observe("api/runs/", "GET", 3, 20_000, 7, 0.2)
+        second.flush()
+        broken = self.directory / f"metrics_{os.getpid()}_0.json"
+        broken.write_text("[")
+
+        merged = first.collect()
+        self.assertEqual(sorted(merged), [("api/runs/", "GET"), ("api/runs/", "POST")])
+        duration = merged[("api/runs/", "GET")]["duration"]
+        self.assertEqual(duration["buckets"], [0, 1, 1, 1, 1, 1, 1, 1, 1, 2, 2])
+        self.assertEqual((duration["sum"], duration["count"]), (3.01, 2))
+        self.assertEqual(merged[("api/runs/", "POST")]["size"]["count"], 0)
+        self.assertTrue(broken.exists())
+
+        second.close()
+        self.assertEqual(list(first.collect()), [("api/runs/", "GET"), ("api/runs/", "POST")])
+        self.assertEqual(first.collect()[("api/runs/", "GET")]["duration"]["count"], 1)
+
+
+class MetricsMiddlewareTestCase(TestCase):
+    def test_disabled_metrics(self):
+        # Тестовый запуск отключает метрики: запросы не создают реестр, его поток и файл
+        self.assertFalse(settings.METRICS_ENABLED)
+        with mock.patch("app_run.metrics.MetricsRegistry") as registry:
+            self.client.get("/api/runs/")
+            self.assertEqual(self.client.get("/api/metrics/").status_code, 404)
+        registry.assert_not_called()
+
+    def test_enabled_metrics(self):
+        with tempfile.TemporaryDirectory() as directory:
+            with override_settings(METRICS_ENABLED=True, METRICS_DIR=directory):
+                self.client.get("/api/runs/")
+                response = self.client.get("/api/metrics/")
+                self.assertIn('http_request_duration_seconds_count{route="api/runs/$",method="GET"} 1', response.content.decode())
+                self.assertEqual(len(list(Path(directory).glob("metrics_*.json"))), 1)
+
+            # После смены настроек реестр закрыт и удалил свой файл
+            self.assertEqual(list(Path(directory).glob("metrics_*.json")), [])
@@ -0,0 +1,250 @@
+import struct
+import sys
+from array import array
+from datetime import datetime, timedelta, timezone as dt_timezone
+from decimal import Decimal
+
+import numpy as np
+from django.conf import settings
+from django.utils import timezone
+
+from .geo import WGS84_A, WGS84_E2, distances
+
+# Упаковывает позиции законченного забега - кортежи (id, latitude, longitude, date_time, speed, distance),
+# в порядке времени (при равном времени - id). Формат (little-endian):
+#   заголовок - сигнатура, версия, число точек, флаги и базовые значения id, времени (мкс), широты и долготы (1e-4 градуса);
+#   далее столбцы по числу точек: дельты времени (int64, мкс), скорости и дистанции (int32 в сотых долях
+#   или float64, если значения не округлены до сотых), дельты id, широты и долготы (int32).
+# Первая дельта каждого столбца равна нулю. Столбцы по 8 байт идут первыми, чтобы сохранить выравнивание.
+TRACK_MAGIC = b"TRK"
+TRACK_VERSION = 1
+TRACK_HEADER = struct.Struct("<3sBIBxxxqqii")
+
+FLAG_FLOAT_SPEED = 1
+FLAG_FLOAT_DISTANCE = 2
+
+COORDINATE_SCALE = 10_000
+EPOCH = datetime(1970, 1, 1, tzinfo=dt_timezone.utc)
+
+
+def _to_bytes(values):
+    if sys.byteorder == "big":
+        values.byteswap()
+
+    return values.tobytes()
+
+
+def _deltas(values):
+    return [0] + [value - previous for previous, value in zip(values, values[1:])]
+
+
+def _hundredths(values):
+    scaled = [round(value * 100) for value in values]
+    if all(abs(value) < 2 ** 31 and value / 100 == original for value, original in zip(scaled, values)):
+        return scaled
+
+    return None
+
+
+def pack_track(positions):
+    if not positions or any(None in position for position in positions):
+        return None
+
+    ids = [position[0] for position in positions]
+    latitudes = [int(position[1] * COORDINATE_SCALE) for position in positions]
+    longitudes = [int(position[2] * COORDINATE_SCALE) for position in positions]
+    times = [(position[3] - EPOCH) // timedelta(microseconds=1) for position in positions]
+    speeds = [position[4] for position in positions]
+    distances = [position[5] for position in positions]
+
+    flags = 0
+    speed_column = _hundredths(speeds)
+    if speed_column is None:
+        flags |= FLAG_FLOAT_SPEED
+        speed_column = array("d", speeds)
+    else:
+        speed_column = array("i", speed_column)
+
+    distance_column = _hundredths(distances)
+    if distance_column is None:
+        flags |= FLAG_FLOAT_DISTANCE
+        distance_column = array("d", distances)
+    else:
+        distance_column = array("i", distance_column)
+
+    header = TRACK_HEADER.pack(TRACK_MAGIC, TRACK_VERSION, len(positions), flags, ids[0], times[0], latitudes[0], longitudes[0])
+    columns = [
+        array("q", _deltas(times)),
+        *sorted([speed_column, distance_column], key=lambda column: -column.itemsize),
+        array("i", _deltas(ids)),
+        array("i", _deltas(latitudes)),
+        array("i", _deltas(longitudes)),
+    ]
+
+    return header + b"".join(_to_bytes(column) for column in columns)
+
+
+def unpack_track(data):
+    # Столбцы читаются из буфера без копирования, накопленные значения считаются через numpy.
+    view = memoryview(data)
+    magic, version, count, flags, base_id, base_time, base_latitude, base_longitude = TRACK_HEADER.unpack_from(view)
+    if magic != TRACK_MAGIC or version != TRACK_VERSION:
+        raise ValueError("Неизвестный формат трека")
+
+    dtypes = {
+        "times": np.dtype("<i8"),
+        "speeds": np.dtype("<f8" if flags & FLAG_FLOAT_SPEED else "<i4"),
+        "distances": np.dtype("<f8" if flags & FLAG_FLOAT_DISTANCE else "<i4"),
+        "ids": np.dtype("<i4"),
+        "latitudes": np.dtype("<i4"),
+        "longitudes": np.dtype("<i4"),
+    }
+    order = ["times"] + sorted(["speeds", "distances"], key=lambda name: -dtypes[name].itemsize) + \
+        ["ids", "latitudes", "longitudes"]
+
+    columns = {}
+    offset = TRACK_HEADER.size
+    for name in order:
+        columns[name] = np.frombuffer(view, dtype=dtypes[name], count=count, offset=offset)
+        offset += count * dtypes[name].itemsize
+
+    return {
+        "ids": base_id + np.cumsum(columns["ids"], dtype=np.int64),
+        "times": base_time + np.cumsum(columns["times"], dtype=np.int64),
+        "latitudes": base_latitude + np.cumsum(columns["latitudes"], dtype=np.int64),
+        "longitudes": base_longitude + np.cumsum(columns["longitudes"], dtype=np.int64),
+        "speeds": columns["speeds"] if dtypes["speeds"].kind == "f" else columns["speeds"] / 100,
+        "distances": columns["distances"] if dtypes["distances"].kind == "f" else columns["distances"] / 100,
+        "count": count,
+    }
+
+
+def track_coordinates(data):
+    view = memoryview(data)
+    _, _, count, flags, _, _, base_latitude, base_longitude = TRACK_HEADER.unpack_from(view)
+    offset = len(view) - 2 * count * 4
+
+    latitudes = base_latitude + np.cumsum(np.frombuffer(view, dtype="<i4", count=count, offset=offset), dtype=np.int64)
+    longitudes = base_longitude + np.cumsum(np.frombuffer(view, dtype="<i4", count=count, offset=offset + count * 4), dtype=np.int64)
+
+    return latitudes / COORDINATE_SCALE, longitudes / COORDINATE_SCALE
+
+
+def simplification_ranks(latitudes, longitudes):
+    # Ранг точки в алгоритме Дугласа-Пекера: наибольший допуск в метрах, при котором точка остаётся в треке.
+    # Отрезки разбираются по уровням: на каждом уровне расстояния точек всех ещё не разбитых отрезков
+    # до их хорд считаются одним проходом numpy. Каждый уровень - O(n); уровней O(log n) для обычного
+    # трека и до n в худшем случае (каждое разбиение отделяет одну крайнюю точку), то есть O(n²) операций,
+    # но на уровень приходится один проход numpy, а не цикл Python.
+    count = len(latitudes)
+    ranks = np.full(count, np.inf)
+    if count <= 2:
+        return ranks
+
+    lat = np.radians(np.asarray(latitudes, dtype=np.float64))
+    lon = np.radians(np.asarray(longitudes, dtype=np.float64))
+    lat_mid = lat.mean()
+    w = 1 - WGS84_E2 * np.sin(lat_mid) ** 2
+    x = WGS84_A / np.sqrt(w) * np.cos(lat_mid) * (lon - lon[0])
+    y = WGS84_A * (1 - WGS84_E2) / w ** 1.5 * (lat - lat[0])
+
+    starts = np.array([0])
+    ends = np.array([count - 1])
+    parent_ranks = np.array([np.inf])
+    while True:
+        inner = ends - starts - 1
+        split = inner > 0
+        if not split.any():
+            break
+        starts, ends, parent_ranks, inner = starts[split], ends[split], parent_ranks[split], inner[split]
+
+        # Точки всех отрезков уровня подряд: segments - номер отрезка точки, offsets - начало отрезка
+        offsets = np.cumsum(inner) - inner
+        segments = np.repeat(np.arange(len(starts)), inner)
+        points = starts[segments] + 1 + np.arange(len(segments)) - offsets[segments]
+
+        dx, dy = (x[ends] - x[starts])[segments], (y[ends] - y[starts])[segments]
+        px, py = x[points] - x[starts][segments], y[points] - y[starts][segments]
+        length = dx * dx + dy * dy
+        with np.errstate(divide="ignore", invalid="ignore"):
+            t = np.where(length > 0, np.clip((px * dx + py * dy) / length, 0, 1), 0)
+        segment_distances = np.hypot(px - t * dx, py - t * dy)
+
+        # Первая точка с наибольшим расстоянием в каждом отрезке, как у argmax
+        maxima = np.maximum.reduceat(segment_distances, offsets)
+        candidates = np.flatnonzero(segment_distances == maxima[segments])
+        first = candidates[np.unique(segments[candidates], return_index=True)[1]]
+
+        indices = points[first]
+        level_ranks = np.minimum(segment_distances[first], parent_ranks)
+        ranks[indices] = level_ranks
+
+        starts, ends = np.concatenate([starts, indices]), np.concatenate([indices, ends])
+        parent_ranks = np.concatenate([level_ranks, level_ranks])
+
+    return ranks
+
+
+def select_points(ranks, tolerance=None, max_points=None):
+    indices = np.arange(len(ranks))
+    if tolerance is not None:
+        indices = indices[ranks > tolerance]
+
+    if max_points is not None and len(indices) > max_points:
+        top = np.argpartition(-ranks[indices], max_points - 1)[:max_points]
+        indices = np.sort(indices[top])
+
+    return indices.tolist()
+
+
+def track_to_positions(data, run_id, indices=None):
+    track = unpack_track(data)
+    current_timezone = timezone.get_current_timezone()
+
+    if indices is None:
+        indices = slice(None)
+    columns = zip(*(
+        track[name][indices].tolist()
+        for name in ("ids", "times", "latitudes", "longitudes", "speeds", "distances")
+    ))
+
+    return [
+        {
+            "id": position_id,
+            "date_time": (EPOCH + timedelta(microseconds=time)).astimezone(current_timezone).strftime(
+                "%Y-%m-%dT%H:%M:%S.%f"
+            ),
+            "latitude": str(Decimal(latitude).scaleb(-4)),
+            "longitude": str(Decimal(longitude).scaleb(-4)),
+            "speed": speed,
+            "distance": distance,
+            "run": run_id,
+        }
+        for position_id, time, latitude, longitude, speed, distance in columns
+    ]
+
+
+def chain_positions(last_position, positions):
+    # Скорость и дистанция новой позиции считаются от последней по времени позиции забега.
+    # Возвращает новую последнюю позицию и приращения дистанции в метрах.
+    previous_positions = []
+    for position in positions:
+        previous_positions.append(last_position)
+        if last_position is None or position.date_time >= last_position.date_time:
+            last_position = position
+
+    chained = [(position, previous) for position, previous in zip(positions, previous_positions) if previous]
+    dist_diffs = distances(
+        [previous.latitude for _, previous in chained],
+        [previous.longitude for _, previous in chained],
+        [position.latitude for position, _ in chained],
+        [position.longitude for position, _ in chained],
+        settings.TRACK_DISTANCE_MODEL
+    )
+
+    for (position, previous), dist_diff in zip(chained, dist_diffs):
+        time_diff = (position.date_time - previous.date_time).total_seconds()
+        position.speed = round(dist_diff / time_diff, 2) if time_diff else 0
+        position.distance = round(previous.distance + dist_diff / 1000, 2)
+
+    return last_position, dist_diffs
@@ -1,18 +1,555 @@
-from django.db.utils import IntegrityError
+import time
+from concurrent.futures import ThreadPoolExecutor
+from hashlib import md5
+from contextlib import nullcontext
+from datetime import date, datetime, timedelta, timezone as dt_timezone
+from itertools import groupby
+from operator import itemgetter
 
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.db import connection, transaction, IntegrityError
+from django.db.models import Q, F, Count, Sum, Max, Avg, Value, OuterRef, Subquery, DateField
+from django.db.models.functions import Coalesce, Greatest, TruncDay, TruncWeek, TruncMonth
+from django.utils import timezone
+from rest_framework.exceptions import ValidationError
+
+import numpy as np
+import openpyxl
 from geopy.distance import geodesic
 
-from .models import Challenge
+from .geo import get_grid_cell, get_grid_ranges, track_distance, distances
+from .tracks import pack_track, track_coordinates, track_to_positions, simplification_ranks, select_points, chain_positions
+from .models import Run, Challenge, ChallengeRule, Position, CollectibleItem, AthleteStats, Rating, Subscribe, UploadJob, RunTrack, \
+    ActivityRollup, TableVersion
+from .serializers import CollectibleItemSerializer
+from .live import publish_positions, publish_run_finished
+from .buffer import get_position_buffer
 
+COLLECTIBLE_RADIUS = 100
+COLLECTIBLE_MATRIX_SIZE = 1_000_000
+COLLECTIBLE_ITEM_COLUMNS = ["name", "uid", "value", "latitude", "longitude", "picture"]
+TABLE_VERSION_STEP = 1_000_000_000
 
-def create_challenge(challenge_name, user):
-    try:
-        Challenge.objects.create(
-            full_name=challenge_name,
-            athlete=user
+
+# Версии таблиц для кэша сводок и условных GET хранятся в базе, поэтому изменение в одном процессе
+# сразу видят все воркеры. Версия - время изменения в наносекундах, округлённое вверх до секунды,
+# но не меньше прошлой версии плюс секунда, так что она только растёт при любом расхождении часов.
+# Last-Modified точен до секунды: при шаге меньше секунды две записи в одну секунду дали бы одинаковый
+# Last-Modified, и клиент только с If-Modified-Since получил бы устаревший ответ 304. Частые записи
+# уводят версию вперёд часов, это лишь отключает 304 по If-Modified-Since до тех пор, пока часы её не догонят.
+# Сами сводки лежат в кэше процесса под ключом с версией: после изменения ключ другой, и устаревшая
+# запись больше не читается. Повышение версии входит в транзакцию изменения данных.
+def upsert_table_version(table, on_conflict):
+    db_table = TableVersion._meta.db_table
+    version = -(-time.time_ns() // TABLE_VERSION_STEP) * TABLE_VERSION_STEP
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f'INSERT INTO "{db_table}" (name, version) VALUES (%s, %s) ON CONFLICT (name) {on_conflict}',
+            [table, version]
         )
-    except IntegrityError:
-        pass
+
+
+def get_table_version(table):
+    version = TableVersion.objects.filter(name=table).values_list("version", flat=True).first()
+    if version is None:
+        upsert_table_version(table, "DO NOTHING")
+        version = TableVersion.objects.filter(name=table).values_list("version", flat=True).first()
+
+    return version
+
+
+def bump_table_version(table):
+    db_table = TableVersion._meta.db_table
+    upsert_table_version(
+        table,
+        f'DO UPDATE SET version = CASE WHEN excluded.version > "{db_table}".version THEN excluded.version '
+        f'ELSE ("{db_table}".version / {TABLE_VERSION_STEP} + 1) * {TABLE_VERSION_STEP} END'
+    )
+
+
+def get_table_etag(table, version):
+    return f"{table}-{version}"
+
+
+def get_table_last_modified(version):
+    return datetime.fromtimestamp(version / 1e9, tz=dt_timezone.utc)
+
+
+def get_challenge_summary(version=None):
+    cache_key = f"challenge_summary:{version or get_table_version('challenge')}"
+    data = cache.get(cache_key)
+    if data is not None:
+        return data
+
+    challenges = Challenge.objects.order_by("full_name", "id").values_list(
+        "full_name", "athlete_id", "athlete__first_name", "athlete__last_name", "athlete__username"
+    )
+
+    data = []
+    for challenge_name, athletes in groupby(challenges.iterator(), key=itemgetter(0)):
+        data.append({
+            "name_to_display": challenge_name,
+            "athletes": [{"id": athlete[1], "full_name": f"{athlete[2]} {athlete[3]}", "username": athlete[4]} for athlete in athletes]
+        })
+
+    cache.set(cache_key, data, None)
+
+    return data
+
+
+def get_coach_analytics(coach_id):
+    cache_key = f"coach_analytics:{coach_id}:{get_table_version(f'coach_analytics:{coach_id}')}"
+    data = cache.get(cache_key)
+    if data is not None:
+        return data
+
+    athletes = User.objects.filter(subscribers__subscribed_to_id=coach_id).order_by("id").values("id").annotate(
+        runs_finished=Count("runs", filter=Q(runs__status="finished")),
+        longest_run_distance=Max("runs__distance", filter=Q(runs__status="finished")),
+        total_runs_distance=Sum("runs__distance", filter=Q(runs__status="finished")),
+        avg_speed=Avg("runs__speed", filter=Q(runs__status="finished"))
+    )
+
+    longest_run = total_run = speed_avg = None
+    for athlete in athletes:
+        if athlete["longest_run_distance"] is not None and (
+                longest_run is None or athlete["longest_run_distance"] > longest_run["longest_run_distance"]):
+            longest_run = athlete
+        if total_run is None or athlete["runs_finished"] > total_run["runs_finished"]:
+            total_run = athlete
+        if athlete["avg_speed"] is not None and (speed_avg is None or athlete["avg_speed"] > speed_avg["avg_speed"]):
+            speed_avg = athlete
+
+    data = {
+        "longest_run_user": longest_run["id"] if longest_run else None,
+        "longest_run_value": longest_run["longest_run_distance"] if longest_run else None,
+        "total_run_user": total_run["id"] if total_run else None,
+        "total_run_value": total_run["total_runs_distance"] if total_run else None,
+        "speed_avg_user": speed_avg["id"] if speed_avg else None,
+        "speed_avg_value": speed_avg["avg_speed"] if speed_avg else None
+    }
+
+    cache.set(cache_key, data, None)
+
+    return data
+
+
+def invalidate_coach_analytics(athlete_id):
+    for coach_id in Subscribe.objects.filter(subscriber_id=athlete_id).values_list("subscribed_to_id", flat=True):
+        bump_table_version(f"coach_analytics:{coach_id}")
+
+
+def update_athlete_stats(athlete_id, last_activity=None, best_speed=None, **increments):
+    values = {field: F(field) + value for field, value in increments.items()}
+    if last_activity:
+        values["last_activity"] = Greatest(Coalesce("last_activity", Value(last_activity)), Value(last_activity))
+    if best_speed:
+        values["best_speed"] = Greatest(Coalesce("best_speed", Value(best_speed)), Value(best_speed))
+
+    if not AthleteStats.objects.filter(athlete_id=athlete_id).update(**values):
+        create_missing_athlete_stats([athlete_id])
+        AthleteStats.objects.filter(athlete_id=athlete_id).update(**values)
+
+
+def create_missing_athlete_stats(athlete_ids):
+    # Строки статистики пользователей, созданных без сигнала (bulk_create). Счётчики начинаются с нуля,
+    # потому что все приращения идут через update_athlete_stats, а тренер берётся из подписки.
+    coaches = dict(Subscribe.objects.filter(subscriber_id__in=athlete_ids).values_list("subscriber_id", "subscribed_to_id"))
+    AthleteStats.objects.bulk_create([
+        AthleteStats(athlete_id=athlete_id, coach_id=coaches.get(athlete_id)) for athlete_id in athlete_ids
+    ], ignore_conflicts=True)
+
+
+# Вклад законченного забега в статистику атлета, его итоги по периодам и аналитику его тренера.
+# Его поддерживают сигналы модели
+# Run: переход забега в finished прибавляет забег, любое другое изменение вклада (правка или удаление
+# законченного забега, возврат из finished, смена атлета) пересчитывает итоги атлета по его забегам.
+RUN_ACTIVITY_FIELDS = ["athlete_id", "created_at", "distance", "run_time_seconds", "speed", "last_position_at"]
+
+
+def tracks_run_activity(run, update_fields=None):
+    # Сохранение без полей вклада и сохранение незаконченного забега без смены статуса его не меняют,
+    # для них прежний вклад из базы не читается (так сохраняет забег приём позиций)
+    if update_fields is None:
+        return True
+
+    fields = {"athlete", "status"} | set(RUN_ACTIVITY_FIELDS)
+    return bool(fields & set(update_fields)) and ("status" in update_fields or run.status == "finished")
+
+
+def get_run_activity(run):
+    if run.status != "finished":
+        return None
+
+    return tuple(getattr(run, field) for field in RUN_ACTIVITY_FIELDS)
+
+
+def load_run_activity(run):
+    if run._state.adding:
+        return None
+
+    row = Run.objects.filter(pk=run.pk).values_list("status", *RUN_ACTIVITY_FIELDS).first()
+    if row is None or row[0] != "finished":
+        return None
+
+    return row[1:]
+
+
+def apply_run_activity(run, previous):
+    current = get_run_activity(run)
+    if current == previous:
+        return
+
+    if previous is None:
+        update_athlete_stats(
+            run.athlete_id, last_activity=run.last_position_at or run.created_at, best_speed=run.speed, runs_finished=1,
+            total_distance=run.distance or 0
+        )
+        update_rollups(run)
+        invalidate_coach_analytics(run.athlete_id)
+        return
+
+    for athlete_id in sorted({previous[0], run.athlete_id}):
+        refresh_athlete_activity(athlete_id)
+
+
+def refresh_athlete_activity(athlete_id):
+    # Итоги атлета по периодам строятся заново, поля статистики, которые зависят от забегов, считаются
+    # как в rebuild_athlete_stats. rebuild_rollups_chunk блокирует строку статистики до расчёта,
+    # поэтому параллельный финиш забега прибавится к новым значениям.
+    with transaction.atomic():
+        rebuild_rollups_chunk(athlete_id, athlete_id)
+
+        activity = Run.objects.filter(athlete_id=athlete_id, status="finished").aggregate(
+            runs_finished=Count("id"),
+            total_distance=Sum("distance"),
+            last_activity=Max(Coalesce("last_position_at", "created_at")),
+            best_speed=Max("speed", filter=Q(speed__gt=0)),
+        )
+        activity["total_distance"] = activity["total_distance"] or 0
+        AthleteStats.objects.filter(athlete_id=athlete_id).update(**activity)
+        invalidate_coach_analytics(athlete_id)
+
+
+def rebuild_athlete_stats(batch_size=1000):
+    users = User.objects.order_by("id").annotate(
+        runs_finished=Count("runs", filter=Q(runs__status="finished"), distinct=True),
+        total_distance=Sum("runs__distance", filter=Q(runs__status="finished")),
+        last_activity=Max(Coalesce("runs__last_position_at", "runs__created_at"), filter=Q(runs__status="finished")),
+        best_speed=Max("runs__speed", filter=Q(runs__status="finished", runs__speed__gt=0)),
+        # Подзапросы, чтобы соединение с предметами не размножало строки забегов
+        coach_id=Subquery(Subscribe.objects.filter(subscriber_id=OuterRef("id")).values("subscribed_to_id")[:1]),
+        items_value=Subquery(
+            CollectibleItem.users.through.objects.filter(user_id=OuterRef("id")).values("user_id").annotate(
+                items_value=Sum("collectibleitem__value")
+            ).values("items_value")
+        ),
+    )
+    ratings = {
+        rating["rated_id"]: rating
+        for rating in Rating.objects.values("rated_id").annotate(rating_sum=Sum("rating"), rating_count=Count("id"))
+    }
+
+    with transaction.atomic():
+        AthleteStats.objects.all().delete()
+        AthleteStats.objects.bulk_create([
+            AthleteStats(
+                athlete_id=user.id,
+                runs_finished=user.runs_finished,
+                total_distance=user.total_distance or 0,
+                rating_sum=ratings.get(user.id, {}).get("rating_sum", 0),
+                rating_count=ratings.get(user.id, {}).get("rating_count", 0),
+                last_activity=user.last_activity,
+                coach_id=user.coach_id,
+                best_speed=user.best_speed,
+                items_value=user.items_value or 0
+            )
+            for user in users.iterator(chunk_size=batch_size)
+        ], batch_size=batch_size)
+
+
+# Таблицы лидеров строятся по полям AthleteStats, которые обновляются при финише, правке и удалении
+# забега (сигналы модели Run) и находке предмета. В таблицу попадают пользователи с положительным
+# показателем, порядок - по убыванию показателя, при равенстве по id атлета. Каждый запрос - поиск
+# по индексу (показатель, атлет) или (тренер, показатель, атлет): первые N и соседи читаются с позиции
+# в индексе, место - подсчётом записей индекса выше атлета.
+LEADERBOARDS = {
+    "distance": "total_distance",
+    "runs": "runs_finished",
+    "speed": "best_speed",
+    "items": "items_value",
+}
+LEADERBOARD_MAX_LIMIT = 100
+
+
+def get_leaderboard_params(query_params, default_limit=10):
+    coach_id = query_params.get("coach", None)
+    limit = query_params.get("limit", None)
+
+    if coach_id is not None:
+        if not coach_id.isdigit():
+            raise ValidationError({"coach": "id тренера должен быть целым числом"})
+        coach_id = int(coach_id)
+
+    if limit is None:
+        limit = default_limit
+    elif not limit.isdigit() or not 1 <= int(limit) <= LEADERBOARD_MAX_LIMIT:
+        raise ValidationError({"limit": f"Количество мест должно быть целым числом от 1 до {LEADERBOARD_MAX_LIMIT}"})
+
+    return coach_id, int(limit)
+
+
+def get_leaderboard_queryset(field, coach_id=None):
+    queryset = AthleteStats.objects.filter(**{f"{field}__gt": 0})
+    if coach_id is not None:
+        queryset = queryset.filter(coach_id=coach_id)
+
+    return queryset.select_related("athlete")
+
+
+def leaderboard_entry(stats, field, rank):
+    return {
+        "rank": rank,
+        "athlete": stats.athlete_id,
+        "username": stats.athlete.username,
+        "first_name": stats.athlete.first_name,
+        "last_name": stats.athlete.last_name,
+        "value": getattr(stats, field)
+    }
+
+
+def get_leaderboard_top(board, coach_id=None, limit=10):
+    field = LEADERBOARDS[board]
+    top = get_leaderboard_queryset(field, coach_id).order_by(f"-{field}", "athlete_id")[:limit]
+
+    return [leaderboard_entry(stats, field, rank) for rank, stats in enumerate(top, start=1)]
+
+
+def get_leaderboard_rank(queryset, field, stats):
+    value = getattr(stats, field)
+
+    return (
+        queryset.filter(**{f"{field}__gt": value}).count()
+        + queryset.filter(**{field: value, "athlete_id__lt": stats.athlete_id}).count()
+        + 1
+    )
+
+
+def get_leaderboard_stats(board, athlete_id, coach_id=None):
+    field = LEADERBOARDS[board]
+    queryset = get_leaderboard_queryset(field, coach_id)
+    stats = queryset.filter(athlete_id=athlete_id).first()
+    if stats is None:
+        return None
+
+    return leaderboard_entry(stats, field, get_leaderboard_rank(queryset, field, stats))
+
+
+def get_leaderboard_around(board, athlete_id=None, rank=None, coach_id=None, size=5):
+    # Центр - атлет или место. Соседи выше и ниже читаются двумя запросами в каждую сторону:
+    # сначала атлеты с тем же значением, затем со строго большим или меньшим, чтобы каждый
+    # запрос был поиском по индексу без смешанных направлений сортировки.
+    field = LEADERBOARDS[board]
+    queryset = get_leaderboard_queryset(field, coach_id)
+    if athlete_id is not None:
+        stats = queryset.filter(athlete_id=athlete_id).first()
+        if stats is None:
+            return None
+        rank = get_leaderboard_rank(queryset, field, stats)
+    else:
+        stats = queryset.order_by(f"-{field}", "athlete_id")[rank - 1:rank].first()
+        if stats is None:
+            return None
+
+    value = getattr(stats, field)
+    above = list(queryset.filter(**{field: value, "athlete_id__lt": stats.athlete_id}).order_by("-athlete_id")[:size])
+    if len(above) < size:
+        above += queryset.filter(**{f"{field}__gt": value}).order_by(field, "-athlete_id")[:size - len(above)]
+    below = list(queryset.filter(**{field: value, "athlete_id__gt": stats.athlete_id}).order_by("athlete_id")[:size])
+    if len(below) < size:
+        below += queryset.filter(**{f"{field}__lt": value}).order_by(f"-{field}", "athlete_id")[:size - len(below)]
+
+    return (
+        [leaderboard_entry(row, field, rank - offset) for offset, row in reversed(list(enumerate(above, start=1)))]
+        + [leaderboard_entry(stats, field, rank)]
+        + [leaderboard_entry(row, field, rank + offset) for offset, row in enumerate(below, start=1)]
+    )
+
+
+# Итоги атлетов по дням, неделям (с понедельника) и месяцам по дате создания забега в текущем часовом
+# поясе. Финиш забега прибавляет его к трём строкам итогов, правка или удаление законченного забега
+# и пересчёт строят итоги атлета заново по забегам.
+ROLLUP_TRUNCS = {
+    "day": TruncDay,
+    "week": TruncWeek,
+    "month": TruncMonth,
+}
+
+
+def get_rollup_periods(day):
+    return {
+        "day": day,
+        "week": day - timedelta(days=day.weekday()),
+        "month": day.replace(day=1),
+    }
+
+
+def update_rollups(run):
+    # Одна вставка с прибавлением к существующим строкам для всех периодов забега.
+    # Синтаксис ON CONFLICT общий для PostgreSQL и SQLite.
+    table = ActivityRollup._meta.db_table
+    periods = get_rollup_periods(timezone.localtime(run.created_at).date())
+    params = [
+        value
+        for bucket, period_start in periods.items()
+        for value in [run.athlete_id, bucket, period_start.isoformat(), 1, run.distance or 0, int(run.run_time_seconds or 0)]
+    ]
+
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f'INSERT INTO "{table}" (athlete_id, bucket, period_start, runs, distance, run_time_seconds) '
+            f'VALUES {", ".join(["(%s, %s, %s, %s, %s, %s)"] * len(periods))} '
+            f'ON CONFLICT (athlete_id, bucket, period_start) DO UPDATE SET '
+            f'runs = "{table}".runs + excluded.runs, '
+            f'distance = "{table}".distance + excluded.distance, '
+            f'run_time_seconds = "{table}".run_time_seconds + excluded.run_time_seconds',
+            params
+        )
+
+
+def rebuild_rollups_chunk(first_athlete_id, last_athlete_id):
+    # Статистика атлетов блокируется до расчёта: финиш забега обновляет её раньше итогов, поэтому
+    # он либо ждёт пересчёта и прибавляет забег к новым строкам, либо попадает в расчёт целиком.
+    # Недостающие строки статистики сначала создаются, иначе финиш забега такого атлета не ждал бы пересчёта.
+    athlete_range = {"athlete_id__gte": first_athlete_id, "athlete_id__lte": last_athlete_id}
+    with transaction.atomic():
+        create_missing_athlete_stats(list(User.objects.filter(
+            id__gte=first_athlete_id, id__lte=last_athlete_id, stats__isnull=True
+        ).values_list("id", flat=True)))
+        list(AthleteStats.objects.select_for_update().filter(**athlete_range).values_list("id", flat=True))
+
+        runs = Run.objects.filter(status="finished", **athlete_range)
+        rollups = []
+        for bucket, trunc in ROLLUP_TRUNCS.items():
+            rows = runs.annotate(period_start=trunc("created_at", output_field=DateField())).order_by().values(
+                "athlete_id", "period_start"
+            ).annotate(runs_count=Count("id"), distance_sum=Sum("distance"), run_time_sum=Sum("run_time_seconds"))
+            rollups += [
+                ActivityRollup(
+                    athlete_id=row["athlete_id"],
+                    bucket=bucket,
+                    period_start=row["period_start"],
+                    runs=row["runs_count"],
+                    distance=row["distance_sum"] or 0,
+                    run_time_seconds=row["run_time_sum"] or 0
+                )
+                for row in rows
+            ]
+
+        ActivityRollup.objects.filter(**athlete_range).delete()
+        ActivityRollup.objects.bulk_create(rollups, batch_size=1000)
+
+    return len(rollups)
+
+
+def _rebuild_rollups_chunk(athlete_range):
+    try:
+        return rebuild_rollups_chunk(*athlete_range)
+    finally:
+        # У каждого потока своё соединение с базой
+        connection.close()
+
+
+def rebuild_rollups(chunk_size=1000, workers=4):
+    athlete_ids = list(User.objects.order_by("id").values_list("id", flat=True))
+    chunks = [
+        (athlete_ids[start], athlete_ids[min(start + chunk_size, len(athlete_ids)) - 1])
+        for start in range(0, len(athlete_ids), chunk_size)
+    ]
+    if workers <= 1:
+        return sum(rebuild_rollups_chunk(*chunk) for chunk in chunks)
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        return sum(executor.map(_rebuild_rollups_chunk, chunks))
+
+
+def get_history_params(query_params):
+    bucket = query_params.get("bucket", "week")
+    if bucket not in ROLLUP_TRUNCS:
+        raise ValidationError({"bucket": f"Период должен быть одним из: {', '.join(ROLLUP_TRUNCS)}"})
+
+    dates = []
+    for name in ["from", "to"]:
+        value = query_params.get(name, None)
+        if value is not None:
+            try:
+                value = date.fromisoformat(value)
+            except ValueError:
+                raise ValidationError({name: "Дата должна быть в формате ГГГГ-ММ-ДД"})
+        dates.append(value)
+
+    return bucket, *dates
+
+
+def get_athlete_history(athlete_id, bucket, date_from=None, date_to=None):
+    rollups = ActivityRollup.objects.filter(athlete_id=athlete_id, bucket=bucket)
+    if date_from:
+        rollups = rollups.filter(period_start__gte=get_rollup_periods(date_from)[bucket])
+    if date_to:
+        rollups = rollups.filter(period_start__lte=date_to)
+
+    return rollups.order_by("period_start")
+
+
+def award_challenges(run):
+    stats = AthleteStats.objects.get(athlete_id=run.athlete_id)
+    earned = Challenge.objects.filter(athlete_id=run.athlete_id).values("full_name")
+    rules = ChallengeRule.objects.exclude(full_name__in=earned)
+
+    challenges = [Challenge(full_name=rule.full_name, athlete_id=run.athlete_id) for rule in rules if rule.is_achieved(stats, run)]
+    if challenges:
+        Challenge.objects.bulk_create(challenges, ignore_conflicts=True)
+        bump_table_version("challenge")
+
+    return challenges
+
+
+def backfill_challenges(rules, batch_size=1000):
+    rule_names = [rule.full_name for rule in rules]
+    earned = set(Challenge.objects.filter(full_name__in=rule_names).values_list("athlete_id", "full_name"))
+    runs = Run.objects.filter(status="finished").order_by("athlete_id", "created_at", "id").values_list(
+        "athlete_id", "distance", "run_time_seconds"
+    )
+
+    challenges = []
+    awarded = 0
+    stats = AthleteStats()
+    current_athlete_id = None
+    for athlete_id, distance, run_time_seconds in runs.iterator(chunk_size=batch_size):
+        if athlete_id != current_athlete_id:
+            stats = AthleteStats(athlete_id=athlete_id)
+            current_athlete_id = athlete_id
+
+        stats.runs_finished += 1
+        stats.total_distance += distance or 0
+        run = Run(athlete_id=athlete_id, distance=distance, run_time_seconds=run_time_seconds)
+
+        for rule in rules:
+            if (athlete_id, rule.full_name) not in earned and rule.is_achieved(stats, run):
+                earned.add((athlete_id, rule.full_name))
+                challenges.append(Challenge(full_name=rule.full_name, athlete_id=athlete_id))
+
+        if len(challenges) >= batch_size:
+            Challenge.objects.bulk_create(challenges, ignore_conflicts=True)
+            awarded += len(challenges)
+            challenges = []
+
+    Challenge.objects.bulk_create(challenges, ignore_conflicts=True)
+    bump_table_version("challenge")
+
+    return awarded + len(challenges)
 
 
 def check_weight(weight):
@@ -25,13 +562,396 @@ def check_weight(weight):
     return False
 
 
-def calculate_distance(coords):
-    total_distance_km = 0
+def add_positions(run, positions):
+    with transaction.atomic():
+        run = Run.objects.select_for_update().get(pk=run.pk)
+        if run.status != "in_progress":
+            raise ValidationError({"run": ["Забег должен быть в процессе"]})
+
+        for position in positions:
+            position.run = run
+        last_position, dist_diffs = chain_positions(run.get_last_position(), positions)
+
+        Position.objects.bulk_create(positions)
+
+        date_times = [position.date_time for position in positions]
+        if run.first_position_at:
+            date_times.append(run.first_position_at)
+
+        run.positions_count += len(positions)
+        run.positions_distance += float(dist_diffs.sum()) / 1000
+        run.speed_sum += sum(position.speed for position in positions)
+        run.first_position_at = min(date_times)
+        run.last_position_at = last_position.date_time
+        run.last_latitude = last_position.latitude
+        run.last_longitude = last_position.longitude
+        run.last_position_distance = last_position.distance
+        run.save(update_fields=[
+            "positions_count", "positions_distance", "speed_sum", "first_position_at", "last_position_at",
+            "last_latitude", "last_longitude", "last_position_distance"
+        ])
+        publish_positions(run, positions)
+
+    return positions
+
+
+def finish_run(run):
+    # Дистанция накоплена в порядке приёма позиций: каждая новая позиция прибавляет отрезок от последней
+    # по времени позиции забега. Позиция из прошлого не встраивается между соседями по времени, поэтому
+    # при нарушенном порядке дистанция отличается от пересчёта по отсортированным позициям.
+    run.status = "finished"
+    if run.positions_count > 1:
+        run.distance = round(run.positions_distance, 2)
+
+        # У старых позиций время может быть не указано
+        run_time = None
+        if run.first_position_at and run.last_position_at:
+            run_time = (run.last_position_at - run.first_position_at).total_seconds()
+        run.run_time_seconds = run_time if run_time else 0
+
+        run.speed = round(run.speed_sum / run.positions_count, 2)
+
+    run.save()
+
+
+def save_positions(run, positions):
+    if settings.POSITION_WRITE_BEHIND:
+        return get_position_buffer().add(run, positions)
+
+    return add_positions(run, positions)
+
+
+def stop_run(run_id):
+    # Позиции забега из буфера должны попасть в базу до подсчёта итогов
+    if settings.POSITION_WRITE_BEHIND:
+        get_position_buffer().flush()
+
+    with transaction.atomic():
+        run = Run.objects.select_for_update().filter(pk=run_id).first()
+        if run is None or run.status != "in_progress":
+            return run, False
+
+        # Статистику, итоги по периодам и аналитику тренера обновляет сигнал сохранения забега
+        finish_run(run)
+        pack_run_track(run.id)
+        award_challenges(run)
+        publish_run_finished(run)
+
+    if settings.POSITION_WRITE_BEHIND:
+        get_position_buffer().forget(run.id)
+
+    return run, True
+
+
+def record_position(position):
+    save_positions(position.run, [position])
+
+    position_coords = (position.latitude, position.longitude)
+    collectible_items = get_nearby_collectible_items([position_coords])
+
+    return find_collectible_items(position.run.athlete_id, [position_coords], collectible_items)[0]
+
+
+def get_collectible_candidates(coords_list, collectible_items):
+    # Предметы в радиусе каждой позиции, в порядке collectible_items. Пары позиция-предмет отбираются
+    # матрицей расстояний гаверсинусов (погрешность не более 0.6 %, отбор с запасом) по блокам позиций,
+    # точный geodesic считается только для отобранных пар.
+    candidates = [[] for _ in coords_list]
+    if not coords_list or not collectible_items:
+        return candidates
+
+    latitudes = np.array([float(latitude) for latitude, _ in coords_list])
+    longitudes = np.array([float(longitude) for _, longitude in coords_list])
+    item_latitudes = np.array([float(collectible.latitude) for collectible in collectible_items])
+    item_longitudes = np.array([float(collectible.longitude) for collectible in collectible_items])
+
+    block = max(1, COLLECTIBLE_MATRIX_SIZE // len(collectible_items))
+    for start in range(0, len(coords_list), block):
+        near = distances(
+            latitudes[start:start + block, None], longitudes[start:start + block, None],
+            item_latitudes[None, :], item_longitudes[None, :], "haversine"
+        ) <= COLLECTIBLE_RADIUS * 1.01
+
+        for point, item in zip(*np.nonzero(near)):
+            coords = coords_list[start + point]
+            collectible = collectible_items[item]
+            if geodesic(coords, (collectible.latitude, collectible.longitude)).meters <= COLLECTIBLE_RADIUS:
+                candidates[start + point].append(collectible)
+
+    return candidates
+
+
+def find_collectible_items(user_id, coords_list, collectible_items):
+    # Для каждой позиции - первый предмет в радиусе, которого у атлета ещё нет. Владение проверяется
+    # одним запросом к промежуточной таблице по индексу (предмет, атлет) только для предметов в радиусе,
+    # поэтому число владельцев предмета и размер каталога не влияют на приём позиций.
+    collectible_items = [
+        collectible for collectible in collectible_items
+        if -90 <= collectible.latitude <= 90 and -180 <= collectible.longitude <= 180
+    ]
+    candidates = get_collectible_candidates(coords_list, collectible_items)
+
+    candidate_ids = {collectible.id for collectibles in candidates for collectible in collectibles}
+    if not candidate_ids:
+        return [None] * len(coords_list)
+
+    owned_ids = set(CollectibleItem.users.through.objects.filter(
+        user_id=user_id, collectibleitem_id__in=candidate_ids
+    ).values_list("collectibleitem_id", flat=True))
+
+    found = []
+    for collectibles in candidates:
+        collectible = None
+        for candidate in collectibles:
+            if candidate.id in owned_ids:
+                continue
+            owned_ids.add(candidate.id)
+            if award_collectible_item(user_id, candidate):
+                collectible = candidate
+                break
+        found.append(collectible)
+
+    return found
+
+
+def award_collectible_item(user_id, collectible):
+    # Предмет и его ценность засчитываются вместе. Если предмет уже выдан параллельным запросом,
+    # вставка упирается в уникальный индекс и статистика не меняется.
+    try:
+        with transaction.atomic():
+            CollectibleItem.users.through.objects.create(collectibleitem_id=collectible.id, user_id=user_id)
+            update_athlete_stats(user_id, items_value=collectible.value)
+    except IntegrityError:
+        return False
+
+    return True
+
+
+def get_run_positions(run_id):
+    # Границы забега по времени позволяют PostgreSQL читать только секции позиций этого забега.
+    # Они должны покрывать время всех позиций забега: add_positions и буфер расширяют их при вставке,
+    # refresh_run_aggregates пересчитывает после правки и удаления, сигнал position_saved вызывает его
+    # для позиций, сохранённых по одной. Позиции, записанные в обход этих путей (update(), сырой SQL),
+    # нужно досчитать через refresh_run_aggregates.
+    bounds = Run.objects.filter(pk=run_id).values_list("first_position_at", "last_position_at").first()
+    positions = Position.objects.filter(run_id=run_id)
+    if bounds and bounds[0] and bounds[1]:
+        positions = positions.filter(Q(date_time__range=bounds) | Q(date_time__isnull=True))
 
-    if len(coords) > 1:
-        for i in range(len(coords) - 1):
-            coord_1 = coords[i]
-            coord_2 = coords[i + 1]
-            total_distance_km += geodesic(coord_1, coord_2).km
+    return positions
+
+
+def pack_run_track(run_id):
+    positions = get_run_positions(run_id).order_by("date_time", "id").values_list(
+        "id", "latitude", "longitude", "date_time", "speed", "distance"
+    )
+    data = pack_track(list(positions))
+    if data is None:
+        return None
+
+    RunTrack.objects.update_or_create(run_id=run_id, defaults={"points_count": len(positions), "data": data})
+
+    return data
+
+
+def refresh_run_aggregates(run_id):
+    # Итоги забега пересчитываются по всем его позициям после правки или удаления отдельной позиции.
+    # Дистанция считается по позициям, упорядоченным по времени; скорость и дистанция самих позиций
+    # не пересчитываются. Упакованный трек забега удаляется.
+    with transaction.atomic():
+        run = Run.objects.select_for_update().filter(pk=run_id).first()
+        if run is None:
+            return
+
+        positions = list(Position.objects.filter(run_id=run_id).order_by("date_time", "id").values_list(
+            "latitude", "longitude", "date_time", "speed", "distance"
+        ))
+        date_times = [position[2] for position in positions if position[2] is not None]
+        last_position = positions[-1] if positions else (None, None, None, None, 0)
+
+        run.positions_count = len(positions)
+        run.positions_distance = track_distance([position[:2] for position in positions], settings.TRACK_DISTANCE_MODEL)
+        run.speed_sum = sum(position[3] or 0 for position in positions)
+        run.first_position_at = min(date_times, default=None)
+        run.last_position_at = max(date_times, default=None)
+        run.last_latitude = last_position[0]
+        run.last_longitude = last_position[1]
+        run.last_position_distance = last_position[4] or 0
+        run.save(update_fields=[
+            "positions_count", "positions_distance", "speed_sum", "first_position_at", "last_position_at",
+            "last_latitude", "last_longitude", "last_position_distance"
+        ])
+        RunTrack.objects.filter(run_id=run_id).delete()
+
+
+def get_simplification_params(query_params):
+    tolerance = query_params.get("tolerance", None)
+    max_points = query_params.get("max_points", None)
+
+    if tolerance is not None:
+        try:
+            tolerance = float(tolerance)
+        except ValueError:
+            tolerance = None
+        if tolerance is None or not 0 <= tolerance < float("inf"):
+            raise ValidationError({"tolerance": "Допуск должен быть неотрицательным числом метров"})
+
+    if max_points is not None:
+        if not max_points.isdigit() or int(max_points) < 2:
+            raise ValidationError({"max_points": "Количество точек должно быть целым числом не меньше 2"})
+        max_points = int(max_points)
+
+    return tolerance, max_points
+
+
+def get_track_ranks(data):
+    # Ранги точек подходят для любого допуска и количества точек. Ключ кэша - хэш упакованного трека,
+    # поэтому после перепаковки в любом процессе читаются ранги нового трека.
+    cache_key = f"track_ranks:{md5(data).hexdigest()}"
+    ranks = cache.get(cache_key)
+    if ranks is None:
+        ranks = simplification_ranks(*track_coordinates(data)).tobytes()
+        cache.set(cache_key, ranks, None)
+
+    return np.frombuffer(ranks)
+
+
+def get_track_positions(run_id, tolerance=None, max_points=None):
+    # Трек упаковывается при остановке забега, забеги, законченные другим путём, упаковывает manage.py pack_tracks.
+    # Чтение ничего не записывает: пока трек не упакован, позиции читаются из строк. Строки позиций остаются
+    # и после упаковки - по ним работают курсорная пагинация, чтение позиции по id и пересчёт итогов забега,
+    # если его вернули из finished; трек - копия для быстрого чтения, а не замена строк.
+    data = RunTrack.objects.filter(run_id=run_id).values_list("data", flat=True).first()
+    if data is None:
+        return None
+
+    indices = None
+    if tolerance is not None or max_points is not None:
+        indices = select_points(get_track_ranks(data), tolerance, max_points)
+
+    return track_to_positions(data, int(run_id), indices)
+
+
+def simplify_positions(positions, tolerance=None, max_points=None):
+    ranks = simplification_ranks(
+        [float(position["latitude"]) for position in positions],
+        [float(position["longitude"]) for position in positions]
+    )
+
+    return [positions[index] for index in select_points(ranks, tolerance, max_points)]
+
+
+def get_nearby_collectible_items(coords_list):
+    lat_range, lon_ranges = get_grid_ranges(coords_list, COLLECTIBLE_RADIUS)
+
+    lon_filter = Q()
+    for lon_range in lon_ranges:
+        lon_filter |= Q(grid_longitude__range=lon_range)
+
+    return CollectibleItem.objects.filter(lon_filter, grid_latitude__range=lat_range).order_by("id")
+
+
+def validate_collectible_item_row(serializer, row):
+    data = {}
+    errors = {}
+    for field_name, value in zip(COLLECTIBLE_ITEM_COLUMNS, row):
+        try:
+            value = serializer.fields[field_name].run_validation(value)
+            validate_method = getattr(serializer, f"validate_{field_name}", None)
+            data[field_name] = validate_method(value) if validate_method else value
+        except ValidationError as exc:
+            errors[field_name] = exc.detail
+
+    return data, errors
+
+
+def save_collectible_items(items):
+    for item in items:
+        item.grid_latitude, item.grid_longitude = get_grid_cell(item.latitude, item.longitude)
+
+    CollectibleItem.objects.bulk_create(items)
+    bump_table_version("collectible_item")
+
+    return len(items)
+
+
+def import_collectible_items(file, chunk_size=1000, atomic=True, on_chunk=None):
+    serializer = CollectibleItemSerializer()
+    workbook = openpyxl.load_workbook(file, read_only=True)
+    rows_processed = 0
+    invalid_rows = []
+
+    try:
+        with transaction.atomic() if atomic else nullcontext():
+            items = []
+            rows = workbook.active.iter_rows(min_row=2, values_only=True)
+            for row_number, row in enumerate(rows, start=2):
+                rows_processed += 1
+                row = (tuple(row) + (None,) * len(COLLECTIBLE_ITEM_COLUMNS))[:len(COLLECTIBLE_ITEM_COLUMNS)]
+                data, errors = validate_collectible_item_row(serializer, row)
+                if errors:
+                    invalid_rows.append({"row": row_number, "values": list(row), "errors": errors})
+                    continue
+
+                items.append(CollectibleItem(**data))
+                if len(items) >= chunk_size:
+                    save_collectible_items(items)
+                    items = []
+                    if on_chunk:
+                        on_chunk(rows_processed, invalid_rows)
+
+            save_collectible_items(items)
+            if on_chunk:
+                on_chunk(rows_processed, invalid_rows)
+    finally:
+        workbook.close()
+
+    return rows_processed - len(invalid_rows), invalid_rows
+
+
+def claim_upload_job():
+    for job_id in UploadJob.objects.filter(status="pending").order_by("id").values_list("id", flat=True)[:10]:
+        now = timezone.now()
+        if UploadJob.objects.filter(pk=job_id, status="pending").update(status="processing", started_at=now, heartbeat_at=now):
+            return job_id
+
+    return None
+
+
+def touch_upload_jobs(job_ids):
+    UploadJob.objects.filter(pk__in=job_ids, status="processing").update(heartbeat_at=timezone.now())
+
+
+def fail_stale_upload_jobs(timeout):
+    # Воркер обновляет heartbeat_at своих загрузок на каждом цикле. Загрузка без сигнала дольше timeout
+    # секунд осталась от остановленного или упавшего воркера, живые загрузки других воркеров не трогаются
+    stale_at = timezone.now() - timedelta(seconds=timeout)
+
+    return UploadJob.objects.filter(
+        Q(heartbeat_at__lt=stale_at) | Q(heartbeat_at__isnull=True, started_at__lt=stale_at),
+        status="processing"
+    ).update(status="failed", message="Обработка прервана: воркер перестал отвечать", finished_at=timezone.now())
+
+
+def process_upload_job(job_id, chunk_size=1000):
+    job = UploadJob.objects.get(pk=job_id)
+    jobs = UploadJob.objects.filter(pk=job_id, status="processing")
+    saved_errors = 0
+
+    def save_progress(rows_processed, invalid_rows):
+        # Ошибки строк сохраняются вместе с прогрессом, только когда их стало больше
+        nonlocal saved_errors
+        values = {"rows_processed": rows_processed, "rows_rejected": len(invalid_rows)}
+        if len(invalid_rows) > saved_errors:
+            values["errors"] = invalid_rows
+            saved_errors = len(invalid_rows)
+        jobs.update(**values)
+
+    try:
+        with job.file.open("rb") as file:
+            _, invalid_rows = import_collectible_items(file, chunk_size=chunk_size, atomic=False, on_chunk=save_progress)
+    except Exception as exc:
+        jobs.update(status="failed", message=str(exc), finished_at=timezone.now())
+        raise
 
-    return total_distance_km
+    jobs.update(status="finished", errors=invalid_rows, finished_at=timezone.now())
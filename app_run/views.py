@@ -1,27 +1,59 @@
+from hashlib import md5
+
 from django.conf import settings
 from django.contrib.auth.models import User
-from django.db.models import Sum, Min, Max, Q, Count, Avg
+from django.db import transaction
+from django.db.models import OuterRef, Prefetch, Subquery, prefetch_related_objects
+from django.http import Http404, HttpResponse
 from django.shortcuts import get_object_or_404
+from django.utils.decorators import method_decorator
+from django.views.decorators.http import condition
 from rest_framework import viewsets, status
 from rest_framework.generics import ListAPIView
 from rest_framework.views import APIView
-from rest_framework.decorators import api_view
+from rest_framework.decorators import api_view, action
+from rest_framework.exceptions import ValidationError
 from rest_framework.response import Response
 from rest_framework.filters import SearchFilter, OrderingFilter
-from rest_framework.pagination import PageNumberPagination
 
-import openpyxl
-from geopy.distance import geodesic
 from django_filters.rest_framework import DjangoFilterBackend
 
-from .models import Run, AthleteInfo, Challenge, Position, CollectibleItem, Subscribe, Rating
+from .metrics import get_registry, render_metrics
+from .models import Run, AthleteInfo, Challenge, Position, CollectibleItem, Subscribe, Rating, UploadJob, RunTrack
+from .pagination import RunPagination, PositionPagination, UserPagination, is_cursor_request
 from .serializers import RunSerializer, UserSerializer, UserDetailSerializer, CoachDetailSerializer, ChallengeSerializer, \
-    PositionSerializer, \
-    CollectibleItemSerializer, RatingSerializer
-from .utils import create_challenge, check_weight, calculate_distance
+    PositionSerializer, PositionBatchSerializer, CollectibleItemSerializer, RatingSerializer, UploadJobSerializer, \
+    RunValuesSerializer, UserValuesSerializer, ActivityRollupSerializer
+from .utils import get_challenge_summary, get_coach_analytics, check_weight, stop_run, record_position, \
+    save_positions, update_athlete_stats, find_collectible_items, get_nearby_collectible_items, \
+    import_collectible_items, get_track_positions, get_simplification_params, simplify_positions, get_table_version, \
+    get_table_etag, get_table_last_modified, get_run_positions, get_leaderboard_params, get_leaderboard_top, \
+    get_leaderboard_stats, get_leaderboard_around, LEADERBOARDS, get_history_params, get_athlete_history, \
+    refresh_run_aggregates
+
+
+def table_condition(table):
+    # Ответ 304 по версии таблицы, без основного запроса и сериализации.
+    # Версия читается из базы один раз на запрос и общая для ETag и Last-Modified
+    def get_version(request):
+        versions = request.__dict__.setdefault("table_versions", {})
+        if table not in versions:
+            versions[table] = get_table_version(table)
+
+        return versions[table]
+
+    return condition(
+        etag_func=lambda request, *args, **kwargs: get_table_etag(table, get_version(request)),
+        last_modified_func=lambda request, *args, **kwargs: get_table_last_modified(get_version(request))
+    )
+
+
+def company_details_etag(request):
+    return md5("\n".join([settings.SITE_TITLE, settings.SITE_SLOGAN, settings.SITE_CONTACTS]).encode()).hexdigest()
 
 
 @api_view(["GET"])
+@condition(etag_func=company_details_etag)
 def company_details_view(request):
     return Response({
         "company_name": settings.SITE_TITLE,
@@ -30,18 +62,34 @@ def company_details_view(request):
     })
 
 
-class SizePagination(PageNumberPagination):
-    page_size_query_param = "size"
+class ValuesListMixin:
+    values_serializer_class = None
+
+    def list(self, request, *args, **kwargs):
+        rows = self.values_serializer_class.get_rows(self.filter_queryset(self.get_queryset()))
+
+        page = self.paginate_queryset(rows)
+        if page is not None:
+            return self.get_paginated_response(self.values_serializer_class(page).data)
 
+        return Response(self.values_serializer_class(rows).data)
 
-class RunViewSet(viewsets.ModelViewSet):
+
+class RunViewSet(ValuesListMixin, viewsets.ModelViewSet):
     queryset = Run.objects.all().select_related("athlete")
     serializer_class = RunSerializer
-    pagination_class = SizePagination
+    values_serializer_class = RunValuesSerializer
+    pagination_class = RunPagination
     filter_backends = [DjangoFilterBackend, OrderingFilter]
     filterset_fields = ["status", "athlete"]
     ordering_fields = ["created_at"]
 
+    def perform_update(self, serializer):
+        # После смены статуса упакованный трек может не совпадать с позициями забега
+        with transaction.atomic():
+            serializer.save()
+            RunTrack.objects.filter(run_id=serializer.instance.id).delete()
+
 
 class RunStartView(APIView):
     def post(self, request, run_id):
@@ -61,42 +109,10 @@ class RunStartView(APIView):
 
 class RunStopView(APIView):
     def post(self, request, run_id):
-        run = get_object_or_404(Run, pk=run_id)
-        if run.status == "in_progress":
-            run.status = "finished"
-            run.save()
-
-            athlete = run.athlete
-            finished_runs = athlete.runs.filter(status="finished")
-            if finished_runs.count() == 10:
-                create_challenge("Сделай 10 Забегов!", athlete)
-
-            all_positions = run.positions.all().order_by("date_time")
-            if all_positions.count() > 1:
-                positions_coords = []
-                for position in all_positions:
-                    positions_coords.append((position.latitude, position.longitude))
-
-                total_distance = calculate_distance(positions_coords)
-                run.distance = round(total_distance, 2)
-
-                min_time = all_positions.aggregate(min_time=Min("date_time")).get("min_time")
-                max_time = all_positions.aggregate(max_time=Max("date_time")).get("max_time")
-                run_time = (max_time - min_time).total_seconds()
-                run.run_time_seconds = run_time if run_time else 0
-
-                avg_speed = run.positions.aggregate(avg_speed=Avg("speed")).get("avg_speed")
-                run.speed = round(avg_speed, 2)
-
-                run.save()
-
-            total_distance = finished_runs.aggregate(total_distance=Sum("distance")).get("total_distance", 0)
-            if total_distance and total_distance >= 50:
-                create_challenge("Пробеги 50 километров!", athlete)
-
-            if total_distance and total_distance >= 2 and run.run_time_seconds / 60 <= 10:
-                create_challenge("2 километра за 10 минут!", athlete)
-        else:
+        run, stopped = stop_run(run_id)
+        if run is None:
+            raise Http404(f"No {Run._meta.object_name} matches the given query.")
+        if not stopped:
             return Response({
                 "message": "Невозможно закончить забег, он не начат"
             }, status=status.HTTP_400_BAD_REQUEST)
@@ -106,19 +122,22 @@ class RunStopView(APIView):
         })
 
 
-class UserViewSet(viewsets.ReadOnlyModelViewSet):
-    queryset = User.objects.exclude(is_superuser=True).order_by("id").annotate(
-        runs_finished=Count("runs", filter=Q(runs__status="finished")),
-        avg_rating=Avg("rated_by__rating")
-    )
+class UserViewSet(ValuesListMixin, viewsets.ReadOnlyModelViewSet):
+    queryset = User.objects.exclude(is_superuser=True).order_by("id").select_related("stats")
     serializer_class = UserSerializer
-    pagination_class = SizePagination
+    values_serializer_class = UserValuesSerializer
+    pagination_class = UserPagination
     filter_backends = [SearchFilter, OrderingFilter]
     search_fields = ["first_name", "last_name"]
     ordering_fields = ["date_joined"]
 
     def get_queryset(self):
         qs = self.queryset
+        if self.action == "retrieve":
+            return qs.annotate(
+                coach_id=Subquery(Subscribe.objects.filter(subscriber=OuterRef("pk")).values("subscribed_to_id")[:1])
+            )
+
         q_type = self.request.query_params.get("type", None)
         if q_type:
             if q_type == "coach":
@@ -128,6 +147,19 @@ class UserViewSet(viewsets.ReadOnlyModelViewSet):
 
         return qs
 
+    def get_object(self):
+        # Пользователь нужен и для выбора сериализатора, и для ответа: загружаем его один раз.
+        # Тренер атлета приходит в том же запросе, предметы атлета или подписчики тренера - вторым
+        if not hasattr(self, "_object"):
+            user = super().get_object()
+            if user.is_staff:
+                prefetch_related_objects([user], Prefetch("subscriptions", queryset=Subscribe.objects.order_by("id")))
+            else:
+                prefetch_related_objects([user], "items")
+            self._object = user
+
+        return self._object
+
     def get_serializer_class(self):
         if self.action == "list":
             return UserSerializer
@@ -142,6 +174,15 @@ class UserViewSet(viewsets.ReadOnlyModelViewSet):
         return super().get_serializer_class()
 
 
+class AthleteHistoryView(APIView):
+    # Графики прогресса читают только строки итогов, без агрегации забегов
+    def get(self, request, athlete_id):
+        bucket, date_from, date_to = get_history_params(request.query_params)
+        get_object_or_404(User, pk=athlete_id)
+
+        return Response(ActivityRollupSerializer(get_athlete_history(athlete_id, bucket, date_from, date_to), many=True).data)
+
+
 class AthleteInfoView(APIView):
     def get(self, request, user_id):
         user = get_object_or_404(User, pk=user_id)
@@ -180,6 +221,7 @@ class AthleteInfoView(APIView):
         }, status=status.HTTP_201_CREATED)
 
 
+@method_decorator(table_condition("challenge"), name="get")
 class ChallengeListView(ListAPIView):
     serializer_class = ChallengeSerializer
 
@@ -192,85 +234,102 @@ class ChallengeListView(ListAPIView):
 
 
 class ChallengeSummaryView(APIView):
+    @method_decorator(table_condition("challenge"))
     def get(self, request):
-        data = []
-
-        challenges = Challenge.objects.all().select_related("athlete")
-        if challenges.exists():
-            challenges_names = set(challenges.values_list("full_name", flat=True))
-            for challenge_name in challenges_names:
-                athletes = challenges.filter(full_name=challenge_name).values_list("athlete_id", "athlete__first_name", "athlete__last_name",
-                                                                                   "athlete__username")
-
-                data.append({
-                    "name_to_display": challenge_name,
-                    "athletes": [{"id": athlete[0], "full_name": f"{athlete[1]} {athlete[2]}", "username": athlete[3]} for athlete in athletes]
-                })
-
-        return Response(data)
+        return Response(get_challenge_summary(request.table_versions["challenge"]))
 
 
 class PositionViewSet(viewsets.ModelViewSet):
     serializer_class = PositionSerializer
+    pagination_class = PositionPagination
 
     def get_queryset(self):
         run_id = self.request.query_params.get("run", None)
+        if run_id and run_id.isdigit():
+            return get_run_positions(run_id).select_related("run").order_by("date_time", "id")
         if run_id:
-            return Position.objects.filter(run__id=run_id).select_related("run")
+            return Position.objects.filter(run__id=run_id).select_related("run").order_by("date_time", "id")
 
         return Position.objects.all().select_related("run")
 
+    def list(self, request, *args, **kwargs):
+        if is_cursor_request(request):
+            if "tolerance" in request.query_params or "max_points" in request.query_params:
+                raise ValidationError({"pagination": ["Упрощение трека недоступно при курсорной пагинации"]})
+            return super().list(request, *args, **kwargs)
+
+        run_id = request.query_params.get("run", None)
+        tolerance, max_points = get_simplification_params(request.query_params)
+        if run_id and run_id.isdigit():
+            positions = get_track_positions(run_id, tolerance, max_points)
+            if positions is not None:
+                return Response(positions)
+
+        response = super().list(request, *args, **kwargs)
+        if run_id and (tolerance is not None or max_points is not None):
+            response.data = simplify_positions(response.data, tolerance, max_points)
+
+        return response
+
     def create(self, request, *args, **kwargs):
         serializer = self.get_serializer(data=request.data)
         if serializer.is_valid():
-            position_run = serializer.validated_data["run"]
-            position_latitude = serializer.validated_data["latitude"]
-            position_longitude = serializer.validated_data["longitude"]
-            position_coords = (position_latitude, position_longitude)
-            position_date_time = serializer.validated_data["date_time"]
-
-            all_positions = Position.objects.filter(run=position_run).order_by("date_time")
-            if all_positions.exists():
-                last_position = all_positions.last()
-                last_position_coords = (last_position.latitude, last_position.longitude)
-                last_position_date_time = last_position.date_time
-                last_position_distance = last_position.distance
-
-                dist_diff = geodesic(position_coords, last_position_coords).meters
-                time_diff = (position_date_time - last_position_date_time).total_seconds()
-                speed = round(dist_diff / time_diff, 2) if time_diff else 0
-                distance = round(last_position_distance + dist_diff / 1000, 2)
-
-                position = serializer.save(speed=speed, distance=distance)
-            else:
-                position = serializer.save()
+            position = Position(**serializer.validated_data)
+            collectible = record_position(position)
+            if collectible:
+                return Response({
+                    "message": f"Вы нашли предмет {collectible.name}",
+                    "item_id": collectible.id
+                }, status=status.HTTP_201_CREATED)
 
-            user = position.run.athlete
+            return Response(PositionSerializer(position).data, status=status.HTTP_201_CREATED)
 
-            collectible_items = CollectibleItem.objects.all().prefetch_related("users")
-            if collectible_items:
-                for collectible in collectible_items:
-                    latitude = collectible.latitude
-                    longitude = collectible.longitude
-                    collectible_coords = (collectible.latitude, collectible.longitude)
+        return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
-                    if latitude > 90 or latitude < -90 or longitude > 180 or longitude < -180:
-                        continue
+    def check_run_editable(self, run):
+        # Позиции законченного забега учтены в его итогах и упакованном треке
+        if run.status == "finished":
+            raise ValidationError({"run": ["Позиции законченного забега нельзя изменить"]})
 
-                    distance = geodesic(position_coords, collectible_coords).meters
-                    if distance <= 100:
-                        if user not in collectible.users.all():
-                            collectible.users.add(user)
-                            return Response({
-                                "message": f"Вы нашли предмет {collectible.name}",
-                                "item_id": collectible.id
-                            }, status=status.HTTP_201_CREATED)
+    def perform_update(self, serializer):
+        self.check_run_editable(serializer.instance.run)
+        # Итоги забега сохранённой позиции пересчитывает сигнал position_saved, здесь - только прежнего забега
+        run_id = serializer.instance.run_id
+        with transaction.atomic():
+            serializer.save()
+            if serializer.instance.run_id != run_id:
+                refresh_run_aggregates(run_id)
 
-            return Response(serializer.data, status=status.HTTP_201_CREATED)
+    def perform_destroy(self, instance):
+        self.check_run_editable(instance.run)
+        with transaction.atomic():
+            instance.delete()
+            refresh_run_aggregates(instance.run_id)
 
-        return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+    @action(detail=False, methods=["post"])
+    def batch(self, request):
+        serializer = PositionBatchSerializer(data=request.data)
+        if not serializer.is_valid():
+            return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+
+        run = serializer.validated_data["run"]
+        points = serializer.validated_data["positions"]
+
+        positions = save_positions(run, [Position(**point) for point in points])
 
+        coords_list = [(position.latitude, position.longitude) for position in positions]
+        collectibles = find_collectible_items(run.athlete_id, coords_list, get_nearby_collectible_items(coords_list))
 
+        data = PositionSerializer(positions, many=True).data
+        for result, collectible in zip(data, collectibles):
+            if collectible:
+                result["message"] = f"Вы нашли предмет {collectible.name}"
+                result["item_id"] = collectible.id
+
+        return Response(data, status=status.HTTP_201_CREATED)
+
+
+@method_decorator(table_condition("collectible_item"), name="get")
 class CollectibleItemView(ListAPIView):
     queryset = CollectibleItem.objects.all()
     serializer_class = CollectibleItemSerializer
@@ -280,33 +339,40 @@ class UploadCollectibleItemView(APIView):
     def post(self, request):
         file = request.data.get("file", None)
         if file:
-            workbook = openpyxl.load_workbook(file)
-            worksheet = workbook.active
-            invalid_rows = []
-
-            for row in worksheet.iter_rows(min_row=2, values_only=True):
-                data = {
-                    "name": row[0],
-                    "uid": row[1],
-                    "value": row[2],
-                    "latitude": row[3],
-                    "longitude": row[4],
-                    "picture": row[5]
-                }
-
-                serializer = CollectibleItemSerializer(data=data)
-                if serializer.is_valid():
-                    serializer.save()
-                else:
-                    invalid_rows.append(list(data.values()))
+            _, invalid_rows = import_collectible_items(file)
+            if request.query_params.get("details"):
+                return Response(invalid_rows)
 
-            return Response(invalid_rows)
+            return Response([invalid_row["values"] for invalid_row in invalid_rows])
 
         return Response({
             "message": "Пожалуйста, загрузите Excel-файл"
         }, status=status.HTTP_400_BAD_REQUEST)
 
 
+class UploadJobView(APIView):
+    def post(self, request):
+        file = request.data.get("file", None)
+        if not file:
+            return Response({
+                "message": "Пожалуйста, загрузите Excel-файл"
+            }, status=status.HTTP_400_BAD_REQUEST)
+
+        job = UploadJob.objects.create(file=file)
+
+        return Response({
+            "job_id": job.id,
+            "status": job.status
+        }, status=status.HTTP_202_ACCEPTED)
+
+
+class UploadJobDetailView(APIView):
+    def get(self, request, job_id):
+        job = get_object_or_404(UploadJob, pk=job_id)
+
+        return Response(UploadJobSerializer(job).data)
+
+
 class SubscribeToCoachView(APIView):
     def post(self, request, coach_id):
         athlete_id = request.data.get("athlete")
@@ -384,9 +450,13 @@ class RateCoachView(APIView):
 
         rate = Rating.objects.filter(rater=athlete, rated=coach).first()
         if rate:
+            old_rating = rate.rating
             serializer = RatingSerializer(rate, data={"rating": rating}, partial=True)
             if serializer.is_valid():
-                serializer.save()
+                with transaction.atomic():
+                    serializer.save()
+                    update_athlete_stats(coach.id, rating_sum=serializer.instance.rating - old_rating)
+
                 return Response(serializer.data)
             else:
                 return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
@@ -399,7 +469,10 @@ class RateCoachView(APIView):
 
             serializer = RatingSerializer(data=data)
             if serializer.is_valid():
-                serializer.save()
+                with transaction.atomic():
+                    serializer.save()
+                    update_athlete_stats(coach.id, rating_sum=serializer.instance.rating, rating_count=1)
+
                 return Response(serializer.data)
             else:
                 return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
@@ -407,43 +480,68 @@ class RateCoachView(APIView):
 
 class CoachAnalyticsView(APIView):
     def get(self, request, coach_id):
-        data = {
-            "longest_run_user": None,
-            "longest_run_value": None,
-            "total_run_user": None,
-            "total_run_value": None,
-            "speed_avg_user": None,
-            "speed_avg_value": None
-        }
-
-        athletes = User.objects.filter(subscribers__subscribed_to_id=coach_id).annotate(
-            runs_finished=Count("runs", filter=Q(runs__status="finished")),
-            longest_run_distance=Max("runs__distance", filter=Q(runs__status="finished")),
-            total_runs_distance=Sum("runs__distance", filter=Q(runs__status="finished")),
-            avg_speed=Avg("runs__speed", filter=Q(runs__status="finished"))
-        )
+        return Response(get_coach_analytics(coach_id))
 
-        if athletes.exists():
-            max_values = athletes.aggregate(
-                max_run_distance=Max("longest_run_distance"),
-                max_runs=Max("runs_finished"),
-                max_avg_speed=Max("avg_speed")
-            )
 
-            longest_run_value = max_values.get("max_run_distance")
-            longest_run_user = athletes.filter(runs__distance=longest_run_value).first().id
-            data["longest_run_user"] = longest_run_user
-            data["longest_run_value"] = longest_run_value
+class LeaderboardMixin:
+    def initial(self, request, *args, **kwargs):
+        super().initial(request, *args, **kwargs)
+        if kwargs["board"] not in LEADERBOARDS:
+            raise Http404("Таблица лидеров не найдена")
+
+
+class LeaderboardView(LeaderboardMixin, APIView):
+    def get(self, request, board):
+        coach_id, limit = get_leaderboard_params(request.query_params)
+
+        return Response(get_leaderboard_top(board, coach_id, limit))
+
+
+class LeaderboardRankView(LeaderboardMixin, APIView):
+    def get(self, request, board, athlete_id):
+        coach_id, _ = get_leaderboard_params(request.query_params)
+        entry = get_leaderboard_stats(board, athlete_id, coach_id)
+        if entry is None:
+            return Response({
+                "message": "Атлет не участвует в таблице лидеров"
+            }, status=status.HTTP_404_NOT_FOUND)
+
+        return Response(entry)
+
+
+class LeaderboardAroundView(LeaderboardMixin, APIView):
+    def get(self, request, board):
+        coach_id, limit = get_leaderboard_params(request.query_params, default_limit=5)
+        # Пустой параметр (?athlete=) считается не указанным
+        athlete_id = request.query_params.get("athlete", None) or None
+        rank = request.query_params.get("rank", None) or None
+
+        if (athlete_id is None) == (rank is None):
+            return Response({
+                "message": "Укажите атлета или место"
+            }, status=status.HTTP_400_BAD_REQUEST)
+        if not (athlete_id or rank).isdigit() or int(athlete_id or rank) < 1:
+            return Response({
+                "message": "Атлет и место должны быть целыми положительными числами"
+            }, status=status.HTTP_400_BAD_REQUEST)
+
+        entries = get_leaderboard_around(
+            board,
+            athlete_id=int(athlete_id) if athlete_id else None,
+            rank=int(rank) if rank else None,
+            coach_id=coach_id,
+            size=limit
+        )
+        if entries is None:
+            return Response({
+                "message": "Место в таблице лидеров не найдено"
+            }, status=status.HTTP_404_NOT_FOUND)
+
+        return Response(entries)
 
-            max_runs = max_values.get("max_runs")
-            total_run_user = athletes.filter(runs_finished=max_runs).first().id
-            total_run_value = athletes.filter(id=total_run_user).first().total_runs_distance
-            data["total_run_user"] = total_run_user
-            data["total_run_value"] = total_run_value
 
-            speed_avg_value = max_values.get("max_avg_speed")
-            speed_avg_user = athletes.filter(avg_speed=speed_avg_value).first().id
-            data["speed_avg_user"] = speed_avg_user
-            data["speed_avg_value"] = speed_avg_value
+def metrics_view(request):
+    if not settings.METRICS_ENABLED:
+        raise Http404("Метрики отключены")
 
-        return Response(data)
+    return HttpResponse(render_metrics(get_registry().collect()), content_type="text/plain; version=0.0.4; charset=utf-8")
@@ -10,6 +10,8 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/5.0/ref/settings/
 """
 
+import os
+import tempfile
 from pathlib import Path
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
@@ -39,6 +41,36 @@ SITE_SLOGAN = "Бегер - бега трекер"
 SITE_CONTACTS = "Проспект Ленина, дом 1, г.Ленинск"
 
 
+# Track distance model: "ellipsoidal", "haversine" or "geodesic" (see app_run/geo.py)
+
+TRACK_DISTANCE_MODEL = "ellipsoidal"
+
+
+# Request metrics: per-process files merged by /api/metrics/ (see app_run/metrics.py).
+# Files are merged across the workers that share METRICS_DIR. On AWS Lambda (Zappa) every container has
+# its own /tmp and a single worker, so metrics are off there unless METRICS_ENABLED=1 and METRICS_DIR
+# points to storage shared by all containers. The test runner turns them off (project_run/test_runner.py).
+
+METRICS_ENABLED = os.environ.get("METRICS_ENABLED", "0" if "AWS_LAMBDA_FUNCTION_NAME" in os.environ else "1") == "1"
+METRICS_DIR = os.environ.get("METRICS_DIR", os.path.join(tempfile.gettempdir(), "project_run_metrics"))
+METRICS_FLUSH_INTERVAL = 1
+
+TEST_RUNNER = "project_run.test_runner.TestRunner"
+
+
+# Live position feed for coaches over SSE (see app_run/live.py)
+
+LIVE_FEED_QUEUE_SIZE = 100
+LIVE_FEED_HEARTBEAT = 15
+
+
+# Write-behind buffer for position inserts (see app_run/buffer.py)
+
+POSITION_WRITE_BEHIND = os.environ.get("POSITION_WRITE_BEHIND", "") == "1"
+POSITION_BUFFER_SIZE = 500
+POSITION_BUFFER_INTERVAL = 1
+
+
 # Application definition
 
 INSTALLED_APPS = [
@@ -57,6 +89,7 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'app_run.metrics.MetricsMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -125,6 +158,9 @@ USE_TZ = True
 STATIC_URL = 'static/'
 STATIC_ROOT = 'static'
 
+MEDIA_URL = 'media/'
+MEDIA_ROOT = BASE_DIR / 'media'
+
 # Default primary key field type
 # https://docs.djangoproject.com/en/5.0/ref/settings/#default-auto-field
 
@@ -1,5 +1,10 @@
+import os
+
 from .base import *
 
+# Замеры запускают серверы с DJANGO_DEBUG=0, чтобы debug toolbar не искажал время ответа
+DEBUG = os.environ.get('DJANGO_DEBUG', '1') == '1'
+
 # Database
 # https://docs.djangoproject.com/en/5.0/ref/settings/#databases
 
@@ -7,5 +12,24 @@ DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
         'NAME': BASE_DIR / 'db.sqlite3',
+        # Транзакции сразу берут блокировку на запись, чтобы параллельные запросы ждали друг друга, а не падали
+        'OPTIONS': {
+            'transaction_mode': 'IMMEDIATE',
+            'timeout': 20,
+        },
     }
-}
\ No newline at end of file
+}
+
+# Тесты секционирования позиций идут только на PostgreSQL: DJANGO_DATABASE=postgresql подключает базу
+# с теми же переменными окружения, что и в production
+if os.environ.get('DJANGO_DATABASE') == 'postgresql':
+    DATABASES = {
+        'default': {
+            'ENGINE': 'django.db.backends.postgresql',
+            'NAME': os.environ.get('DB_NAME', 'db_name'),
+            'USER': os.environ.get('DB_USER', 'db_user'),
+            'PASSWORD': os.environ.get('DB_PASSWORD', 'db_pass'),
+            'HOST': os.environ.get('DB_HOST', 'localhost'),
+            'PORT': os.environ.get('DB_PORT', '5432'),
+        }
+    }
\ No newline at end of file
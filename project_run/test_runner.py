@@ -0,0 +1,10 @@
+from django.conf import settings
+from django.test.runner import DiscoverRunner
+
+
+class TestRunner(DiscoverRunner):
+    # Тесты не запускают поток сброса метрик и не пишут свои файлы в общий METRICS_DIR, где их сложил бы
+    # с метриками воркеров эндпоинт /api/metrics/. Тесты метрик включают их через override_settings.
+    def setup_test_environment(self, **kwargs):
+        super().setup_test_environment(**kwargs)
+        settings.METRICS_ENABLED = False
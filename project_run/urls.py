@@ -22,9 +22,12 @@ from rest_framework.routers import DefaultRouter
 
 from debug_toolbar.toolbar import debug_toolbar_urls
 
+from app_run.async_views import position_create_view, run_start_view, run_stop_view, coach_live_feed_view
 from app_run.views import company_details_view, RunViewSet, UserViewSet, RunStartView, RunStopView, AthleteInfoView, ChallengeListView, \
     ChallengeSummaryView, \
-    PositionViewSet, CollectibleItemView, UploadCollectibleItemView, SubscribeToCoachView, RateCoachView, CoachAnalyticsView
+    PositionViewSet, CollectibleItemView, UploadCollectibleItemView, SubscribeToCoachView, RateCoachView, CoachAnalyticsView, \
+    UploadJobView, UploadJobDetailView, metrics_view, LeaderboardView, LeaderboardRankView, LeaderboardAroundView, \
+    AthleteHistoryView
 
 router = DefaultRouter()
 router.register("runs", RunViewSet)
@@ -38,13 +41,24 @@ urlpatterns = [
     path("api/runs/<int:run_id>/start/", RunStartView.as_view()),
     path("api/runs/<int:run_id>/stop/", RunStopView.as_view()),
     path("api/athlete_info/<int:user_id>/", AthleteInfoView.as_view()),
+    path("api/athletes/<int:athlete_id>/history/", AthleteHistoryView.as_view()),
     path("api/challenges/", ChallengeListView.as_view()),
     path("api/challenges_summary/", ChallengeSummaryView.as_view()),
     path("api/collectible_item/", CollectibleItemView.as_view()),
     path("api/upload_file/", UploadCollectibleItemView.as_view()),
+    path("api/upload_jobs/", UploadJobView.as_view()),
+    path("api/upload_jobs/<int:job_id>/", UploadJobDetailView.as_view()),
     path("api/subscribe_to_coach/<int:coach_id>/", SubscribeToCoachView.as_view()),
     path("api/rate_coach/<int:coach_id>/", RateCoachView.as_view()),
     path("api/analytics_for_coach/<int:coach_id>/", CoachAnalyticsView.as_view()),
+    path("api/leaderboards/<str:board>/", LeaderboardView.as_view()),
+    path("api/leaderboards/<str:board>/rank/<int:athlete_id>/", LeaderboardRankView.as_view()),
+    path("api/leaderboards/<str:board>/around/", LeaderboardAroundView.as_view()),
+    path("api/metrics/", metrics_view),
+    path("api/async/positions/", position_create_view),
+    path("api/async/runs/<int:run_id>/start/", run_start_view),
+    path("api/async/runs/<int:run_id>/stop/", run_stop_view),
+    path("api/async/coaches/<int:coach_id>/live/", coach_live_feed_view),
 ]
 
 if settings.DEBUG: